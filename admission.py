@@ -0,0 +1,100 @@
+"""
+Admission control on the accept path.
+
+After a network blip every device reconnects at once. Rather than giving
+each of them a thread (threaded mode) or a protocol object and a CONNECT to
+parse before finding out the broker can't cope, a connection is admitted
+only if
+
+- the accept rate allows it (a token bucket), and
+- fewer than `max_half_open` connections are waiting for their CONNECT,
+  each of which has `connect_timeout` seconds to send it.
+
+Connections that don't pass are closed right away; the kernel's listen
+backlog and the clients' reconnect backoff absorb the rest. Admitted clients
+beyond `max_connections` get a CONNACK with return code 3 (server
+unavailable) instead of a session.
+"""
+
+from typing import Optional
+import threading
+from ratelimit import TokenBucket
+
+
+class Admission:
+    # Connections accepted but without a CONNECT yet
+    MAX_HALF_OPEN = 10000
+
+    # Seconds a connection has to send its CONNECT
+    CONNECT_TIMEOUT = 10
+
+    def __init__(
+        self,
+        accept_rate: float = 0.0,
+        accept_burst: Optional[float] = None,
+        max_half_open: int = MAX_HALF_OPEN,
+        max_connections: int = 0,
+        connect_timeout: float = CONNECT_TIMEOUT,
+    ):
+        # 0 turns a limit off
+        self.bucket = None
+        if accept_rate > 0:
+            self.bucket = TokenBucket(accept_rate, accept_burst)
+        self.max_half_open = max_half_open
+        self.max_connections = max_connections
+        self.connect_timeout = connect_timeout
+
+        self.half_open = 0
+
+        # counters: connections closed on accept, CONNECTs answered with
+        # server unavailable, connections that lost their client id to a
+        # newer one, and those that never sent a CONNECT
+        self.refused = 0
+        self.rejected = 0
+        self.taken_over = 0
+        self.timed_out = 0
+
+        # Accepts and CONNECTs come from every handler thread in threaded
+        # mode
+        self.lock = threading.Lock()
+
+    def accept(self) -> bool:
+        """
+        Decides on a connection that was just accepted. An admitted one is
+        half-open until `release()`d.
+        """
+        with self.lock:
+            if (self.max_half_open > 0 and self.half_open >= self.max_half_open) or (
+                self.bucket is not None and not self.bucket.take()
+            ):
+                self.refused += 1
+                return False
+            self.half_open += 1
+            return True
+
+    def release(self):
+        """
+        Ends a half-open connection: it sent its CONNECT, or went away.
+        """
+        with self.lock:
+            self.half_open -= 1
+
+    def full(self, connected: int) -> bool:
+        """
+        Returns whether a new client can't be let in, with `connected`
+        clients connected already, and counts it as rejected if so.
+        """
+        if self.max_connections == 0 or connected < self.max_connections:
+            return False
+        with self.lock:
+            self.rejected += 1
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "half_open": self.half_open,
+            "refused": self.refused,
+            "rejected": self.rejected,
+            "taken_over": self.taken_over,
+            "timed_out": self.timed_out,
+        }
@@ -0,0 +1,265 @@
+"""
+asyncio server mode: every client is an `asyncio.BufferedProtocol` driven by a single
+event loop, so an idle client costs a few hundred bytes of Python objects
+instead of an OS thread and its stack.
+
+Buffered protocols are used rather than streams on purpose: streams need one task
+(and its coroutine frame) per client, which is what dominates memory at tens
+of thousands of idle connections.
+"""
+
+import asyncio
+import logging
+from typing import Optional
+from broker import Broker, Connection
+from framer import Framer
+from outbound import QueueOverflow, frame_size
+from protocol import deserialize_mqtt_message
+
+logger = logging.getLogger(__name__)
+
+
+class MqttProtocol(asyncio.BufferedProtocol, Connection):
+    """
+    Unless the broker's `coalesce_bytes` is 0, frames sent during one
+    iteration of the event loop are handed to the transport together, in one
+    write, and so are those of a batch that reached `coalesce_bytes`. With a
+    `coalesce_delay`, a batch waits that long instead of for the end of the
+    iteration.
+    """
+
+    __slots__ = (
+        "broker",
+        "transport",
+        "framer",
+        "resume_handle",
+        "paused",
+        "pending",
+        "pending_size",
+        "flush_handle",
+        "writes",
+    )
+
+    def __init__(self, broker: Broker):
+        Connection.__init__(self, broker.next_conn_id(), broker.new_outbound_queue())
+        self.broker = broker
+        self.transport: Optional[asyncio.Transport] = None
+        self.framer = Framer(max_packet_size=broker.max_packet_size)
+
+        # Reading resumes when this fires, see `pause_reading`
+        self.resume_handle: Optional[asyncio.TimerHandle] = None
+
+        # Set while the transport's own write buffer is above its high-water
+        # mark; frames then wait in our bounded queue instead.
+        self.paused = False
+
+        # Frames gathered for the next write, their size, and the scheduled
+        # flush
+        self.pending = []
+        self.pending_size = 0
+        self.flush_handle: Optional[asyncio.Handle] = None
+
+        # transport writes, batched or not
+        self.writes = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if not self.broker.admit():
+            transport.abort()
+            return
+        self.broker.await_connect(self)
+
+    def get_buffer(self, sizehint):
+        # The event loop recv_into()s the framer's buffer directly
+        return self.framer.recv_buffer()
+
+    def buffer_updated(self, nbytes):
+        self.framer.advance(nbytes)
+        self.handle_frames()
+
+    def handle_frames(self):
+        try:
+            for data in self.framer.frames():
+                request, _ = deserialize_mqtt_message(data)
+                if not self.broker.handle_message(self, request, data):
+                    self.close()
+                    return
+                if self.resume_handle is not None:
+                    # Over its rate limits; the rest waits in the framer
+                    return
+        except Exception as e:
+            logger.warning("[%s] Closing connection: %r", self.conn_id, e)
+            self.close()
+
+    def connection_lost(self, exc):
+        logger.info("[%s] Client %s disconnected", self.conn_id, self.client_id)
+        if self.resume_handle is not None:
+            self.resume_handle.cancel()
+        self.broker.disconnect(self)
+        self.queue.close()
+        self.transport = None
+        self.discard_pending()
+
+    def pause_reading(self, delay: float):
+        if self.transport is None or self.transport.is_closing():
+            return
+        loop = asyncio.get_running_loop()
+        resume_at = loop.time() + delay
+        if self.resume_handle is not None:
+            if self.resume_handle.when() >= resume_at:
+                return
+            self.resume_handle.cancel()
+        else:
+            self.transport.pause_reading()
+        self.resume_handle = loop.call_at(resume_at, self.resume_reading)
+
+    def resume_reading(self):
+        self.resume_handle = None
+        if self.transport is None or self.transport.is_closing():
+            return
+        self.handle_frames()
+        if self.resume_handle is None and self.transport is not None:
+            self.transport.resume_reading()
+
+    def pause_writing(self):
+        self.paused = True
+
+    def resume_writing(self):
+        self.paused = False
+        self.drain()
+
+    def drain(self):
+        while not self.paused and len(self.queue) > 0:
+            for frame in self.queue.take():
+                self.write(frame)
+
+    def write(self, frame):
+        size = frame_size(frame)
+        self.broker.metrics.counters().bytes_out += size
+
+        coalesce_bytes = self.broker.coalesce_bytes
+        if coalesce_bytes == 0:
+            if isinstance(frame, tuple):
+                self.transport.writelines(frame)
+            else:
+                self.transport.write(frame)
+            self.writes += 1
+            return
+
+        if isinstance(frame, tuple):
+            self.pending.extend(frame)
+        else:
+            self.pending.append(frame)
+        self.pending_size += size
+
+        if self.pending_size >= coalesce_bytes:
+            self.flush()
+        elif self.flush_handle is None:
+            loop = asyncio.get_running_loop()
+            delay = self.broker.coalesce_delay
+            if delay > 0:
+                self.flush_handle = loop.call_later(delay, self.flush)
+            else:
+                self.flush_handle = loop.call_soon(self.flush)
+
+    def flush(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        if self.transport is not None and len(self.pending) > 0:
+            self.transport.writelines(self.pending)
+            self.writes += 1
+        self.pending = []
+        self.pending_size = 0
+
+    def discard_pending(self):
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        self.pending = []
+        self.pending_size = 0
+
+    def send(self, data, droppable: bool = False):
+        if self.transport is None or self.transport.is_closing():
+            return
+
+        if not self.paused and len(self.queue) == 0:
+            self.write(data)
+            return
+
+        try:
+            self.queue.put(data, droppable)
+        except QueueOverflow as e:
+            logger.warning(
+                "[%s] Outbound queue overflow, disconnecting: %s", self.conn_id, e
+            )
+            self.abort()
+
+    def abort(self):
+        self.queue.close()
+        self.discard_pending()
+        if self.transport is not None:
+            self.transport.abort()
+
+    def close(self):
+        if self.transport is not None and not self.transport.is_closing():
+            # Hand whatever is still queued to the transport, which flushes
+            # its buffer before closing.
+            while len(self.queue) > 0:
+                for frame in self.queue.take():
+                    self.write(frame)
+            self.flush()
+            self.transport.close()
+
+
+class AsyncServer:
+    # Pending connections the kernel queues for us; a reconnect storm easily
+    # overflows the default of 100.
+    BACKLOG = 4096
+
+    def __init__(self, server_address, broker=None, reuse_port=False):
+        self.server_address = server_address
+        self.broker = broker if broker is not None else Broker()
+
+        # Lets worker processes listen on the same port; the kernel spreads
+        # incoming connections over them
+        self.reuse_port = reuse_port
+        self.server: Optional[asyncio.base_events.Server] = None
+        self.tasks = []
+
+    async def start(self):
+        loop = asyncio.get_running_loop()
+        self.broker.fanout.start_loop(loop)
+        host, port = self.server_address
+        self.server = await loop.create_server(
+            lambda: MqttProtocol(self.broker),
+            host,
+            port,
+            reuse_address=True,
+            reuse_port=self.reuse_port,
+            backlog=self.BACKLOG,
+        )
+        self.tasks.append(loop.create_task(self.run_timers()))
+        logger.info("Listening on %s:%s", *self.address()[:2])
+
+    def address(self):
+        return self.server.sockets[0].getsockname()
+
+    async def run_timers(self):
+        timers = self.broker.timers
+        while True:
+            await asyncio.sleep(timers.tick)
+            timers.advance()
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        self.server.close()
+        await self.server.wait_closed()
+
+    async def serve_forever(self):
+        if self.server is None:
+            await self.start()
+
+        async with self.server:
+            await self.server.serve_forever()
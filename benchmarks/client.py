@@ -0,0 +1,179 @@
+"""
+Minimal asyncio MQTT 3.1.1 client for the benchmarks, built on the broker's
+own codec.
+
+It speaks just enough of the protocol to drive load: CONNECT, SUBSCRIBE,
+PUBLISH at any QoS with the acks that go with it, PINGREQ and DISCONNECT.
+Received messages are handed to a callback as they arrive. Every publish
+returns a future that completes when the broker acked the message (right
+away for QoS 0), so a publisher can keep a bounded number in flight.
+"""
+
+import asyncio
+import itertools
+from typing import Callable, Dict, List, Optional, Tuple
+from protocol import (
+    MqttConnect,
+    MqttDisconnect,
+    MqttPingreq,
+    MqttPubcomp,
+    MqttPuback,
+    MqttPubrec,
+    MqttPubrel,
+    MqttSubscribe,
+    QosLevel,
+    deserialize_mqtt_publish,
+    encode_topic,
+    serialize_mqtt_publish_header,
+)
+
+
+class Client:
+    def __init__(
+        self,
+        on_message: Optional[Callable[[str, memoryview, QosLevel], None]] = None,
+    ):
+        self.on_message = on_message
+        self.reader: Optional[asyncio.StreamReader] = None
+        self.writer: Optional[asyncio.StreamWriter] = None
+        self.task: Optional[asyncio.Task] = None
+
+        self.packet_ids = itertools.cycle(range(1, 0x10000))
+
+        # Futures of the CONNACK, of SUBACKs and of QoS 1/2 publishes, by
+        # packet id
+        self.connack: Optional[asyncio.Future] = None
+        self.pending: Dict[bytes, asyncio.Future] = {}
+
+    async def connect(
+        self, host: str, port: int, client_id: str, clean: bool = True
+    ) -> bool:
+        """
+        Returns whether the broker resumed a session.
+        """
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.connack = asyncio.get_running_loop().create_future()
+        self.task = asyncio.get_running_loop().create_task(self.read_loop())
+
+        flags = 0x02 if clean else 0x00
+        self.writer.write(MqttConnect("MQTT", 4, flags, 0, client_id).serialize())
+        return await self.connack
+
+    async def subscribe(self, topics: List[Tuple[str, QosLevel]]) -> bytes:
+        """
+        Returns the SUBACK return codes.
+        """
+        packet_id = self.next_packet_id()
+        done = self.pending[packet_id] = asyncio.get_running_loop().create_future()
+        self.writer.write(MqttSubscribe(packet_id, topics).serialize())
+        return await done
+
+    def publish(
+        self, topic: str, payload: bytes, qos_level: QosLevel = QosLevel.AT_MOST_ONCE
+    ) -> asyncio.Future:
+        done = asyncio.get_running_loop().create_future()
+        packet_id = b""
+        if qos_level == QosLevel.AT_MOST_ONCE:
+            done.set_result(None)
+        else:
+            packet_id = self.next_packet_id()
+            self.pending[packet_id] = done
+
+        header = serialize_mqtt_publish_header(
+            encode_topic(topic), qos_level, packet_id, len(payload)
+        )
+        self.writer.writelines((header, payload))
+        return done
+
+    async def ping(self):
+        self.writer.write(MqttPingreq().serialize())
+        await self.writer.drain()
+
+    async def drain(self):
+        await self.writer.drain()
+
+    async def disconnect(self):
+        if self.writer is None:
+            return
+        self.writer.write(MqttDisconnect().serialize())
+        await self.close()
+
+    async def close(self):
+        if self.writer is None:
+            return
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except OSError:
+            pass
+        self.task.cancel()
+        self.writer = None
+
+    def abort(self):
+        """
+        Drops the connection without a DISCONNECT or a proper close, like a
+        device losing its network.
+        """
+        if self.writer is None:
+            return
+        self.writer.transport.abort()
+        self.task.cancel()
+        self.writer = None
+
+    def next_packet_id(self) -> bytes:
+        return next(self.packet_ids).to_bytes(2, "big")
+
+    async def read_loop(self):
+        try:
+            while True:
+                first_byte, data = await self.read_frame()
+                self.handle(first_byte, data)
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            for future in itertools.chain([self.connack], self.pending.values()):
+                if not future.done():
+                    future.set_exception(ConnectionError(e))
+
+    async def read_frame(self) -> Tuple[int, bytes]:
+        header = await self.reader.readexactly(2)
+        first_byte = header[0]
+        remaining_len = header[1] & 0x7F
+        shift = 7
+        more = header[1] & 0x80
+        while more:
+            (b,) = await self.reader.readexactly(1)
+            remaining_len |= (b & 0x7F) << shift
+            shift += 7
+            more = b & 0x80
+        return first_byte, await self.reader.readexactly(remaining_len)
+
+    def handle(self, first_byte: int, data: bytes):
+        match first_byte >> 4:
+            case 2:  # CONNACK
+                if data[1] != 0:
+                    self.connack.set_exception(
+                        ConnectionError(f"CONNACK return code {data[1]}")
+                    )
+                else:
+                    self.connack.set_result(data[0] == 1)
+            case 3:  # PUBLISH
+                message = deserialize_mqtt_publish(data, first_byte, 0, len(data))
+                match message.qos_level:
+                    case QosLevel.AT_LEAST_ONCE:
+                        self.writer.write(MqttPuback(message.packet_id).serialize())
+                    case QosLevel.EXACTLY_ONCE:
+                        self.writer.write(MqttPubrec(message.packet_id).serialize())
+                if self.on_message is not None:
+                    self.on_message(message.topic, message.payload, message.qos_level)
+            case 4 | 7:  # PUBACK, PUBCOMP
+                self.complete(data[:2], None)
+            case 5:  # PUBREC
+                self.writer.write(MqttPubrel(data[:2]).serialize())
+            case 6:  # PUBREL
+                self.writer.write(MqttPubcomp(data[:2]).serialize())
+            case 9:  # SUBACK
+                self.complete(data[:2], data[2:])
+
+    def complete(self, packet_id: bytes, result):
+        done = self.pending.pop(packet_id, None)
+        if done is not None and not done.done():
+            done.set_result(result)
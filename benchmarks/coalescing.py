@@ -0,0 +1,135 @@
+"""
+Throughput and latency of QoS 0 fan-out with write coalescing on and off.
+
+A publisher sends bursts of small messages stamped with the time they were
+sent; subscribers record when each one arrives. Everything runs in one
+process against an in-process broker, so the numbers compare the two
+settings rather than describe a deployment.
+
+    $ python -m benchmarks.coalescing --mode asyncio
+"""
+
+import argparse
+import asyncio
+import socket
+import statistics
+import struct
+import threading
+import time
+from aio import AsyncServer
+from broker import Broker
+from encoder import Encoder
+from framer import Framer
+from main import Handler, Server
+
+STAMP = struct.Struct("!d")
+
+
+def frame(first_byte: int, body: bytes) -> bytes:
+    encoder = Encoder()
+    encoder.append_byte(first_byte)
+    encoder.append_varint(len(body))
+    encoder.append_bytes(body)
+    return encoder.bytes()
+
+
+def string(s: str) -> bytes:
+    return len(s).to_bytes(2, "big") + s.encode("utf-8")
+
+
+def connect(address, client_id: str) -> socket.socket:
+    sock = socket.create_connection(address)
+    sock.sendall(
+        frame(0x10, string("MQTT") + bytes([4, 2, 0, 0]) + string(client_id))
+    )
+    sock.recv(4)
+    return sock
+
+
+def start_server(mode: str, broker: Broker):
+    """
+    Returns the address of a server running in a background thread.
+    """
+    if mode == "threaded":
+        server = Server(("localhost", 0), Handler, broker)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server.server_address
+
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    server = AsyncServer(("localhost", 0), broker)
+    asyncio.run_coroutine_threadsafe(server.start(), loop).result()
+    return server.address()
+
+
+def receive(sock: socket.socket, count: int, latencies: list):
+    framer = Framer()
+    received = 0
+    while received < count:
+        n = sock.recv_into(framer.recv_buffer())
+        if n == 0:
+            return
+        framer.advance(n)
+        now = time.perf_counter()
+        for data in framer.frames():
+            if data[0] & 0xF0 == 0x30:
+                (sent,) = STAMP.unpack_from(data, len(data) - STAMP.size)
+                latencies.append(now - sent)
+                received += 1
+
+
+def run(mode: str, coalesce_bytes: int, subscribers: int, messages: int, burst: int):
+    broker = Broker(coalesce_bytes=coalesce_bytes, max_queue_depth=messages)
+    address = start_server(mode, broker)
+
+    latencies = [[] for _ in range(subscribers)]
+    readers = []
+    for i in range(subscribers):
+        sock = connect(address, f"sub-{i}")
+        sock.sendall(frame(0x82, b"\x00\x01" + string("bench") + b"\x00"))
+        sock.recv(5)
+        reader = threading.Thread(
+            target=receive, args=(sock, messages, latencies[i]), daemon=True
+        )
+        reader.start()
+        readers.append(reader)
+
+    pub = connect(address, "pub")
+    start = time.perf_counter()
+    for _ in range(messages // burst):
+        pub.sendall(
+            b"".join(
+                frame(0x30, string("bench") + STAMP.pack(time.perf_counter()))
+                for _ in range(burst)
+            )
+        )
+        # Let the broker catch up, so latency isn't just queueing delay
+        time.sleep(0.001)
+    for reader in readers:
+        reader.join()
+    elapsed = time.perf_counter() - start
+
+    all_latencies = sorted(sum(latencies, []))
+    p50 = statistics.median(all_latencies)
+    p99 = all_latencies[int(len(all_latencies) * 0.99)]
+    return len(all_latencies) / elapsed, p50, p99
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write coalescing benchmark")
+    parser.add_argument("--mode", choices=["threaded", "asyncio"], default="asyncio")
+    parser.add_argument("--subscribers", type=int, default=10)
+    parser.add_argument("--messages", type=int, default=20000)
+    parser.add_argument("--burst", type=int, default=50)
+    args = parser.parse_args()
+
+    print(f"{'':<12} {'deliveries/s':>14} {'p50 ms':>8} {'p99 ms':>8}")
+    for name, coalesce_bytes in [("off", 0), ("on", 64 * 1024)]:
+        rate, p50, p99 = run(
+            args.mode, coalesce_bytes, args.subscribers, args.messages, args.burst
+        )
+        print(f"{name:<12} {rate:>14.0f} {p50 * 1000:>8.2f} {p99 * 1000:>8.2f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+"""
+Encode and decode rates of the packet codec for PUBLISH and PUBACK, the
+packets every QoS 1 message costs.
+
+The reference is the codec `protocol.py` had before the dispatch table: a
+`Decoder` per packet re-reading the fixed header, enum lookups and a dict of
+deserializers built per call, and byte-at-a-time `int.to_bytes` encoding.
+Its `protocol.py`, `decoder.py` and `encoder.py` are taken from git as of
+`--reference` and imported as they were, so this needs a git checkout.
+
+    $ python -m benchmarks.codec
+"""
+
+import argparse
+import importlib
+import os
+import subprocess
+import sys
+import tempfile
+import timeit
+from protocol import (
+    MqttPuback,
+    QosLevel,
+    deserialize_mqtt_message,
+    encode_topic,
+    serialize_mqtt_publish_header,
+)
+
+# The last revision with the generic codec
+REFERENCE = "d1daa3d"
+
+CODEC_MODULES = ("protocol", "decoder", "encoder")
+
+
+def load_reference(rev: str):
+    """
+    Returns the `protocol` module as of `rev`, importing the decoder and
+    encoder of `rev` with it. The current modules are left in place.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in CODEC_MODULES:
+            source = subprocess.run(
+                ["git", "show", f"{rev}:{name}.py"],
+                cwd=root,
+                check=True,
+                capture_output=True,
+            ).stdout
+            with open(os.path.join(tmp, f"{name}.py"), "wb") as f:
+                f.write(source)
+
+        current = {name: sys.modules.pop(name, None) for name in CODEC_MODULES}
+        sys.path.insert(0, tmp)
+        try:
+            return importlib.import_module("protocol")
+        finally:
+            sys.path.remove(tmp)
+            for name, module in current.items():
+                if module is not None:
+                    sys.modules[name] = module
+                else:
+                    sys.modules.pop(name, None)
+
+
+def rate(stmt: str, namespace: dict, number: int) -> float:
+    """
+    Returns executions of `stmt` per second, best of 3 runs.
+    """
+    timer = timeit.Timer(stmt, globals=namespace)
+    return number / min(timer.repeat(number=number, repeat=3))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Packet codec micro-benchmark")
+    parser.add_argument("--number", type=int, default=200000)
+    parser.add_argument(
+        "--reference", default=REFERENCE, help="git revision to compare with"
+    )
+    args = parser.parse_args()
+
+    reference = load_reference(args.reference)
+
+    topic = encode_topic("sensors/42/temperature")
+    packet_id = b"\x00\x2a"
+    payload = b"x" * 64
+    qos_level = QosLevel.AT_LEAST_ONCE
+    reference_qos_level = reference.QosLevel.AT_LEAST_ONCE
+    publish = (
+        serialize_mqtt_publish_header(topic, qos_level, packet_id, len(payload))
+        + payload
+    )
+    puback = MqttPuback(packet_id).serialize()
+    namespace = dict(globals(), **locals())
+
+    cases = [
+        (
+            "decode PUBLISH",
+            "reference.deserialize_mqtt_message(publish)",
+            "deserialize_mqtt_message(publish)",
+        ),
+        (
+            "decode PUBACK",
+            "reference.deserialize_mqtt_message(puback)",
+            "deserialize_mqtt_message(puback)",
+        ),
+        (
+            "encode PUBLISH",
+            "reference.serialize_mqtt_publish_header("
+            "topic, reference_qos_level, packet_id, 64)",
+            "serialize_mqtt_publish_header(topic, qos_level, packet_id, 64)",
+        ),
+        (
+            "encode PUBACK",
+            "reference.MqttPuback(packet_id).serialize()",
+            "MqttPuback.frame(packet_id)",
+        ),
+    ]
+
+    print(f"{'':<16} {'reference':>12} {'current':>12}")
+    for name, reference, current in cases:
+        before = rate(reference, namespace, args.number)
+        after = rate(current, namespace, args.number)
+        print(
+            f"{name:<16} {before:>10.0f}/s {after:>10.0f}/s {after / before:5.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+One message to very many subscribers, with chunked fan-out (fanout.py) on
+and off.
+
+Every subscriber subscribes to one topic, and a publisher sends a QoS 1
+message to it, waiting for every copy to arrive before sending the next.
+Reported are the medians over the messages of how long the publisher waited
+for its PUBACK and how long until the first and the last copy arrived. The
+subscribers all live in this one process, which has to read every copy, so
+the time to last delivery is partly theirs.
+
+    $ python -m benchmarks.fanout --mode threaded --subscribers 50000
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+from benchmarks.client import Client
+from benchmarks.suite import HOST, BrokerProcess
+from fanout import FanOut
+from main import raise_fd_limit
+from protocol import QosLevel
+
+TOPIC = "firmware/notice"
+
+# Subscribers connecting at once
+CONNECT_BATCH = 500
+
+
+class Deliveries:
+    """
+    Counts the copies of the current message as they arrive.
+    """
+
+    def __init__(self, expected: int):
+        self.expected = expected
+        self.received = 0
+        self.first = 0.0
+        self.last = 0.0
+        self.done = None
+
+    def reset(self):
+        self.received = 0
+        self.done = asyncio.get_running_loop().create_future()
+
+    def on_message(self, topic: str, payload: memoryview, qos_level: QosLevel):
+        now = time.perf_counter()
+        if self.received == 0:
+            self.first = now
+        self.received += 1
+        if self.received == self.expected:
+            self.last = now
+            self.done.set_result(None)
+
+
+async def broadcast(port: int, subscribers: int, messages: int, qos: QosLevel):
+    deliveries = Deliveries(subscribers)
+    clients = []
+    for start in range(0, subscribers, CONNECT_BATCH):
+        batch = [
+            Client(deliveries.on_message)
+            for _ in range(min(CONNECT_BATCH, subscribers - start))
+        ]
+        await asyncio.gather(
+            *(
+                client.connect(HOST, port, f"device-{start + i}")
+                for i, client in enumerate(batch)
+            )
+        )
+        await asyncio.gather(*(client.subscribe([(TOPIC, qos)]) for client in batch))
+        clients.extend(batch)
+
+    pub = Client()
+    await pub.connect(HOST, port, "pub")
+    acks, firsts, lasts = [], [], []
+    for i in range(messages):
+        deliveries.reset()
+        start = time.perf_counter()
+        await pub.publish(TOPIC, i.to_bytes(8, "big"), QosLevel.AT_LEAST_ONCE)
+        acks.append(time.perf_counter() - start)
+        await deliveries.done
+        firsts.append(deliveries.first - start)
+        lasts.append(deliveries.last - start)
+
+    await pub.disconnect()
+    for client in clients:
+        client.abort()
+    return statistics.median(acks), statistics.median(firsts), statistics.median(lasts)
+
+
+def run(mode: str, threshold: int, args) -> tuple:
+    broker = BrokerProcess(
+        mode,
+        [
+            "--fanout-threshold",
+            str(threshold),
+            "--fanout-chunk-size",
+            str(args.chunk_size),
+            "--fanout-workers",
+            str(args.workers),
+        ],
+    )
+    try:
+        return asyncio.run(
+            broadcast(
+                broker.port, args.subscribers, args.messages, QosLevel(args.qos)
+            )
+        )
+    finally:
+        broker.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Large fan-out benchmark")
+    parser.add_argument("--mode", choices=["threaded", "asyncio"], default="asyncio")
+    parser.add_argument("--subscribers", type=int, default=50000)
+    parser.add_argument("--messages", type=int, default=3)
+    parser.add_argument("--qos", type=int, choices=[0, 1, 2], default=1)
+    parser.add_argument("--chunk-size", type=int, default=FanOut.CHUNK_SIZE)
+    parser.add_argument("--workers", type=int, default=FanOut.WORKERS)
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    print(f"{'':<10} {'ack ms':>10} {'first ms':>10} {'last ms':>10}")
+    for name, threshold in [("inline", 0), ("chunked", FanOut.THRESHOLD)]:
+        ack, first, last = run(args.mode, threshold, args)
+        print(
+            f"{name:<10} {ack * 1000:>10.1f} {first * 1000:>10.1f}"
+            f" {last * 1000:>10.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+"""
+Cost of logging on the packet path.
+
+PUBLISH packets are handed straight to `Broker.handle_message` and fanned
+out to one subscriber whose connection discards everything, so the numbers
+only cover the broker's own work. Log records go to /dev/null, which is the
+cheapest a real log destination gets.
+
+    $ python -m benchmarks.log_overhead
+"""
+
+import argparse
+import logging
+import os
+import time
+from broker import Broker, Connection
+from encoder import Encoder
+from outbound import OutboundQueue
+from protocol import deserialize_mqtt_message
+
+
+class NullConnection(Connection):
+    def send(self, data, droppable: bool = False):
+        pass
+
+    def close(self):
+        pass
+
+    def abort(self):
+        pass
+
+    def pause_reading(self, delay: float):
+        pass
+
+
+def frame(first_byte: int, body: bytes) -> bytes:
+    encoder = Encoder()
+    encoder.append_byte(first_byte)
+    encoder.append_varint(len(body))
+    encoder.append_bytes(body)
+    return encoder.bytes()
+
+
+def string(s: str) -> bytes:
+    data = s.encode("utf-8")
+    return len(data).to_bytes(2, "big") + data
+
+
+def handle(broker: Broker, conn: Connection, data: bytes):
+    request, _ = deserialize_mqtt_message(data)
+    broker.handle_message(conn, request, data)
+
+
+def connect(broker: Broker, client_id: str) -> Connection:
+    conn = NullConnection(broker.next_conn_id(), OutboundQueue())
+    handle(
+        broker,
+        conn,
+        frame(0x10, string("MQTT") + b"\x04\x02\x00\x3c" + string(client_id)),
+    )
+    return conn
+
+
+def run(messages: int, trace: bool, trace_sample: int) -> float:
+    """
+    Returns the PUBLISHes handled per second.
+    """
+    logging.getLogger("broker.packets").setLevel(
+        logging.DEBUG if trace else logging.WARNING
+    )
+    broker = Broker(trace_sample=trace_sample)
+    publisher = connect(broker, "pub")
+    subscriber = connect(broker, "sub")
+    handle(broker, subscriber, frame(0x82, b"\x00\x01" + string("bench/+") + b"\x00"))
+
+    data = frame(0x30, string("bench/topic") + b"x" * 64)
+    start = time.perf_counter()
+    for _ in range(messages):
+        request, _ = deserialize_mqtt_message(data)
+        broker.handle_message(publisher, request, data)
+    return messages / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cost of logging on the packet path")
+    parser.add_argument("--messages", type=int, default=100000)
+    args = parser.parse_args()
+
+    logging.basicConfig(stream=open(os.devnull, "w"), level=logging.INFO)
+
+    runs = [
+        ("trace every packet", True, 1),
+        ("trace 1 in 100", True, 100),
+        ("trace off (default)", False, 1),
+    ]
+    baseline = None
+    for name, trace, sample in runs:
+        rate = run(args.messages, trace, sample)
+        if baseline is None:
+            baseline = rate
+        print(f"{name:<22} {rate:>10.0f} msgs/s  {rate / baseline:5.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+"""
+Topic matching with and without the match cache.
+
+Subscribers hold wildcard filters over a tree of device topics; publishes
+pick from a fixed set of hot topics, with a few subscription changes mixed
+in to show the cost of invalidation.
+
+    $ python -m benchmarks.match_cache
+"""
+
+import argparse
+import random
+import time
+from protocol import QosLevel
+from topics import TopicTrie
+
+
+def build(cache_size: int, filters: int) -> TopicTrie:
+    trie = TopicTrie(cache_size)
+    rand = random.Random(1)
+    for i in range(filters):
+        site, device = rand.randrange(100), rand.randrange(1000)
+        match i % 3:
+            case 0:
+                topic_filter = f"site/{site}/device/{device}/#"
+            case 1:
+                topic_filter = f"site/{site}/+/{device}/telemetry"
+            case _:
+                topic_filter = f"site/+/device/{device}/status"
+        trie.subscribe(f"client-{i}", topic_filter, QosLevel.AT_MOST_ONCE)
+    return trie
+
+
+def run(trie: TopicTrie, topics, publishes: int, churn: int) -> float:
+    # Steady state: every hot topic has been published to before
+    for topic in topics:
+        trie.match(topic)
+
+    rand = random.Random(2)
+    start = time.perf_counter()
+    for i in range(publishes):
+        trie.match(topics[rand.randrange(len(topics))])
+        if churn > 0 and i % churn == 0:
+            device = rand.randrange(1000)
+            trie.subscribe("churn", f"site/1/device/{device}/#", QosLevel.AT_MOST_ONCE)
+            trie.unsubscribe("churn", f"site/1/device/{device}/#")
+    return publishes / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Topic match cache benchmark")
+    parser.add_argument("--filters", type=int, default=100_000)
+    parser.add_argument("--topics", type=int, default=100_000)
+    parser.add_argument("--publishes", type=int, default=500_000)
+    parser.add_argument(
+        "--churn",
+        type=int,
+        default=1000,
+        help="publishes per subscription change; 0 for none",
+    )
+    args = parser.parse_args()
+
+    rand = random.Random(3)
+    kinds = ["telemetry", "status"]
+    topics = [
+        f"site/{rand.randrange(100)}/device/{rand.randrange(1000)}/{kinds[i % 2]}"
+        for i in range(args.topics)
+    ]
+
+    uncached = run(build(0, args.filters), topics, args.publishes, args.churn)
+    trie = build(args.topics, args.filters)
+    cached = run(trie, topics, args.publishes, args.churn)
+
+    print(f"uncached {uncached:>10.0f} matches/s")
+    print(f"cached   {cached:>10.0f} matches/s {cached / uncached:5.1f}x")
+    print(trie.cache.stats())
+
+
+if __name__ == "__main__":
+    main()
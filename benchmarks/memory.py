@@ -0,0 +1,119 @@
+"""
+Broker memory per idle connection and per queued message.
+
+Both are measured as the growth of the broker process' resident memory, so
+they include everything a connection or message costs: Python objects,
+buffers, and in the threaded mode the touched part of each thread's stack.
+
+- idle connections: clients that connected, subscribed to one topic and
+  went quiet;
+- queued messages: QoS 1 messages waiting for persistent subscribers that
+  are offline, with small payloads so the bookkeeping shows rather than the
+  payload itself.
+
+    $ python -m benchmarks.memory --mode asyncio
+"""
+
+import argparse
+import asyncio
+import time
+from benchmarks.client import Client
+from benchmarks.suite import HOST, BrokerProcess
+from main import raise_fd_limit
+from protocol import QosLevel
+
+# Bytes of each queued message's payload
+PAYLOAD_SIZE = 16
+
+
+async def idle_connections(port: int, count: int) -> list:
+    clients = []
+    for i in range(count):
+        client = Client()
+        await client.connect(HOST, port, f"device-{i}")
+        await client.subscribe([(f"devices/{i}/commands", QosLevel.AT_LEAST_ONCE)])
+        clients.append(client)
+    return clients
+
+
+async def queue_messages(port: int, subscribers: int, messages: int):
+    for i in range(subscribers):
+        client = Client()
+        await client.connect(HOST, port, f"offline-{i}", clean=False)
+        await client.subscribe([("queued/#", QosLevel.AT_LEAST_ONCE)])
+        await client.disconnect()
+    # Let the broker notice the disconnects
+    await asyncio.sleep(0.5)
+
+    pub = Client()
+    await pub.connect(HOST, port, "pub")
+    window = []
+    for i in range(messages):
+        payload = i.to_bytes(PAYLOAD_SIZE, "big")
+        window.append(pub.publish(f"queued/{i % 100}", payload, QosLevel.AT_LEAST_ONCE))
+        if len(window) >= 100:
+            await asyncio.gather(*window)
+            window = []
+    await asyncio.gather(*window)
+    await pub.disconnect()
+
+
+def settle(broker: BrokerProcess) -> float:
+    """
+    Returns the broker's resident memory in bytes once it stopped changing.
+    """
+    rss = broker.memory()["rss_mb"]
+    while True:
+        time.sleep(0.5)
+        now = broker.memory()["rss_mb"]
+        if now == rss:
+            return rss * 1024 * 1024
+        rss = now
+
+
+def per_connection(mode: str, count: int) -> float:
+    broker = BrokerProcess(mode, [])
+    try:
+        loop = asyncio.new_event_loop()
+        before = settle(broker)
+        clients = loop.run_until_complete(idle_connections(broker.port, count))
+        after = settle(broker)
+        for client in clients:
+            loop.run_until_complete(client.close())
+        loop.close()
+        return (after - before) / count
+    finally:
+        broker.stop()
+
+
+def per_message(mode: str, subscribers: int, messages: int) -> float:
+    # Big enough offline budgets that nothing goes to disk
+    broker = BrokerProcess(
+        mode, ["--offline-memory", str(1 << 40), "--offline-total-memory", str(1 << 40)]
+    )
+    try:
+        before = settle(broker)
+        asyncio.run(queue_messages(broker.port, subscribers, messages))
+        after = settle(broker)
+        return (after - before) / (subscribers * messages)
+    finally:
+        broker.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Broker memory benchmark")
+    parser.add_argument("--mode", choices=["threaded", "asyncio"], default="asyncio")
+    parser.add_argument("--connections", type=int, default=5000)
+    parser.add_argument("--subscribers", type=int, default=10)
+    parser.add_argument("--messages", type=int, default=20000)
+    args = parser.parse_args()
+
+    raise_fd_limit()
+    connection = per_connection(args.mode, args.connections)
+    print(f"bytes per idle connection: {connection:>10.0f}")
+    message = per_message(args.mode, args.subscribers, args.messages)
+    print(f"bytes per queued message:  {message:>10.0f}")
+
+
+if __name__ == "__main__":
+    main()
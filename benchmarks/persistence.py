@@ -0,0 +1,72 @@
+"""
+Throughput of QoS 1 messages to persistent sessions, with the write-ahead
+log off and on.
+
+Subscribers connect with clean session 0, so with `--data-dir` every
+message they are sent and every ack they return is appended to the log.
+The same load runs against a broker without a store and one with; the
+ratio of their throughputs should stay at 0.5 or above, and the exit
+status is 1 if it doesn't.
+
+    $ python -m benchmarks.persistence --mode asyncio
+"""
+
+import argparse
+import asyncio
+import sys
+import tempfile
+from benchmarks.suite import BrokerProcess, flow
+from protocol import QosLevel
+
+# Lowest acceptable throughput with the log, as a fraction of without
+MIN_RATIO = 0.5
+
+
+def run(mode: str, extra_args, subscribers: int, messages: int) -> float:
+    # Subscribers fall behind the publisher; queue rather than drop
+    broker = BrokerProcess(mode, ["--max-queued", str(messages)] + extra_args)
+    try:
+        result = asyncio.run(
+            flow(
+                broker.port,
+                1,
+                subscribers,
+                messages,
+                QosLevel.AT_LEAST_ONCE,
+                clean=False,
+            )
+        )
+    finally:
+        broker.stop()
+    if result["messages"] < result["expected"]:
+        print(f"only {result['messages']} of {result['expected']} delivered")
+    return result["msgs_per_s"]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Write-ahead log overhead")
+    parser.add_argument("--mode", choices=["threaded", "asyncio"], default="asyncio")
+    parser.add_argument("--subscribers", type=int, default=10)
+    parser.add_argument("--messages", type=int, default=10000)
+    parser.add_argument("--commit-interval", type=float, default=0.01)
+    args = parser.parse_args()
+
+    memory = run(args.mode, [], args.subscribers, args.messages)
+    with tempfile.TemporaryDirectory() as data_dir:
+        persistent = run(
+            args.mode,
+            ["--data-dir", data_dir, "--commit-interval", str(args.commit_interval)],
+            args.subscribers,
+            args.messages,
+        )
+
+    ratio = persistent / memory
+    print(f"{'in memory':<12} {memory:>10.0f} msgs/s")
+    print(f"{'write-ahead':<12} {persistent:>10.0f} msgs/s")
+    print(f"{'ratio':<12} {ratio:>10.2f}")
+    if ratio < MIN_RATIO:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,517 @@
+"""
+Benchmark suite: scenarios run against a broker in its own process.
+
+Every scenario starts a fresh broker (`main.py`, with the mode and flags
+given here) and drives it with `benchmarks.client.Client`s from this
+process. It reports messages (or connections) per second, end-to-end
+latency percentiles and the broker's resident memory. Latency is measured
+from a timestamp the publisher puts at the start of every payload to the
+moment a subscriber reads the message, on the system-wide monotonic clock.
+
+Results are printed and written as JSON; given a baseline (an earlier
+result file), regressions beyond a tolerance are listed and make the run
+exit with status 1.
+
+    $ python -m benchmarks.suite --mode asyncio --output results.json
+    $ python -m benchmarks.suite --mode asyncio --baseline results.json
+
+Load generator and broker share the machine, so absolute numbers depend on
+it; compare runs made on the same host.
+"""
+
+import argparse
+import asyncio
+from collections import Counter
+import itertools
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+import time
+from typing import Dict, List, Optional
+from benchmarks.client import Client
+from main import raise_fd_limit
+from protocol import QosLevel
+from topics import TopicTrie
+
+HOST = "127.0.0.1"
+
+# Seconds without a delivery after which a scenario stops waiting for the
+# rest; QoS 0 messages may be dropped under load
+IDLE_TIMEOUT = 5
+
+
+class BrokerProcess:
+    def __init__(self, mode: str, extra_args: List[str]):
+        with socket.socket() as sock:
+            sock.bind((HOST, 0))
+            self.port = sock.getsockname()[1]
+
+        self.process = subprocess.Popen(
+            [
+                sys.executable,
+                "main.py",
+                "--mode",
+                mode,
+                "--host",
+                HOST,
+                "--port",
+                str(self.port),
+                "--log-level",
+                "ERROR",
+                *extra_args,
+            ],
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        )
+
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                socket.create_connection((HOST, self.port)).close()
+                return
+            except OSError:
+                if time.monotonic() > deadline:
+                    self.stop()
+                    raise RuntimeError("broker didn't start")
+                time.sleep(0.05)
+
+    def memory(self) -> Dict[str, float]:
+        """
+        Returns the current and peak resident memory in MB, summed over the
+        broker and its worker processes (`--workers`).
+        """
+        pid = self.process.pid
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            pids = [pid] + [int(child) for child in f.read().split()]
+
+        res = {"VmRSS": 0.0, "VmHWM": 0.0}
+        for pid in pids:
+            with open(f"/proc/{pid}/status") as f:
+                for line in f:
+                    key, _, value = line.partition(":")
+                    if key in res:
+                        res[key] += int(value.split()[0]) / 1024
+        return {"rss_mb": res["VmRSS"], "peak_rss_mb": res["VmHWM"]}
+
+    def stop(self):
+        self.process.terminate()
+        self.process.wait()
+
+
+class Recorder:
+    """
+    Collects the latency of every message received by the subscribers.
+    """
+
+    def __init__(self):
+        self.latencies: List[int] = []
+        self.last = time.monotonic()
+
+    def on_message(self, topic: str, payload: memoryview, qos_level: QosLevel):
+        now = time.monotonic_ns()
+        self.latencies.append(now - int.from_bytes(payload[:8], "big"))
+        self.last = time.monotonic()
+
+    async def wait(self, expected: int):
+        start = time.monotonic()
+        while len(self.latencies) < expected:
+            if time.monotonic() - max(self.last, start) > IDLE_TIMEOUT:
+                return
+            await asyncio.sleep(0.01)
+
+
+def stamped(size: int) -> bytes:
+    """
+    Returns a payload of `size` bytes starting with the current time.
+    """
+    return time.monotonic_ns().to_bytes(8, "big") + bytes(max(size - 8, 0))
+
+
+def percentiles(samples_ns: List[int]) -> Dict[str, float]:
+    if len(samples_ns) == 0:
+        return {}
+    samples = sorted(samples_ns)
+
+    def at(p):
+        return samples[min(int(len(samples) * p), len(samples) - 1)] / 1e6
+
+    return {"p50": at(0.5), "p99": at(0.99), "p999": at(0.999)}
+
+
+async def connect(
+    count: int,
+    prefix: str,
+    recorder: Optional[Recorder],
+    port: int,
+    clean: bool = True,
+):
+    clients = []
+    for i in range(count):
+        client = Client(recorder.on_message if recorder is not None else None)
+        await client.connect(HOST, port, f"{prefix}-{i}", clean)
+        clients.append(client)
+    return clients
+
+
+async def publish(
+    client: Client, topics: List[str], qos_level: QosLevel, size: int, window: int = 100
+):
+    """
+    Publishes a message to each of `topics`, keeping at most `window` unacked.
+    """
+    inflight = set()
+    for i, topic in enumerate(topics):
+        done = client.publish(topic, stamped(size), qos_level)
+        if qos_level == QosLevel.AT_MOST_ONCE:
+            if i % window == window - 1:
+                await client.drain()
+            continue
+        inflight.add(done)
+        done.add_done_callback(inflight.discard)
+        if len(inflight) >= window:
+            await asyncio.wait(list(inflight), return_when=asyncio.FIRST_COMPLETED)
+    await client.drain()
+    if len(inflight) > 0:
+        await asyncio.wait(list(inflight))
+
+
+async def flow(
+    port: int,
+    publishers: int,
+    subscribers: int,
+    messages: int,
+    qos_level: QosLevel = QosLevel.AT_MOST_ONCE,
+    size: int = 64,
+    filters: Optional[List[List[str]]] = None,
+    topics: Optional[List[str]] = None,
+    clean: bool = True,
+) -> dict:
+    """
+    `publishers` clients publish `messages` messages between them to topics
+    picked from `topics`; the `subscribers` clients subscribe with their
+    entry in `filters`, with persistent sessions unless `clean`. Everything
+    goes to "bench" by default.
+    """
+    filters = filters if filters is not None else [["bench"]] * subscribers
+    topics = topics if topics is not None else ["bench"]
+
+    rand = random.Random(1)
+    sequences = [
+        [topics[rand.randrange(len(topics))] for _ in range(messages // publishers)]
+        for _ in range(publishers)
+    ]
+
+    # Count the deliveries to wait for with the broker's own matching
+    trie = TopicTrie()
+    for i, sub_filters in enumerate(filters):
+        for topic_filter in sub_filters:
+            trie.subscribe(f"sub-{i}", topic_filter, qos_level)
+    deliveries = sum(
+        len(trie.match(topic)) * count
+        for topic, count in Counter(itertools.chain(*sequences)).items()
+    )
+
+    recorder = Recorder()
+    subs = await connect(subscribers, "sub", recorder, port, clean)
+    for sub, sub_filters in zip(subs, filters):
+        for i in range(0, len(sub_filters), 100):
+            await sub.subscribe([(f, qos_level) for f in sub_filters[i : i + 100]])
+    pubs = await connect(publishers, "pub", None, port)
+
+    start = time.monotonic()
+    await asyncio.gather(
+        *(publish(pub, seq, qos_level, size) for pub, seq in zip(pubs, sequences))
+    )
+    await recorder.wait(deliveries)
+    received = len(recorder.latencies)
+    elapsed = (recorder.last if received > 0 else time.monotonic()) - start
+
+    for client in subs + pubs:
+        await client.disconnect()
+
+    return {
+        "messages": received,
+        "expected": deliveries,
+        "msgs_per_s": received / elapsed,
+        "latency_ms": percentiles(recorder.latencies),
+    }
+
+
+async def connect_storm(port: int, scale: float) -> dict:
+    count = int(2000 * scale)
+    concurrency = 200
+    latencies = []
+    clients = []
+
+    async def one(i):
+        client = Client()
+        start = time.monotonic_ns()
+        await client.connect(HOST, port, f"storm-{i}")
+        latencies.append(time.monotonic_ns() - start)
+        clients.append(client)
+
+    start = time.monotonic()
+    for i in range(0, count, concurrency):
+        await asyncio.gather(*(one(j) for j in range(i, min(i + concurrency, count))))
+    elapsed = time.monotonic() - start
+
+    for client in clients:
+        await client.close()
+    return {
+        "messages": count,
+        "msgs_per_s": count / elapsed,
+        "latency_ms": percentiles(latencies),
+    }
+
+
+async def reconnect_storm(port: int, scale: float) -> dict:
+    """
+    Persistent clients that lost their connections all at once, after a
+    network blip, and reconnect together. Refused ones retry with jittered
+    exponential backoff, as devices do. Latency is per client, from its
+    first attempt to its CONNACK.
+    """
+    count = int(20000 * scale)
+    concurrency = 200
+    rand = random.Random(1)
+    clients = []
+    latencies = []
+    retries = 0
+
+    async def one(i):
+        nonlocal retries
+        backoff = 0.05
+        start = time.monotonic_ns()
+        while True:
+            client = Client()
+            try:
+                await client.connect(HOST, port, f"device-{i}", clean=False)
+                break
+            except OSError:
+                retries += 1
+                await client.close()
+                await asyncio.sleep(backoff * rand.random())
+                backoff = min(backoff * 2, 2)
+        latencies.append(time.monotonic_ns() - start)
+        clients.append(client)
+
+    for i in range(0, count, concurrency):
+        await asyncio.gather(*(one(j) for j in range(i, min(i + concurrency, count))))
+
+    # The blip
+    for client in clients:
+        client.abort()
+    clients = []
+    latencies = []
+    retries = 0
+
+    start = time.monotonic()
+    await asyncio.gather(*(one(i) for i in range(count)))
+    elapsed = time.monotonic() - start
+
+    for client in clients:
+        await client.close()
+    return {
+        "messages": count,
+        "msgs_per_s": count / elapsed,
+        "latency_ms": percentiles(latencies),
+        "retries": retries,
+    }
+
+
+def parallel(port: int, scale: float) -> dict:
+    """
+    Many independent streams: 100 publishers and 100 subscribers, each
+    subscriber on a topic of its own. With `--workers`, most publishers and
+    their subscribers end up on different workers.
+    """
+    topics = [f"bench/{i}" for i in range(100)]
+    return flow(
+        port,
+        100,
+        100,
+        int(20000 * scale),
+        filters=[[topic] for topic in topics],
+        topics=topics,
+    )
+
+
+def wildcard_filters(count: int) -> List[str]:
+    rand = random.Random(1)
+    res = []
+    for i in range(count):
+        site, device = rand.randrange(50), rand.randrange(200)
+        match i % 3:
+            case 0:
+                res.append(f"site/{site}/device/{device}/#")
+            case 1:
+                res.append(f"site/{site}/+/{device}/telemetry")
+            case _:
+                res.append(f"site/+/device/{device}/status")
+    return res
+
+
+SCENARIOS = {
+    "connect_storm": connect_storm,
+    "reconnect_storm": reconnect_storm,
+    "publish_qos0": lambda port, scale: flow(port, 1, 1, int(20000 * scale)),
+    "publish_qos1": lambda port, scale: flow(
+        port, 1, 1, int(10000 * scale), QosLevel.AT_LEAST_ONCE
+    ),
+    "publish_qos2": lambda port, scale: flow(
+        port, 1, 1, int(5000 * scale), QosLevel.EXACTLY_ONCE
+    ),
+    "fan_out": lambda port, scale: flow(port, 1, 100, int(1000 * scale)),
+    "fan_in": lambda port, scale: flow(port, 100, 1, int(20000 * scale)),
+    # 100 subscribers with 100 wildcard filters each
+    "wildcards": lambda port, scale: flow(
+        port,
+        1,
+        100,
+        int(10000 * scale),
+        filters=[
+            wildcard_filters(10000)[i : i + 100] for i in range(0, 10000, 100)
+        ],
+        topics=[
+            f"site/{site}/device/{device}/{kind}"
+            for site in range(50)
+            for device in range(0, 200, 10)
+            for kind in ("telemetry", "status")
+        ],
+    ),
+    "large_payload": lambda port, scale: flow(
+        port, 1, 1, int(200 * scale), QosLevel.AT_LEAST_ONCE, size=1024 * 1024
+    ),
+    "parallel": parallel,
+    # The same load on WORKERS processes; compare with "parallel"
+    "parallel_workers": parallel,
+}
+
+# Worker processes of the parallel_workers scenario
+WORKERS = 4
+
+
+# Broker arguments scenarios need on top of the ones given
+SCENARIO_ARGS = {
+    # 1MB payloads don't fit the default packet size limit
+    "large_payload": ["--max-packet-size", str(2 * 1024 * 1024)],
+    "parallel_workers": ["--workers", str(WORKERS)],
+}
+
+# Scenarios only the asyncio mode can run; skipped in the threaded mode
+ASYNCIO_ONLY = {"parallel_workers"}
+
+
+def run(name: str, mode: str, extra_args: List[str], scale: float) -> dict:
+    broker = BrokerProcess(mode, SCENARIO_ARGS.get(name, []) + extra_args)
+    try:
+        before = broker.memory()
+        result = asyncio.run(SCENARIOS[name](broker.port, scale))
+        result.update(broker.memory())
+        result["idle_rss_mb"] = before["rss_mb"]
+        return result
+    finally:
+        broker.stop()
+
+
+def regressions(results: dict, baseline: dict, tolerance: float) -> List[str]:
+    """
+    Returns what got worse than in `baseline` by more than `tolerance`
+    (a fraction).
+    """
+    res = []
+    for name, result in results["scenarios"].items():
+        before = baseline["scenarios"].get(name)
+        if before is None:
+            continue
+
+        # (description, before, after, whether higher is better)
+        metrics = [("msgs/s", before["msgs_per_s"], result["msgs_per_s"], True)]
+        for p in ("p50", "p99", "p999"):
+            if p in before["latency_ms"] and p in result["latency_ms"]:
+                metrics.append(
+                    (f"{p} ms", before["latency_ms"][p], result["latency_ms"][p], False)
+                )
+        metrics.append(
+            ("peak RSS MB", before["peak_rss_mb"], result["peak_rss_mb"], False)
+        )
+
+        for metric, old, new, higher_is_better in metrics:
+            change = (new - old) / old if old > 0 else 0
+            if (change < -tolerance) if higher_is_better else (change > tolerance):
+                res.append(f"{name} {metric}: {old:.2f} -> {new:.2f} ({change:+.0%})")
+    return res
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Broker benchmark suite")
+    parser.add_argument("--mode", choices=["threaded", "asyncio"], default="asyncio")
+    parser.add_argument(
+        "--scenario",
+        action="append",
+        choices=list(SCENARIOS),
+        help="scenario to run; repeatable, all by default",
+    )
+    parser.add_argument(
+        "--scale", type=float, default=1.0, help="multiplies every message count"
+    )
+    parser.add_argument("--output", default=None, help="JSON file to write")
+    parser.add_argument("--baseline", default=None, help="JSON file to compare with")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.1,
+        help="change relative to the baseline reported as a regression",
+    )
+    parser.add_argument(
+        "broker_args", nargs="*", help="passed on to main.py, after --"
+    )
+    args = parser.parse_args()
+
+    raise_fd_limit()
+
+    results = {
+        "mode": args.mode,
+        "broker_args": args.broker_args,
+        "scale": args.scale,
+        "python": platform.python_version(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "scenarios": {},
+    }
+
+    print(
+        f"{'':<16} {'msgs/s':>10} {'p50 ms':>8} {'p99 ms':>8} {'p999 ms':>8} "
+        f"{'peak RSS MB':>12}"
+    )
+    for name in args.scenario or list(SCENARIOS):
+        if args.mode != "asyncio" and name in ASYNCIO_ONLY:
+            print(f"{name:<16} asyncio mode only, skipped")
+            continue
+        result = run(name, args.mode, args.broker_args, args.scale)
+        results["scenarios"][name] = result
+        latency = result["latency_ms"]
+        print(
+            f"{name:<16} {result['msgs_per_s']:>10.0f} {latency.get('p50', 0):>8.2f} "
+            f"{latency.get('p99', 0):>8.2f} {latency.get('p999', 0):>8.2f} "
+            f"{result['peak_rss_mb']:>12.1f}"
+        )
+
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        found = regressions(results, baseline, args.tolerance)
+        for regression in found:
+            print("regression:", regression)
+        if len(found) > 0:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1343 @@
+"""
+Broker core shared by every server mode.
+
+The server modes (`main.Server` with one thread per client, `aio.AsyncServer`
+with one event loop) only move bytes around. They wrap each client in a
+`Connection` and hand every decoded packet to `Broker.handle_message`, so the
+MQTT flows are implemented exactly once.
+
+In the threaded mode, packets of different clients are handled concurrently,
+next to the timer and writer threads. Shared state is made safe without a
+lock on the publish path:
+
+- the subscription trie and shared subscription groups are changed under a
+  lock but read without one (see `TopicTrie`, `ShareGroup.members`);
+- `clients` and `sessions` are changed under one of `CLIENT_LOCKS` locks,
+  picked by client id, so connects and disconnects of different clients
+  rarely contend; lookups are single dict operations, atomic on their own;
+- every session's inflight window has a lock of its own.
+"""
+
+from abc import ABC, abstractmethod
+from typing import Dict, Iterable, Tuple, Optional
+from protocol import (
+    MqttConnack,
+    MqttConnect,
+    MqttPublish,
+    MqttPuback,
+    MqttPubrec,
+    MqttPubrel,
+    MqttPubcomp,
+    MqttSubscribe,
+    MqttSuback,
+    MqttUnsubscribe,
+    MqttUnsuback,
+    MqttPingreq,
+    MqttPingresp,
+    MqttDisconnect,
+    QosLevel,
+    encode_topic,
+    serialize_mqtt_publish_header,
+    set_dup_flag,
+)
+from topics import MatchCache, TopicTrie, is_valid_filter, is_valid_topic, split_shared
+from shared import ShareGroup, ShareStrategy
+from outbound import OutboundQueue, OverflowPolicy
+from inflight import InflightMessage, InflightState, InflightWindow
+from offline import OfflineBudget, OfflineQueue
+from admission import Admission
+from fanout import FanOut
+from framer import Framer
+from ratelimit import RateLimit, Throttle
+from timerwheel import TimerWheel
+from retained import RetainedStore
+from persistence import RecordType, StoredState, WriteAheadLog
+from metrics import Metrics, sys_topics
+import functools
+import itertools
+import logging
+import sys
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+# Per-packet traces. Off unless this logger is enabled for DEBUG, and then
+# only for one packet in `Broker.trace_sample`.
+packet_logger = logging.getLogger(__name__ + ".packets")
+
+
+class Connection(ABC):
+    """
+    A client connection as seen by the broker.
+
+    Server modes subclass this and implement `send`, `close`, `abort` and
+    `pause_reading` on top of their transport (a blocking socket, an asyncio
+    transport, ...).
+    """
+
+    __slots__ = (
+        "conn_id",
+        "client_id",
+        "queue",
+        "session",
+        "half_open",
+        "connect_timer",
+        "rate_limit",
+        "throttled",
+        "keep_alive",
+        "last_seen",
+        "keep_alive_timer",
+    )
+
+    def __init__(self, conn_id: int, queue: OutboundQueue):
+        self.conn_id = conn_id
+        self.client_id: Optional[str] = None
+        self.queue = queue
+
+        # Set on CONNECT
+        self.session: Optional[Session] = None
+
+        # Admitted and waiting for its CONNECT, which is due before
+        # `connect_timer` fires
+        self.half_open = False
+        self.connect_timer = None
+
+        # Publish limits of the client, set on CONNECT, and how many of its
+        # messages went over them
+        self.rate_limit: Optional[RateLimit] = None
+        self.throttled = 0
+
+        # Keep-alive: seconds the client may stay silent, and when it last
+        # sent something (on the broker's timer clock)
+        self.keep_alive = 0
+        self.last_seen = 0.0
+        self.keep_alive_timer = None
+
+    @abstractmethod
+    def send(self, data, droppable: bool = False):
+        """
+        Queues `data` for this connection's writer and returns without
+        waiting for it to be written. `data` is either one buffer or a tuple
+        of buffers making up one frame, which is written with scatter-gather
+        I/O. `droppable` marks QoS 0 PUBLISHes the overflow policy is allowed
+        to discard.
+        """
+
+    @abstractmethod
+    def close(self):
+        """
+        Closes the connection once the frames queued so far are written.
+        """
+
+    @abstractmethod
+    def abort(self):
+        """
+        Closes the connection right away, dropping queued frames. For clients
+        that stopped responding.
+        """
+
+    @abstractmethod
+    def pause_reading(self, delay: float):
+        """
+        Stops reading from the client for `delay` seconds, or until `delay`
+        seconds from now if already paused. Packets received already are
+        still handled.
+        """
+
+
+class Session:
+    """
+    Per-client protocol state. A clean session is dropped with its
+    connection, so a departed client leaves nothing behind. A persistent one
+    (clean_session=0) is kept, in the store too if there is one, until the
+    client comes back.
+    """
+
+    __slots__ = (
+        "client_id",
+        "persistent",
+        "seq",
+        "inflight",
+        "releasable",
+        "groups",
+        "offline",
+    )
+
+    def __init__(
+        self,
+        client_id: str,
+        max_inflight: int,
+        persistent: bool = False,
+        offline: Optional[OfflineQueue] = None,
+        max_queued: int = InflightWindow.MAX_QUEUED,
+    ):
+        self.client_id = client_id
+        self.persistent = persistent
+
+        # Numbers the messages of a persistent session in the store
+        self.seq = itertools.count(1)
+
+        # QoS 1/2 messages sent to the client, awaiting acks
+        self.inflight = InflightWindow(max_inflight, max_queued)
+
+        # QoS 2 messages received from the client, awaiting PUBREL. Maps
+        # packet id to (topic, payload, retain).
+        self.releasable: Dict[bytes, Tuple[str, bytes, bool]] = {}
+
+        # Shared subscription groups the client is a member of, by their
+        # "$share/..." filter
+        self.groups: Dict[str, ShareGroup] = {}
+
+        # QoS 1/2 messages that arrived while the client was offline, for
+        # persistent sessions
+        self.offline = offline
+
+
+class Broker:
+    # Seconds until an unacked message is first retransmitted; the delay
+    # doubles with every attempt, up to MAX_RETRY_INTERVAL
+    RETRY_INTERVAL = 2
+    MAX_RETRY_INTERVAL = 60
+
+    # Retransmissions of one message before the client is considered dead
+    MAX_RETRIES = 5
+
+    # A client is disconnected after 1.5 times its keep-alive without a
+    # packet, MQTT 3.1.1 section 3.1.2.10
+    KEEP_ALIVE_GRACE = 1.5
+
+    # Seconds between updates of the $SYS topics
+    SYS_INTERVAL = 10
+
+    # Locks `clients` and `sessions` are striped over
+    CLIENT_LOCKS = 64
+
+    def __init__(
+        self,
+        max_queue_depth: int = OutboundQueue.MAX_DEPTH,
+        overflow_policy: OverflowPolicy = OverflowPolicy.DROP_QOS0,
+        spill_dir: Optional[str] = None,
+        coalesce_bytes: int = OutboundQueue.COALESCE_BYTES,
+        coalesce_delay: float = 0.0,
+        max_inflight: int = InflightWindow.MAX_INFLIGHT,
+        max_queued: int = InflightWindow.MAX_QUEUED,
+        retry_interval: float = RETRY_INTERVAL,
+        max_retries: int = MAX_RETRIES,
+        retained_memory: int = RetainedStore.MAX_MEMORY,
+        store: Optional[WriteAheadLog] = None,
+        trace_sample: int = 1,
+        share_strategy: ShareStrategy = ShareStrategy.ROUND_ROBIN,
+        match_cache_size: int = MatchCache.MAX_SIZE,
+        sys_interval: float = SYS_INTERVAL,
+        offline_memory: int = OfflineQueue.MAX_MEMORY,
+        offline_total_memory: int = OfflineBudget.MAX_MEMORY,
+        offline_spill: int = OfflineQueue.MAX_SPILL,
+        admission: Optional[Admission] = None,
+        throttle: Optional[Throttle] = None,
+        max_packet_size: int = Framer.MAX_PACKET_SIZE,
+        fanout: Optional[FanOut] = None,
+    ):
+        # settings of the per-connection outbound queues
+        self.max_queue_depth = max_queue_depth
+        self.overflow_policy = overflow_policy
+        self.spill_dir = spill_dir
+
+        # Frames for a client are gathered and written together, up to
+        # `coalesce_bytes` per write (0: every frame on its own). A batch
+        # below that may wait `coalesce_delay` seconds for more frames.
+        self.coalesce_bytes = coalesce_bytes
+        self.coalesce_delay = coalesce_delay
+
+        # unacked QoS 1/2 messages per client, and those waiting behind
+        # them before the oldest is dropped
+        self.max_inflight = max_inflight
+        self.max_queued = max_queued
+
+        # Memory for the messages of offline clients, per session and in
+        # total; the rest goes to disk, in `spill_dir`, up to `offline_spill`
+        # bytes per session
+        self.offline_memory = offline_memory
+        self.offline_budget = OfflineBudget(offline_total_memory)
+        self.offline_spill = offline_spill
+
+        self.retry_interval = retry_interval
+        self.max_retries = max_retries
+
+        # Retransmissions and keep-alive checks. Server modes call
+        # `timers.advance()` every `TimerWheel.TICK` seconds.
+        self.timers = TimerWheel()
+
+        # maps topic filters to client ids. A shared subscription group is
+        # one subscriber, under the ShareGroup itself rather than a client id.
+        self.subscriptions = TopicTrie(match_cache_size)
+
+        # maps "$share/<group>/<filter>" to its group, and how groups pick
+        # the member a message goes to
+        self.share_groups: Dict[str, ShareGroup] = {}
+        self.share_strategy = share_strategy
+
+        # guards `share_groups` and the groups of every session
+        self.groups_lock = threading.Lock()
+
+        # maps client id to connection
+        self.clients: Dict[str, Connection] = {}
+
+        # Limits on connections coming in, see admission.py
+        self.admission = admission if admission is not None else Admission()
+
+        # Limits on publishers, see ratelimit.py, and on packets. Server
+        # modes give their framers `max_packet_size`.
+        self.throttle = throttle if throttle is not None else Throttle()
+        self.max_packet_size = max_packet_size
+
+        # Hands out messages with many subscribers in chunks; server modes
+        # start it
+        self.fanout = fanout if fanout is not None else FanOut()
+
+        # maps client id to session
+        self.sessions: Dict[str, Session] = {}
+
+        # guard the entries of `clients` and `sessions`, see `client_lock`
+        self.client_locks = [threading.Lock() for _ in range(self.CLIENT_LOCKS)]
+
+        # last message published with RETAIN on each topic
+        self.retained = RetainedStore(retained_memory)
+
+        # Forwards messages to other brokers, see routing.py
+        self.router = None
+
+        # Connection ids, for logging
+        self.conn_ids = itertools.count()
+
+        # Counters of what the broker did, published on $SYS topics every
+        # `sys_interval` seconds (0: never)
+        self.metrics = Metrics()
+        self.sys_interval = sys_interval
+        if sys_interval > 0:
+            self.timers.schedule(sys_interval, self.publish_sys)
+
+        # Packets seen by `tracing()`
+        self.trace_sample = trace_sample
+        self.trace_cnt = 0
+
+        # Persistent sessions and retained messages survive restarts when
+        # there is a store
+        self.store = store
+        if store is not None:
+            self.restore(store.replay())
+            store.start()
+
+    def restore(self, state: StoredState):
+        """
+        Loads the persistent sessions and retained messages of a previous run.
+        """
+        for topic, (qos_level, payload) in state.retained.items():
+            self.retained.set(topic, QosLevel(qos_level), payload)
+
+        for client_id, stored in state.sessions.items():
+            session = self.new_session(client_id, persistent=True)
+            for topic_filter, qos_level in stored.subscriptions.items():
+                self.subscribe(session, topic_filter, QosLevel(qos_level))
+
+            # Messages waiting for PUBCOMP keep their packet ids, so they go
+            # first; the others get new ids when they are sent again. Those
+            # that fit the window may have been sent before and are resent
+            # as duplicates; the rest wait in the offline queue, as far as
+            # its memory and spill limits go. Those beyond are dropped like
+            # any message queued for an offline session.
+            messages = sorted(stored.messages.items())
+            for seq, message in messages:
+                if message.packet_id is not None:
+                    session.inflight.restore(
+                        message.packet_id, QosLevel(message.qos_level), seq
+                    )
+            for seq, message in messages:
+                if message.packet_id is not None:
+                    continue
+                args = (
+                    message.topic,
+                    QosLevel(message.qos_level),
+                    message.payload,
+                    message.retain,
+                    seq,
+                )
+                if len(session.offline) == 0 and session.inflight.room() > 0:
+                    session.inflight.submit(*args)
+                else:
+                    session.offline.put(*args)
+            if len(messages) > 0:
+                session.seq = itertools.count(messages[-1][0] + 1)
+
+            for packet_id, message in stored.incoming.items():
+                session.releasable[packet_id.to_bytes(2, "big")] = message
+
+            self.sessions[client_id] = session
+
+        logger.info(
+            "Restored %d sessions and %d retained messages",
+            len(state.sessions),
+            len(state.retained),
+        )
+
+    def log(self, session: Session, kind: RecordType, *fields):
+        """
+        Records a change to a persistent session in the store.
+        """
+        if self.store is not None and session.persistent:
+            self.store.append(kind, *fields)
+
+    def close(self):
+        """
+        Commits what is left in the store. Server modes call this on shutdown.
+        """
+        if self.store is not None:
+            self.store.close()
+
+    def tracing(self) -> bool:
+        """
+        Returns whether the packet about to be handled should be traced.
+        """
+        if not packet_logger.isEnabledFor(logging.DEBUG):
+            return False
+        self.trace_cnt += 1
+        return self.trace_cnt % self.trace_sample == 0
+
+    def next_conn_id(self) -> int:
+        return next(self.conn_ids)
+
+    def client_lock(self, client_id: str) -> threading.Lock:
+        return self.client_locks[hash(client_id) % self.CLIENT_LOCKS]
+
+    def new_outbound_queue(self) -> OutboundQueue:
+        return OutboundQueue(self.max_queue_depth, self.overflow_policy, self.spill_dir)
+
+    def new_session(self, client_id: str, persistent: bool) -> Session:
+        offline = None
+        if persistent:
+            offline = OfflineQueue(
+                self.offline_budget,
+                self.offline_memory,
+                self.offline_spill,
+                self.spill_dir,
+            )
+        session = Session(
+            client_id, self.max_inflight, persistent, offline, self.max_queued
+        )
+        session.inflight.on_drop = functools.partial(self.drop_queued, session)
+        if offline is not None:
+            offline.on_drop = functools.partial(self.drop_offline, session)
+        return session
+
+    def drop_queued(self, session: Session, message: tuple):
+        """
+        Gives up on a QoS 1/2 message that waited behind a full inflight
+        window until newer ones pushed it out of the queue.
+        """
+        encoded_topic, qos_level, _, _, seq, _ = message
+        self.drop(session, encoded_topic, qos_level, seq, "is too far behind")
+
+    def drop_offline(self, session: Session, message: tuple):
+        """
+        Gives up on a QoS 1/2 message for an offline session whose queue has
+        no room left on disk.
+        """
+        encoded_topic, qos_level, _, _, seq = message
+        self.drop(session, encoded_topic, qos_level, seq, "has no room offline")
+
+    def drop(
+        self,
+        session: Session,
+        encoded_topic: bytes,
+        qos_level: QosLevel,
+        seq: int,
+        reason: str,
+    ):
+        logger.warning(
+            "Client %s %s, dropping a QoS %d message on %s",
+            session.client_id,
+            reason,
+            qos_level.value,
+            encoded_topic[2:].decode("utf-8", "replace"),
+        )
+        self.metrics.counters().dropped += 1
+        # Done with as far as the store is concerned, or it would come back
+        # on every restart
+        self.log(session, RecordType.ACK, session.client_id, seq)
+
+    def queue_stats(self) -> Dict[str, dict]:
+        """
+        Returns the outbound queue depth and drop counters of every client.
+        """
+        return {
+            client_id: conn.queue.stats()
+            for client_id, conn in list(self.clients.items())
+        }
+
+    def throttle_stats(self) -> dict:
+        """
+        Returns the messages over rate limits of every client that had any,
+        and of every topic prefix with a limit.
+        """
+        return {
+            "clients": {
+                client_id: conn.throttled
+                for client_id, conn in list(self.clients.items())
+                if conn.throttled > 0
+            },
+            "prefixes": dict(self.throttle.prefix_throttled),
+        }
+
+    def match_cache_stats(self) -> dict:
+        """
+        Returns the size and hit rate of the topic match cache.
+        """
+        cache = self.subscriptions.cache
+        return cache.stats() if cache is not None else {}
+
+    def metrics_snapshot(self) -> dict:
+        """
+        Returns the broker's counters and the current number of clients,
+        sessions, subscriptions, inflight and retained messages.
+        """
+        res = self.metrics.snapshot()
+
+        # Copied first: other threads may change them meanwhile
+        sessions = list(self.sessions.values())
+        filters = list(self.subscriptions.client_filters.values())
+
+        res["clients"] = {
+            "connected": len(self.clients),
+            "total": len(sessions),
+            **self.admission.stats(),
+        }
+        res["messages"]["inflight"] = sum(len(s.inflight) for s in sessions)
+        res["messages"]["offline"] = sum(
+            len(s.offline) for s in sessions if s.offline is not None
+        )
+        res["messages"]["retained"] = len(self.retained)
+        res["fanout"] = self.fanout.stats()
+        res["subscriptions"] = sum(len(f) for f in filters)
+        return res
+
+    def publish_sys(self):
+        """
+        Publishes the metrics snapshot on the $SYS topics, retained, and
+        re-arms itself.
+        """
+        for topic, value in sys_topics(self.metrics_snapshot()).items():
+            # Not stored nor routed: they describe this broker only
+            payload = value.encode("utf-8")
+            self.retained.set(topic, QosLevel.AT_MOST_ONCE, payload)
+            self.forward(topic, QosLevel.AT_MOST_ONCE, payload)
+        self.timers.schedule(self.sys_interval, self.publish_sys)
+
+    def send_inflight(self, conn: Connection, message: InflightMessage):
+        """
+        Sends a message that just entered the inflight window and arms its
+        retransmission.
+        """
+        # Armed first: once sent, the ack may come in on another thread
+        self.arm_retransmission(conn, message)
+        conn.send((message.header, message.payload))
+
+    def arm_retransmission(self, conn: Connection, message: InflightMessage):
+        delay = min(
+            self.retry_interval * 2**message.attempts, self.MAX_RETRY_INTERVAL
+        )
+        message.timer = self.timers.schedule(delay, self.retransmit, conn, message)
+
+    def retransmit(self, conn: Connection, message: InflightMessage):
+        if conn.session.inflight.messages.get(message.packet_id) is not message:
+            # Acked while the timer was firing
+            return
+
+        if message.attempts >= self.max_retries:
+            logger.warning(
+                "[%s] No ack for %d after %d retransmissions, disconnecting",
+                conn.conn_id,
+                message.packet_id,
+                message.attempts,
+            )
+            conn.abort()
+            return
+
+        message.attempts += 1
+        self.metrics.counters().retransmits += 1
+        packet_logger.debug(
+            "[%s] Retransmitting %d to %s",
+            conn.conn_id,
+            message.packet_id,
+            conn.client_id,
+        )
+        self.resend(conn, message)
+        self.arm_retransmission(conn, message)
+
+    def resend(self, conn: Connection, message: InflightMessage):
+        match message.state:
+            case InflightState.PUBLISHED:
+                conn.send((set_dup_flag(message.header), message.payload))
+            case InflightState.RELEASED:
+                conn.send(MqttPubrel.frame(message.packet_id_bytes()))
+
+    def admit(self) -> bool:
+        """
+        Decides on a connection that was just accepted, before the server
+        mode spends anything on it. Refused ones should be closed.
+        """
+        if self.admission.accept():
+            return True
+        logger.debug("Refused a connection")
+        return False
+
+    def await_connect(self, conn: Connection):
+        """
+        Starts the wait for the CONNECT of an admitted connection.
+        """
+        conn.half_open = True
+        timeout = self.admission.connect_timeout
+        if timeout > 0:
+            conn.connect_timer = self.timers.schedule(
+                timeout, self.check_connect, conn
+            )
+
+    def check_connect(self, conn: Connection):
+        if not conn.half_open:
+            return
+        logger.info("[%s] No CONNECT in time, closing", conn.conn_id)
+        with self.admission.lock:
+            self.admission.timed_out += 1
+        conn.abort()
+
+    def end_half_open(self, conn: Connection):
+        if not conn.half_open:
+            return
+        conn.half_open = False
+        if conn.connect_timer is not None:
+            conn.connect_timer.cancel()
+            conn.connect_timer = None
+        self.admission.release()
+
+    def check_keep_alive(self, conn: Connection):
+        grace = conn.keep_alive * self.KEEP_ALIVE_GRACE
+        silent = self.timers.clock() - conn.last_seen
+        if silent < grace:
+            # Heard from the client since the timer was armed
+            conn.keep_alive_timer = self.timers.schedule(
+                grace - silent, self.check_keep_alive, conn
+            )
+            return
+
+        logger.info("[%s] Keep-alive expired for %s", conn.conn_id, conn.client_id)
+        conn.abort()
+
+    def publish(
+        self, topic: str, qos_level: QosLevel, payload, retain: bool, route=True
+    ):
+        """
+        Publishes a message received from a client, or with `route` false,
+        from another broker.
+        """
+        if retain:
+            # Shared by the retained store and the fan-out below
+            payload = bytes(payload)
+            self.retained.set(topic, qos_level, payload)
+            if self.store is not None:
+                self.store.append(RecordType.RETAIN, qos_level.value, topic, payload)
+
+        self.forward(topic, qos_level, payload)
+        if route and self.router is not None:
+            self.router.route(topic, qos_level, payload, retain)
+
+    def forward(self, topic: str, qos_level: QosLevel, payload):
+        """
+        Sends a message to every matching subscriber.
+
+        The payload is shared by all subscribers; each one only gets its own
+        small header, with the QoS downgraded to what it subscribed with and
+        a packet id from its own id space.
+
+        Messages with many subscribers are handed out by the fan-out engine
+        after this returns, see fanout.py.
+        """
+        subscribers = self.subscriptions.match(topic)
+        if len(subscribers) == 0:
+            return
+
+        if qos_level != QosLevel.AT_MOST_ONCE:
+            # Kept until acked: copy out of the receive buffer, once for all
+            # subscribers
+            payload = bytes(payload)
+
+        encoded_topic = encode_topic(topic)
+        deliver = functools.partial(self.fan_out, encoded_topic, qos_level, payload)
+        if not self.fanout.submit(subscribers, deliver):
+            deliver(subscribers.items())
+
+    def fan_out(
+        self,
+        encoded_topic: bytes,
+        qos_level: QosLevel,
+        payload,
+        subscribers: Iterable[Tuple[object, QosLevel]],
+    ):
+        """
+        Sends a message to `subscribers`, (client id or share group, qos)
+        pairs from the topic trie.
+        """
+        for client_id, sub_qos_level in subscribers:
+            conn = self.clients.get(client_id)
+            group = None
+            if conn is None:
+                if type(client_id) is not ShareGroup:
+                    qos = min(qos_level, sub_qos_level, key=lambda q: q.value)
+                    if qos != QosLevel.AT_MOST_ONCE:
+                        self.queue_offline(client_id, encoded_topic, qos, payload)
+                    continue
+
+                # One member of the group gets the message
+                group = client_id
+                member = group.pick(self.share_strategy, encoded_topic, self.clients)
+                if member is None:
+                    continue
+                conn, sub_qos_level = member
+
+            qos = min(qos_level, sub_qos_level, key=lambda q: q.value)
+            self.deliver(conn, encoded_topic, qos, payload, group=group)
+
+    def deliver(
+        self,
+        conn: Connection,
+        encoded_topic: bytes,
+        qos_level: QosLevel,
+        payload,
+        retain: bool = False,
+        group: Optional[ShareGroup] = None,
+    ):
+        """
+        Sends one message to one client. QoS 1/2 messages go through the
+        client's inflight window; `group` is the shared subscription group
+        the client was picked from, if any.
+        """
+        self.metrics.counters().messages_out += 1
+        match qos_level:
+            case QosLevel.AT_MOST_ONCE:
+                header = serialize_mqtt_publish_header(
+                    encoded_topic, qos_level, b"", len(payload), retain=retain
+                )
+                conn.send((header, payload), droppable=True)
+            case QosLevel.AT_LEAST_ONCE | QosLevel.EXACTLY_ONCE:
+                session = conn.session
+                seq = self.log_enqueue(
+                    session, encoded_topic, qos_level, payload, retain
+                )
+
+                offline = session.offline
+                if group is None and offline is not None:
+                    # Checked and submitted under the drain lock, so that a
+                    # drain moving older messages on can't be overtaken
+                    with offline.drain_lock:
+                        queued = len(offline) > 0
+                        if queued:
+                            # Behind what was queued while the client was away
+                            offline.put(encoded_topic, qos_level, payload, retain, seq)
+                        else:
+                            self.submit_inflight(
+                                conn, encoded_topic, qos_level, payload, retain, seq
+                            )
+                    if queued:
+                        self.drain_offline(conn)
+                    return
+
+                self.submit_inflight(
+                    conn, encoded_topic, qos_level, payload, retain, seq, group
+                )
+
+    def submit_inflight(
+        self,
+        conn: Connection,
+        encoded_topic: bytes,
+        qos_level: QosLevel,
+        payload,
+        retain: bool,
+        seq: int,
+        group: Optional[ShareGroup] = None,
+    ):
+        """
+        Sends a QoS 1/2 message once the client's inflight window has room.
+        """
+        message = conn.session.inflight.submit(
+            encoded_topic, qos_level, payload, retain, seq, group
+        )
+        if message is not None:
+            self.send_inflight(conn, message)
+
+    def log_enqueue(
+        self,
+        session: Session,
+        encoded_topic: bytes,
+        qos_level: QosLevel,
+        payload,
+        retain: bool,
+    ) -> int:
+        """
+        Records a message for a persistent session in the store. Returns its
+        seq, 0 if it isn't stored.
+        """
+        if self.store is None or not session.persistent:
+            return 0
+        seq = next(session.seq)
+        self.store.append(
+            RecordType.ENQUEUE,
+            session.client_id,
+            seq,
+            qos_level.value,
+            retain,
+            encoded_topic,
+            payload,
+        )
+        return seq
+
+    def queue_offline(
+        self, client_id: str, encoded_topic: bytes, qos_level: QosLevel, payload
+    ):
+        """
+        Queues a QoS 1/2 message for a persistent session whose client is
+        offline. Clean sessions get nothing: they go with their connection.
+        """
+        session = self.sessions.get(client_id)
+        if session is None or session.offline is None:
+            return
+
+        seq = self.log_enqueue(session, encoded_topic, qos_level, payload, False)
+        session.offline.put(encoded_topic, qos_level, payload, False, seq)
+
+        # The client may have come back and drained the queue meanwhile
+        conn = self.clients.get(client_id)
+        if conn is not None and conn.session is session:
+            self.drain_offline(conn)
+
+    def drain_offline(self, conn: Connection):
+        """
+        Moves as many offline messages into the inflight window as it has
+        room for, and sends them.
+        """
+        session = conn.session
+        offline = session.offline
+        if offline is None or len(offline) == 0:
+            return
+
+        with offline.drain_lock:
+            for topic, qos_level, payload, retain, seq in offline.take(
+                session.inflight.room()
+            ):
+                message = session.inflight.submit(
+                    topic, qos_level, payload, retain, seq
+                )
+                if message is not None:
+                    self.send_inflight(conn, message)
+
+    def send_retained(self, conn: Connection, topic_filter: str, qos_level: QosLevel):
+        """
+        Sends the retained messages matching a new subscription.
+        """
+        for message in self.retained.match(topic_filter):
+            qos = min(message.qos_level, qos_level, key=lambda q: q.value)
+            self.deliver(
+                conn, encode_topic(message.topic), qos, message.payload, retain=True
+            )
+
+    def handle_message(self, conn: Connection, request, bytes_consumed) -> bool:
+        """
+        Handles one packet received on `conn`.
+
+        Returns False when the client asked to disconnect; the caller should
+        then stop reading from the connection.
+        """
+        start = time.perf_counter_ns()
+        try:
+            return self.dispatch(conn, request, bytes_consumed)
+        finally:
+            self.metrics.record(
+                bytes_consumed[0] >> 4,
+                len(bytes_consumed),
+                time.perf_counter_ns() - start,
+            )
+
+    def dispatch(self, conn: Connection, request, bytes_consumed) -> bool:
+        tag = conn.conn_id
+        trace = self.tracing()
+        if trace:
+            packet_logger.debug(
+                "[%s] Received: %s from client: %s", tag, request, conn.client_id
+            )
+
+        if conn.client_id is None and not isinstance(request, MqttConnect):
+            # The first packet must be a CONNECT, MQTT-3.1.0-1
+            logger.warning(
+                "[%s] %s before CONNECT, closing", tag, type(request).__name__
+            )
+            return False
+
+        # Any packet counts as a sign of life. Keep-alive timers compare
+        # against this instead of being re-armed for every packet.
+        conn.last_seen = self.timers.clock()
+
+        match request:
+            case MqttConnect(
+                protocol_name,
+                protocol_level,
+                connect_flags,
+                keep_alive,
+                client_id,
+            ):
+                # Todo: validation
+                logger.info("[%s] Client(id='%s') connected", tag, client_id)
+                self.end_half_open(conn)
+
+                if client_id == "":
+                    # The doc says we have two choices:
+                    # 1. Reject and respond return_code = 0x02
+                    # 2. Assign a unique id to the client
+                    #
+                    # `mqtt test` passes in an empty client id and
+                    # gives up if rejected, so we do #2.
+                    client_id = str(uuid.uuid4())
+                    logger.info(
+                        "[%s] Received empty client id. Assign an unique id: %s",
+                        tag,
+                        client_id,
+                    )
+
+                    # Nobody could resume a session under a made-up id
+                    connect_flags |= 0x02
+
+                if client_id not in self.clients and self.admission.full(
+                    len(self.clients)
+                ):
+                    logger.warning(
+                        "[%s] Too many connections, rejecting %s", tag, client_id
+                    )
+                    # Return code 3: server unavailable
+                    conn.send(MqttConnack(return_code=3).serialize())
+                    return False
+
+                # Held by the session, its subscriptions and several maps;
+                # interned, lookups compare it by identity
+                client_id = sys.intern(client_id)
+                conn.client_id = client_id
+                conn.rate_limit = self.throttle.client_limit()
+                clean_session = connect_flags & 0x02 != 0
+                with self.client_lock(client_id):
+                    session_present = self.open_session(conn, not clean_session)
+
+                    # CONNACK goes out first; messages may follow as soon as
+                    # the client is in `clients`
+                    connack = MqttConnack(
+                        return_code=0, session_present=session_present
+                    )
+                    conn.send(connack.serialize())
+                    old = self.clients.get(client_id)
+                    self.clients[client_id] = conn
+
+                # Session takeover: the older connection is closed rather
+                # than left open with nothing behind it. Its `disconnect`
+                # finds it replaced and leaves the session alone.
+                if old is not None and old is not conn:
+                    logger.info(
+                        "[%s] Client %s took over from connection %s",
+                        tag,
+                        client_id,
+                        old.conn_id,
+                    )
+                    with self.admission.lock:
+                        self.admission.taken_over += 1
+                    old.abort()
+                if trace:
+                    packet_logger.debug("[%s] CONNACK sent", tag)
+
+                # A keep-alive of 0 turns the mechanism off
+                if keep_alive > 0:
+                    conn.keep_alive = keep_alive
+                    conn.keep_alive_timer = self.timers.schedule(
+                        keep_alive * self.KEEP_ALIVE_GRACE, self.check_keep_alive, conn
+                    )
+
+                if session_present:
+                    self.resume(conn)
+            case MqttPublish(dup_flag, qos_level, retain, topic, packet_id, payload):
+                if not is_valid_topic(topic):
+                    # Topic names in PUBLISH must not contain wildcards
+                    logger.warning("[%s] Invalid topic name: %s", tag, topic)
+                    return False
+
+                delay = self.throttle.charge(
+                    conn.rate_limit, topic, len(bytes_consumed)
+                )
+                if delay > 0:
+                    # Handled all the same; what the client sends next waits
+                    # in its socket until it is back within its limits
+                    conn.throttled += 1
+                    self.metrics.counters().throttled += 1
+                    conn.pause_reading(delay)
+
+                match qos_level:
+                    case QosLevel.AT_MOST_ONCE:
+                        self.publish(topic, qos_level, payload, retain)
+                    case QosLevel.AT_LEAST_ONCE:
+                        conn.send(MqttPuback.frame(packet_id))
+                        if trace:
+                            packet_logger.debug("[%s] PUBACK sent", tag)
+
+                        self.publish(topic, qos_level, payload, retain)
+                    case QosLevel.EXACTLY_ONCE:
+                        # Mark message as pending release. Copy the payload
+                        # so it doesn't pin the receive buffer.
+                        payload = bytes(payload)
+                        conn.session.releasable[packet_id] = (topic, payload, retain)
+                        self.log(
+                            conn.session,
+                            RecordType.INCOMING,
+                            conn.client_id,
+                            int.from_bytes(packet_id, "big"),
+                            retain,
+                            topic,
+                            payload,
+                        )
+
+                        conn.send(MqttPubrec.frame(packet_id))
+                        if trace:
+                            packet_logger.debug("[%s] PUBREC sent", tag)
+
+            case MqttPuback(packet_id):
+                if trace:
+                    packet_logger.debug(
+                        "[%s] Received PUBACK for %s from %s",
+                        tag,
+                        packet_id,
+                        conn.client_id,
+                    )
+
+                # Nothing is acked when we receive PUBACK for the same
+                # packet_id from a client more than once.
+                self.complete(
+                    conn, int.from_bytes(packet_id, "big"), InflightState.PUBLISHED
+                )
+
+            case MqttPubrec(packet_id):
+                if trace:
+                    packet_logger.debug(
+                        "[%s] Received PUBREC for %s from subscriber %s",
+                        tag,
+                        packet_id,
+                        conn.client_id,
+                    )
+
+                message = conn.session.inflight.release(
+                    int.from_bytes(packet_id, "big")
+                )
+
+                # Send PUBREL
+                conn.send(MqttPubrel.frame(packet_id))
+                if trace:
+                    packet_logger.debug("[%s] PUBREL sent", tag)
+
+                if message is not None:
+                    self.log(
+                        conn.session,
+                        RecordType.RELEASE,
+                        conn.client_id,
+                        message.seq,
+                        message.packet_id,
+                    )
+
+                    # From now on it's the PUBREL that gets retransmitted
+                    message.timer.cancel()
+                    message.attempts = 0
+                    self.arm_retransmission(conn, message)
+            case MqttPubrel(packet_id):
+                if trace:
+                    packet_logger.debug(
+                        "[%s] Received PUBREL for %s from publisher %s",
+                        tag,
+                        packet_id,
+                        conn.client_id,
+                    )
+
+                # The message is missing if this PUBREL is a retransmission;
+                # PUBCOMP is sent regardless.
+                message = conn.session.releasable.pop(packet_id, None)
+                if message is not None:
+                    topic, payload, retain = message
+                    self.publish(topic, QosLevel.EXACTLY_ONCE, payload, retain)
+                    self.log(
+                        conn.session,
+                        RecordType.INCOMING_DONE,
+                        conn.client_id,
+                        int.from_bytes(packet_id, "big"),
+                    )
+
+                # send PUBCOMP
+                conn.send(MqttPubcomp.frame(packet_id))
+                if trace:
+                    packet_logger.debug("[%s] PUBCOMP sent", tag)
+
+            case MqttPubcomp(packet_id):
+                if trace:
+                    packet_logger.debug(
+                        "[%s] Received PUBCOMP for %s from subscriber %s",
+                        tag,
+                        packet_id,
+                        conn.client_id,
+                    )
+
+                # Nothing is acked when we receive PUBCOMP for the
+                # same packet_id from a client more than once.
+                self.complete(
+                    conn, int.from_bytes(packet_id, "big"), InflightState.RELEASED
+                )
+
+            case MqttSubscribe(packet_id, topics):
+                return_codes = []
+                granted = []
+                # A connection that was taken over meanwhile must not
+                # change the session anymore
+                with self.client_lock(conn.client_id):
+                    current = self.sessions.get(conn.client_id) is conn.session
+                    for topic_filter, qos_level in topics:
+                        if not current:
+                            return_codes.append(0x80)
+                            continue
+                        if not is_valid_filter(topic_filter):
+                            logger.warning(
+                                "[%s] Invalid topic filter: %s", tag, topic_filter
+                            )
+                            return_codes.append(0x80)
+                            continue
+
+                        # In MQTT, clients can subscribe to a topic before
+                        # any message is published to that topic.
+                        shared = self.subscribe(
+                            conn.session, topic_filter, qos_level
+                        )
+                        self.log(
+                            conn.session,
+                            RecordType.SUBSCRIBE,
+                            conn.client_id,
+                            topic_filter,
+                            qos_level.value,
+                        )
+
+                        if trace:
+                            packet_logger.debug(
+                                "[%s] Subscribe to %s, %s", tag, topic_filter, qos_level
+                            )
+                        return_codes.append(qos_level.value)
+                        if not shared:
+                            granted.append((topic_filter, qos_level))
+
+                if trace:
+                    packet_logger.debug(
+                        "[%s] Subscriptions: %s",
+                        tag,
+                        self.subscriptions.filters(conn.client_id),
+                    )
+
+                # Respond SUBACK
+                suback = MqttSuback(packet_id, return_codes)
+                conn.send(suback.serialize())
+                if trace:
+                    packet_logger.debug("[%s] SUBACK sent", tag)
+
+                # Retained messages go out after the SUBACK, not for shared
+                # subscriptions though: a group takes no more than new
+                # messages
+                for topic_filter, qos_level in granted:
+                    self.send_retained(conn, topic_filter, qos_level)
+            case MqttUnsubscribe(packet_id, topics):
+                with self.client_lock(conn.client_id):
+                    current = self.sessions.get(conn.client_id) is conn.session
+                    for topic_filter in topics if current else []:
+                        self.unsubscribe(conn.session, topic_filter)
+                        self.log(
+                            conn.session,
+                            RecordType.UNSUBSCRIBE,
+                            conn.client_id,
+                            topic_filter,
+                        )
+                        if trace:
+                            packet_logger.debug(
+                                "[%s] Unsubscribe from %s", tag, topic_filter
+                            )
+
+                conn.send(MqttUnsuback.frame(packet_id))
+                if trace:
+                    packet_logger.debug("[%s] UNSUBACK sent", tag)
+            case MqttPingreq():
+                pingresp = MqttPingresp()
+                conn.send(pingresp.serialize())
+                if trace:
+                    packet_logger.debug("[%s] PINGRESP sent", tag)
+            case MqttDisconnect():
+                self.disconnect(conn)
+                return False
+            case unknown:
+                # Nothing a client may send; close like for a protocol error
+                logger.warning("[%s] Unexpected packet, closing: %s", tag, unknown)
+                return False
+
+        return True
+
+    def subscribe(
+        self, session: Session, topic_filter: str, qos_level: QosLevel
+    ) -> bool:
+        """
+        Subscribes a client to a valid filter. Returns whether that is a
+        shared subscription. Called with the client's `client_lock` held
+        once the broker is serving.
+        """
+        shared = split_shared(topic_filter)
+        if shared is None:
+            self.subscriptions.subscribe(session.client_id, topic_filter, qos_level)
+            return False
+
+        with self.groups_lock:
+            group = self.share_groups.get(topic_filter)
+            if group is None:
+                group = self.share_groups[topic_filter] = ShareGroup(*shared)
+                # Members have a qos each; the group's own doesn't limit them
+                self.subscriptions.subscribe(
+                    group, group.topic_filter, QosLevel.EXACTLY_ONCE
+                )
+            group.members = {**group.members, session.client_id: qos_level}
+            session.groups[topic_filter] = group
+        return True
+
+    def unsubscribe(self, session: Session, topic_filter: str):
+        with self.groups_lock:
+            group = session.groups.pop(topic_filter, None)
+            if group is not None:
+                members = dict(group.members)
+                del members[session.client_id]
+                group.members = members
+                if len(members) == 0:
+                    del self.share_groups[topic_filter]
+                    self.subscriptions.remove_client(group)
+                return
+
+        self.subscriptions.unsubscribe(session.client_id, topic_filter)
+
+    def redistribute(self, session: Session):
+        """
+        Hands the QoS 1/2 messages a departing client got as a member of
+        shared subscription groups over to the other members.
+        """
+        for topic, qos_level, payload, group, seq in session.inflight.take_shared():
+            if seq != 0:
+                self.log(session, RecordType.ACK, session.client_id, seq)
+
+            member = group.pick(self.share_strategy, topic, self.clients)
+            if member is None:
+                logger.debug("No member of %s left to take over a message", group)
+                continue
+            conn, sub_qos_level = member
+            qos = min(qos_level, sub_qos_level, key=lambda q: q.value)
+            self.deliver(conn, topic, qos, payload, group=group)
+
+    def open_session(self, conn: Connection, persistent: bool) -> bool:
+        """
+        Attaches a session to a client that just connected: its persistent
+        session if it asked to resume one, a new session otherwise. Returns
+        whether an existing session was resumed.
+        """
+        session = self.sessions.get(conn.client_id)
+        if session is not None and session.persistent and persistent:
+            conn.session = session
+            return True
+
+        if session is not None:
+            self.drop_session(session)
+        conn.session = self.new_session(conn.client_id, persistent)
+        self.sessions[conn.client_id] = conn.session
+        self.log(conn.session, RecordType.SESSION, conn.client_id)
+        return False
+
+    def resume(self, conn: Connection):
+        """
+        Picks up a persistent session where it was left: resends every
+        message the client hasn't acked, then those queued behind them and
+        those that arrived while it was offline.
+        """
+        for message in conn.session.inflight.pending():
+            if message.timer is not None:
+                message.timer.cancel()
+            message.attempts = 0
+            self.resend(conn, message)
+            self.arm_retransmission(conn, message)
+
+        self.send_admitted(conn, conn.session.inflight.fill())
+        self.drain_offline(conn)
+
+    def drop_session(self, session: Session):
+        """
+        Forgets a session. Called with the client's `client_lock` held.
+        """
+        if self.sessions.get(session.client_id) is session:
+            del self.sessions[session.client_id]
+        self.subscriptions.remove_client(session.client_id)
+        if session.offline is not None:
+            session.offline.close()
+        for topic_filter in list(session.groups):
+            self.unsubscribe(session, topic_filter)
+        # Out of its groups first, so none of this goes back to the client
+        self.redistribute(session)
+        session.inflight.clear()
+        self.log(session, RecordType.DROP_SESSION, session.client_id)
+
+    def complete(self, conn: Connection, packet_id: int, state: InflightState):
+        """
+        Handles a PUBACK (`state` PUBLISHED) or PUBCOMP (`state` RELEASED).
+        """
+        session = conn.session
+        message = session.inflight.messages.get(packet_id)
+        admitted = session.inflight.ack(packet_id, state)
+        if message is not None and message.state == state:
+            self.log(session, RecordType.ACK, session.client_id, message.seq)
+        self.send_admitted(conn, admitted)
+        self.drain_offline(conn)
+
+    def send_admitted(self, conn: Connection, messages):
+        """
+        Sends the queued messages an ack let into the inflight window.
+        """
+        for message in messages:
+            self.send_inflight(conn, message)
+
+    def disconnect(self, conn: Connection):
+        """
+        Forgets `conn`, and its session unless that is persistent. Safe to
+        call more than once.
+        """
+        if conn.keep_alive_timer is not None:
+            conn.keep_alive_timer.cancel()
+        self.end_half_open(conn)
+
+        if conn.client_id is None:
+            return
+
+        # A newer connection may have taken over the client id, in which
+        # case the state belongs to it now.
+        with self.client_lock(conn.client_id):
+            if self.clients.get(conn.client_id) is not conn:
+                return
+
+            del self.clients[conn.client_id]
+            if conn.session.persistent:
+                # Retransmissions resume when the client comes back, except
+                # for messages of shared subscriptions: other members take
+                # them
+                self.redistribute(conn.session)
+                conn.session.inflight.cancel_timers()
+            else:
+                self.drop_session(conn.session)
@@ -1,7 +1,7 @@
 class Decoder:
-    def __init__(self, data):
+    def __init__(self, data, offset: int = 0):
         self.data = data
-        self.curr = 0
+        self.curr = offset
 
     def byte(self) -> int:
         b = self.data[self.curr]
@@ -47,7 +47,8 @@ class Decoder:
 
         data = self.data[self.curr : self.curr + length]
         self.curr += length
-        return data.decode("utf-8")
+        # `data` may be a memoryview, which has no decode()
+        return str(data, "utf-8")
 
     def num_bytes_consumed(self) -> int:
         return self.curr
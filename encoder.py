@@ -1,27 +1,35 @@
+import struct
+
+U16 = struct.Struct("!H")
+
+
+def encode_varint(v: int) -> bytes:
+    if v < 0:
+        raise ValueError("Varint encoding does not support negative values.")
+
+    result = bytearray()
+    while v > 0x7F:  # While there are still more significant bits
+        result.append((v & 0x7F) | 0x80)  # Add the least 7 bits with MSB set
+        v >>= 7  # Shift by 7 bits
+    result.append(v)  # Add the remaining 7 bits
+    return bytes(result)
+
+
 class Encoder:
     def __init__(self):
         self.data = bytearray()
 
     def append_byte(self, b):
-        self.data.extend(int.to_bytes(b, length=1, byteorder="big", signed=False))
+        self.data.append(b)
 
     def append_bytes(self, v):
         self.data.extend(v)
 
     def append_int(self, v):
-        self.data.extend(int.to_bytes(v, length=2, byteorder="big", signed=False))
+        self.data.extend(U16.pack(v))
 
     def append_varint(self, v):
-        if v < 0:
-            raise ValueError("Varint encoding does not support negative values.")
-
-        result = bytearray()
-        while v > 0x7F:  # While there are still more significant bits
-            result.append((v & 0x7F) | 0x80)  # Add the least 7 bits with MSB set
-            v >>= 7  # Shift by 7 bits
-        result.append(v & 0x7F)  # Add the remaining 7 bits
-
-        self.data.extend(result)
+        self.data.extend(encode_varint(v))
 
     def bytes(self) -> bytes:
         return bytes(self.data)
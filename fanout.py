@@ -0,0 +1,177 @@
+"""
+Fan-out of messages with very many subscribers, off the publisher's path.
+
+A firmware notice to 50k devices takes a while to hand out, and done inline
+the publisher's handler is stuck with it: in the threaded mode nothing else
+is read from the publisher meanwhile, in the asyncio mode the event loop
+serves nobody else, and the publisher's PUBACK or PUBCOMP waits for the last
+subscriber. `FanOut` instead splits the subscribers of such a message into
+lanes and chunks, queues the chunks and returns, so the ack goes out right
+away.
+
+- Threaded mode: every lane has a worker thread, and the lanes' chunks are
+  delivered concurrently.
+- asyncio mode: there is one lane, drained one chunk per event loop
+  iteration, so other clients are served between chunks. `--workers` runs
+  more event loops.
+
+Order is kept per subscriber: a subscriber always lands in the same lane
+(by the hash of its client id), lanes are first-in first-out, and while any
+chunk is queued every message goes through the lanes, however few its
+subscribers. Only once they are empty do small fan-outs go back to being
+done inline.
+"""
+
+from collections import deque
+from typing import Callable, Deque, List, Optional, Tuple
+import asyncio
+import logging
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Delivers a chunk of (subscriber, qos) pairs
+Deliver = Callable[[List[tuple]], None]
+
+
+class _Lane:
+    __slots__ = ("chunks", "cond")
+
+    def __init__(self):
+        # (deliver, subscribers) of the chunks to go out, oldest first
+        self.chunks: Deque[Tuple[Deliver, List[tuple]]] = deque()
+        self.cond = threading.Condition()
+
+
+class FanOut:
+    # Subscribers from which a message is handed out in chunks; 0 turns the
+    # engine off
+    THRESHOLD = 1000
+
+    # Subscribers per chunk
+    CHUNK_SIZE = 500
+
+    # Lanes, each with a thread, in the threaded mode
+    WORKERS = 2
+
+    def __init__(
+        self,
+        threshold: int = THRESHOLD,
+        chunk_size: int = CHUNK_SIZE,
+        workers: int = WORKERS,
+    ):
+        self.threshold = threshold
+        self.chunk_size = chunk_size
+        self.workers = workers
+
+        # Set by `start_threads` or `start_loop`; until then everything is
+        # delivered inline
+        self.lanes: List[_Lane] = []
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+
+        # Chunks queued or being delivered. Changed with `lock` held, which
+        # also keeps the chunks of one message together across lanes.
+        self.pending = 0
+        self.lock = threading.Lock()
+
+        # counters: messages handed out in chunks, and chunks
+        self.broadcasts = 0
+        self.chunks = 0
+
+    def start_threads(self):
+        """
+        Starts a worker thread per lane, for the threaded mode.
+        """
+        if self.threshold <= 0 or len(self.lanes) > 0:
+            return
+        self.lanes = [_Lane() for _ in range(self.workers)]
+        for i, lane in enumerate(self.lanes):
+            threading.Thread(
+                target=self.work, args=(lane,), name=f"fanout-{i}", daemon=True
+            ).start()
+
+    def start_loop(self, loop: asyncio.AbstractEventLoop):
+        """
+        Delivers chunks on `loop`, for the asyncio mode. Submitting is then
+        only allowed from the loop's thread.
+        """
+        if self.threshold <= 0 or len(self.lanes) > 0:
+            return
+        self.loop = loop
+        self.lanes = [_Lane()]
+
+    def submit(self, subscribers: dict, deliver: Deliver) -> bool:
+        """
+        Queues the delivery of a message to `subscribers`, which map
+        subscribers to their qos, in chunks passed to `deliver`. Returns
+        False, queueing nothing, if the caller should deliver it inline.
+        """
+        if len(self.lanes) == 0:
+            return False
+
+        # Most messages take this way out, without the lock. A publisher
+        # sees the chunks of its own earlier messages counted in `pending`,
+        # which is all its order depends on.
+        small = len(subscribers) < self.threshold
+        if small and self.pending == 0:
+            return False
+
+        with self.lock:
+            if small and self.pending == 0:
+                return False
+
+            parts = [[] for _ in self.lanes]
+            for subscriber in subscribers.items():
+                parts[hash(subscriber[0]) % len(parts)].append(subscriber)
+
+            self.broadcasts += 1
+            for lane, part in zip(self.lanes, parts):
+                chunks = [
+                    (deliver, part[i : i + self.chunk_size])
+                    for i in range(0, len(part), self.chunk_size)
+                ]
+                if len(chunks) == 0:
+                    continue
+                self.pending += len(chunks)
+                self.chunks += len(chunks)
+                with lane.cond:
+                    idle = len(lane.chunks) == 0
+                    lane.chunks.extend(chunks)
+                    if self.loop is None:
+                        lane.cond.notify()
+                    elif idle:
+                        self.loop.call_soon(self.step, lane)
+        return True
+
+    def work(self, lane: _Lane):
+        while True:
+            with lane.cond:
+                while len(lane.chunks) == 0:
+                    lane.cond.wait()
+                chunk = lane.chunks.popleft()
+            self.run(chunk)
+
+    def step(self, lane: _Lane):
+        # The chunk stays queued while it is delivered, so that `submit`
+        # knows the lane is busy and doesn't schedule another step
+        self.run(lane.chunks[0])
+        lane.chunks.popleft()
+        if len(lane.chunks) > 0:
+            self.loop.call_soon(self.step, lane)
+
+    def run(self, chunk: Tuple[Deliver, List[tuple]]):
+        deliver, subscribers = chunk
+        try:
+            deliver(subscribers)
+        except Exception:
+            logger.exception("Fan-out of a chunk failed")
+        finally:
+            with self.lock:
+                self.pending -= 1
+
+    def stats(self) -> dict:
+        return {
+            "broadcasts": self.broadcasts,
+            "chunks": self.chunks,
+            "pending": self.pending,
+        }
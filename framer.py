@@ -0,0 +1,175 @@
+"""
+Incremental frame reassembly for the receive path.
+
+TCP delivers a byte stream: one read can end in the middle of a packet or
+carry hundreds of small ones. `Framer` owns the receive buffer, reads the
+fixed header of the next packet to learn its length and only hands out a
+frame once all of it has arrived.
+
+Frames are handed out as `memoryview` slices of the receive buffer, so no
+bytes are copied between the socket and the decoder. Once handed out, a
+region of the buffer is never written again: when the buffer runs out of
+space a new one is allocated and only the partial frame at its tail is moved
+over. A frame therefore stays valid as long as someone holds on to it, but
+holding on to it also keeps its whole receive buffer alive; long-lived
+copies (retransmission queues, retained messages) should use `bytes(frame)`.
+
+A frame longer than `max_packet_size` is refused as soon as its fixed header
+is in. Below that, the buffer of a large frame grows with what actually
+arrives, at most `recv_size` ahead of it, rather than to the length its
+header claims.
+
+A small buffer that was fully consumed is let go of, and allocated again by
+the next read: most connections are idle most of the time, and don't need to
+hold one in between.
+"""
+
+from typing import Iterator
+
+# Stands in for the buffer of a framer that has nothing pending
+EMPTY = b""
+
+
+class Framer:
+    __slots__ = (
+        "recv_size",
+        "max_packet_size",
+        "size",
+        "buf",
+        "start",
+        "end",
+        "frame_len",
+    )
+
+    # Upper bound of the buffer handed to a single recv_into(). The buffer
+    # starts small and doubles whenever a read fills it, so idle connections
+    # don't pay for it.
+    RECV_SIZE = 64 * 1024
+    INITIAL_SIZE = 256
+
+    # Fixed header: 1 type byte and up to 4 bytes of remaining length
+    MAX_HEADER_LEN = 5
+
+    # The largest frame the remaining length can describe
+    PROTOCOL_MAX_PACKET_SIZE = MAX_HEADER_LEN + 0x0FFFFFFF
+
+    # The largest frame accepted by default. Brokers expecting bigger
+    # payloads raise it, up to PROTOCOL_MAX_PACKET_SIZE (--max-packet-size).
+    MAX_PACKET_SIZE = 1024 * 1024
+
+    def __init__(
+        self, recv_size: int = RECV_SIZE, max_packet_size: int = MAX_PACKET_SIZE
+    ):
+        self.recv_size = recv_size
+        self.max_packet_size = max_packet_size
+        self.size = min(self.INITIAL_SIZE, recv_size)
+        self.buf = bytearray(self.size)
+
+        # [start, end) holds received bytes that are not part of a frame
+        # handed out yet
+        self.start = 0
+        self.end = 0
+
+        # Length of the frame at `start` once its header has been read
+        self.frame_len = 0
+
+    def recv_buffer(self) -> memoryview:
+        """
+        Returns the writable tail of the receive buffer, to be filled with
+        `socket.recv_into()` and committed with `advance()`.
+        """
+        if self.frame_len == 0:
+            # Learn the size of a partially received frame so its buffer is
+            # grown in few steps rather than read by read. A bad header is
+            # left for `frames()` to raise.
+            try:
+                self.frame_len = self._read_header()
+            except ValueError:
+                pass
+
+        # Room for the rest of the frame, but never more than `recv_size`
+        # beyond what arrived: a header alone can claim 256MB
+        pending = self.end - self.start
+        needed = max(min(self.frame_len, pending + self.recv_size), pending + 1)
+        if self.end == len(self.buf) or self.start + needed > len(self.buf):
+            self._reallocate(max(self.size, needed))
+        return memoryview(self.buf)[self.end :]
+
+    def advance(self, n: int):
+        # The read filled all the space we offered; offer more next time
+        if self.end + n == len(self.buf) and self.size < self.recv_size:
+            self.size = min(self.size * 2, self.recv_size)
+        self.end += n
+
+    def feed(self, data: bytes):
+        """
+        Appends `data` for transports that hand out their own buffers.
+        """
+        while len(data) > 0:
+            buf = self.recv_buffer()
+            n = min(len(buf), len(data))
+            buf[:n] = data[:n]
+            self.advance(n)
+            data = data[n:]
+
+    def frames(self) -> Iterator[memoryview]:
+        """
+        Yields every complete frame received so far, in order.
+        """
+        view = memoryview(self.buf)
+        while True:
+            if self.frame_len == 0:
+                self.frame_len = self._read_header()
+                if self.frame_len == 0:
+                    break
+
+            if self.end - self.start < self.frame_len:
+                return
+
+            frame = view[self.start : self.start + self.frame_len]
+            self.start += self.frame_len
+            self.frame_len = 0
+            yield frame
+
+        if self.start == self.end and self.size <= self.INITIAL_SIZE:
+            # Frames handed out keep the buffer alive as long as they need it
+            self.buf = EMPTY
+            self.start = self.end = 0
+
+    def _read_header(self) -> int:
+        """
+        Returns the length of the whole frame at `start`, or 0 if its fixed
+        header hasn't fully arrived yet.
+        """
+        buf = self.buf
+        remaining_len = 0
+        shift = 0
+        i = self.start + 1
+        while i < self.end:
+            b = buf[i]
+            remaining_len |= (b & 0x7F) << shift
+            i += 1
+            if b & 0x80 == 0:
+                frame_len = (i - self.start) + remaining_len
+                if frame_len > self.max_packet_size:
+                    raise ValueError(
+                        f"packet of {frame_len} bytes, over {self.max_packet_size}"
+                    )
+                return frame_len
+
+            shift += 7
+            if i - self.start == self.MAX_HEADER_LEN:
+                raise ValueError("malformed remaining length")
+
+        return 0
+
+    def _reallocate(self, size: int):
+        # Never resize or overwrite the current buffer: frames handed out
+        # earlier may still point into it.
+        buf = bytearray(size)
+        pending = self.end - self.start
+        buf[:pending] = memoryview(self.buf)[self.start : self.end]
+
+        self.buf = buf
+        self.start = 0
+        self.end = pending
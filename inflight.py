@@ -0,0 +1,342 @@
+"""
+Outgoing QoS 1/2 messages of one session.
+
+MQTT lets a client be sent only so many unacknowledged messages at once.
+`InflightWindow` assigns packet ids from the session's own 16-bit id space,
+keeps at most `max_inflight` messages awaiting an ack and queues the rest
+until a slot frees up. Acks look messages up by packet id, so they are O(1)
+no matter how many messages are pending.
+"""
+
+from enum import Enum
+from typing import Callable, Dict, List, Optional
+import threading
+from protocol import QosLevel, serialize_mqtt_publish_header
+from timerwheel import Timer
+
+
+class InflightState(Enum):
+    # PUBLISH sent, waiting for PUBACK (QoS 1) or PUBREC (QoS 2)
+    PUBLISHED = 1
+    # QoS 2 only: PUBREL sent, waiting for PUBCOMP
+    RELEASED = 2
+
+
+class InflightMessage:
+    __slots__ = (
+        "packet_id",
+        "qos_level",
+        "header",
+        "payload",
+        "state",
+        "attempts",
+        "timer",
+        "seq",
+        "topic",
+        "group",
+    )
+
+    def __init__(
+        self,
+        packet_id: int,
+        qos_level: QosLevel,
+        header: bytes,
+        payload,
+        seq: int = 0,
+        topic: bytes = b"",
+        group=None,
+    ):
+        self.packet_id = packet_id
+        self.qos_level = qos_level
+        self.header = header
+        self.payload = payload
+        self.state = InflightState.PUBLISHED
+
+        # Encoded topic, and the shared subscription group the message was
+        # picked for (see shared.py), if any
+        self.topic = topic
+        self.group = group
+
+        # Identifies the message in the session store, which outlives packet
+        # ids; 0 for sessions that aren't stored
+        self.seq = seq
+
+        # Retransmissions so far in the current state, and the timer of the
+        # next one
+        self.attempts = 0
+        self.timer: Optional[Timer] = None
+
+    def packet_id_bytes(self) -> bytes:
+        return self.packet_id.to_bytes(2, "big")
+
+
+class InflightWindow:
+    __slots__ = (
+        "max_inflight",
+        "max_queued",
+        "messages",
+        "queued",
+        "head",
+        "packet_id",
+        "dropped",
+        "on_drop",
+        "lock",
+    )
+
+    MAX_INFLIGHT = 20
+
+    # Messages waiting for a free slot; beyond that the oldest is dropped
+    MAX_QUEUED = 1000
+
+    def __init__(
+        self,
+        max_inflight: int = MAX_INFLIGHT,
+        max_queued: int = MAX_QUEUED,
+        on_drop: Optional[Callable[[tuple], None]] = None,
+    ):
+        self.max_inflight = max_inflight
+        self.max_queued = max_queued
+
+        # maps packet id to message, oldest first
+        self.messages: Dict[int, InflightMessage] = {}
+
+        # (encoded topic, qos, payload, retain, seq, group) of messages
+        # waiting for a slot, oldest first, from index `head` on. A list:
+        # every session has one, usually empty, and an empty deque costs ten
+        # times as much. Taking from the front moves `head` rather than
+        # shifting the list, see `_take`.
+        self.queued: List[Optional[tuple]] = []
+        self.head = 0
+
+        # Last packet id handed out
+        self.packet_id = 0
+
+        # Queued messages dropped for newer ones, and what is told about
+        # each: its (encoded topic, qos, payload, retain, seq, group). Called
+        # with `lock` held.
+        self.dropped = 0
+        self.on_drop = on_drop
+
+        # Publishers submit from their threads while the owner acks from its
+        # own in the threaded mode
+        self.lock = threading.Lock()
+
+    def submit(
+        self,
+        topic: bytes,
+        qos_level: QosLevel,
+        payload,
+        retain: bool = False,
+        seq: int = 0,
+        group=None,
+    ) -> Optional[InflightMessage]:
+        """
+        Adds a message for the client. Returns it if it entered the window
+        and should be sent now, None if it was queued behind the window.
+        """
+        with self.lock:
+            queued = len(self.queued) - self.head
+            if len(self.messages) < self.max_inflight and queued == 0:
+                return self._admit(topic, qos_level, payload, retain, seq, group)
+
+            if queued >= self.max_queued:
+                dropped = self.queued[self.head]
+                self.queued[self.head] = None
+                self.head += 1
+                self._compact()
+                self.dropped += 1
+                if self.on_drop is not None:
+                    self.on_drop(dropped)
+            self.queued.append((topic, qos_level, payload, retain, seq, group))
+            return None
+
+    def ack(self, packet_id: int, state: InflightState) -> List[InflightMessage]:
+        """
+        Completes the message `packet_id` if it is in `state` (PUBLISHED for
+        a PUBACK, RELEASED for a PUBCOMP). Returns the queued messages that
+        took the freed slots and should be sent now.
+        """
+        with self.lock:
+            message = self.messages.get(packet_id)
+            if message is None or message.state != state:
+                # Duplicate or unexpected ack
+                return []
+
+            del self.messages[packet_id]
+            if message.timer is not None:
+                message.timer.cancel()
+
+            return self._fill()
+
+    def release(self, packet_id: int) -> Optional[InflightMessage]:
+        """
+        Records a PUBREC. Returns the message if it just moved on to waiting
+        for PUBCOMP, None for unknown ids and duplicate PUBRECs; PUBREL
+        should be sent either way.
+        """
+        with self.lock:
+            message = self.messages.get(packet_id)
+            if message is None or message.state != InflightState.PUBLISHED:
+                return None
+            if message.qos_level != QosLevel.EXACTLY_ONCE:
+                return None
+
+            message.state = InflightState.RELEASED
+            # The payload won't be sent again
+            message.payload = None
+            return message
+
+    def restore(self, packet_id: int, qos_level: QosLevel, seq: int):
+        """
+        Puts back a message that was waiting for PUBCOMP when the session was
+        stored, under its original packet id.
+        """
+        with self.lock:
+            message = InflightMessage(packet_id, qos_level, b"", None, seq)
+            message.state = InflightState.RELEASED
+            self.messages[packet_id] = message
+
+    def fill(self) -> List[InflightMessage]:
+        """
+        Admits queued messages into free slots. Returns them; they should be
+        sent now.
+        """
+        with self.lock:
+            return self._fill()
+
+    def room(self) -> int:
+        """
+        Returns how many more messages would be sent right away rather than
+        queued.
+        """
+        with self.lock:
+            if len(self.queued) > self.head:
+                return 0
+            return max(0, self.max_inflight - len(self.messages))
+
+    def pending(self) -> List[InflightMessage]:
+        """
+        Returns a snapshot of the messages awaiting an ack, for
+        retransmission.
+        """
+        with self.lock:
+            return list(self.messages.values())
+
+    def take_shared(self) -> List[tuple]:
+        """
+        Removes the messages picked for shared subscription groups that the
+        client may not have received yet: those awaiting PUBACK or PUBREC,
+        and queued ones. Returns their (encoded topic, qos, payload, group,
+        seq), for another member of the group to take over.
+        """
+        with self.lock:
+            res = []
+            for packet_id, message in list(self.messages.items()):
+                if message.group is None or message.state != InflightState.PUBLISHED:
+                    continue
+                del self.messages[packet_id]
+                if message.timer is not None:
+                    message.timer.cancel()
+                res.append(
+                    (
+                        message.topic,
+                        message.qos_level,
+                        message.payload,
+                        message.group,
+                        message.seq,
+                    )
+                )
+
+            queued = []
+            for message in self.queued[self.head :]:
+                topic, qos_level, payload, retain, seq, group = message
+                if group is None:
+                    queued.append(message)
+                else:
+                    res.append((topic, qos_level, payload, group, seq))
+            self.queued = queued
+            self.head = 0
+            return res
+
+    def cancel_timers(self):
+        """
+        Cancels every retransmission but keeps the messages, for a session
+        whose client went away and may come back.
+        """
+        with self.lock:
+            for message in self.messages.values():
+                if message.timer is not None:
+                    message.timer.cancel()
+                    message.timer = None
+
+    def clear(self):
+        """
+        Forgets every message, cancelling their retransmissions.
+        """
+        with self.lock:
+            for message in self.messages.values():
+                if message.timer is not None:
+                    message.timer.cancel()
+            self.messages.clear()
+            self.queued.clear()
+            self.head = 0
+
+    def __len__(self):
+        return len(self.messages) + len(self.queued) - self.head
+
+    def _fill(self) -> List[InflightMessage]:
+        n = min(
+            len(self.queued) - self.head, self.max_inflight - len(self.messages)
+        )
+        if n <= 0:
+            return []
+        return [self._admit(*message) for message in self._take(n)]
+
+    def _take(self, n: int) -> List[tuple]:
+        """
+        Removes and returns the `n` oldest queued messages. Their entries are
+        only cut off the list once they make up half of it, so this costs
+        O(n), not O(len(queued)), even on a full queue.
+        """
+        start, end = self.head, self.head + n
+        taken = self.queued[start:end]
+        # Don't hold on to the payloads until then
+        self.queued[start:end] = [None] * n
+        self.head = end
+        self._compact()
+        return taken
+
+    def _compact(self):
+        if self.head * 2 >= len(self.queued):
+            del self.queued[: self.head]
+            self.head = 0
+
+    def _admit(
+        self,
+        topic: bytes,
+        qos_level: QosLevel,
+        payload,
+        retain: bool,
+        seq: int,
+        group=None,
+    ) -> InflightMessage:
+        packet_id = self._next_packet_id()
+        header = serialize_mqtt_publish_header(
+            topic,
+            qos_level,
+            packet_id.to_bytes(2, "big"),
+            len(payload),
+            retain=retain,
+        )
+        message = InflightMessage(
+            packet_id, qos_level, header, payload, seq, topic, group
+        )
+        self.messages[packet_id] = message
+        return message
+
+    def _next_packet_id(self) -> int:
+        # Packet ids are non-zero 16-bit integers; skip the ones in use
+        while True:
+            self.packet_id = self.packet_id % 0xFFFF + 1
+            if self.packet_id not in self.messages:
+                return self.packet_id
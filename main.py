@@ -1,367 +1,801 @@
-from socket import socket
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import resource
+import signal
+import socket
+import sys
+import tempfile
 import threading
 import time
-from typing import Dict, Set, Tuple, List
-from protocol import (
-    MqttConnack,
-    MqttConnect,
-    MqttPublish,
-    MqttPuback,
-    MqttPubrec,
-    MqttPubrel,
-    MqttPubcomp,
-    MqttSubscribe,
-    MqttSuback,
-    MqttPingreq,
-    MqttPingresp,
-    MqttDisconnect,
-    QosLevel,
-    deserialize_mqtt_message,
+from typing import Optional
+from broker import Broker, Connection
+from metrics import Metrics
+from inflight import InflightWindow
+from offline import OfflineBudget, OfflineQueue
+from admission import Admission
+from fanout import FanOut
+from ratelimit import Throttle
+from retained import RetainedStore
+from topics import MatchCache
+from persistence import WriteAheadLog
+from outbound import (
+    OutboundQueue,
+    OverflowPolicy,
+    QueueOverflow,
+    frame_buffers,
+    frame_size,
 )
+from framer import Framer
+from shared import ShareStrategy
+from protocol import deserialize_mqtt_message
 import socketserver
-import uuid
+
+logger = logging.getLogger(__name__)
+
+# Most buffers one sendmsg call takes
+IOV_MAX = os.sysconf("SC_IOV_MAX")
+
+
+def sendmsg_all(sock: socket.socket, buffers: list):
+    """
+    Like `socket.sendall`, but for several buffers written with one
+    scatter-gather `sendmsg` call instead of being joined first.
+    """
+    while len(buffers) > 0:
+        n = sock.sendmsg(buffers)
+
+        # Skip what was sent; the kernel may stop in the middle of a buffer
+        i = 0
+        while i < len(buffers) and n >= len(buffers[i]):
+            n -= len(buffers[i])
+            i += 1
+        del buffers[:i]
+        if n > 0:
+            buffers[0] = memoryview(buffers[0])[n:]
+
+
+class SocketConnection(Connection):
+    """
+    A blocking socket with its own writer thread. Whoever sends to the
+    connection only appends to its outbound queue; the writer is the only
+    thread that blocks on a slow client. The writer is started by the first
+    send and exits after `WRITER_IDLE` seconds without anything to write, so
+    idle clients cost one thread rather than two.
+
+    Unless `coalesce_bytes` is 0, the writer sends whatever accumulated in
+    the queue while it was busy in as few `sendmsg` calls as possible, at
+    most `coalesce_bytes` each; see `Broker.coalesce_bytes`. Bytes written
+    are counted in `metrics`, if given.
+    """
+
+    __slots__ = (
+        "sock",
+        "coalesce_bytes",
+        "coalesce_delay",
+        "metrics",
+        "writes",
+        "cond",
+        "closed",
+        "resume_at",
+        "writer",
+    )
+
+    # Seconds the writer thread waits for frames before it exits
+    WRITER_IDLE = 5.0
+
+    def __init__(
+        self,
+        conn_id: int,
+        sock: socket.socket,
+        queue: OutboundQueue,
+        coalesce_bytes: int = 0,
+        coalesce_delay: float = 0.0,
+        metrics: Optional[Metrics] = None,
+    ):
+        super().__init__(conn_id, queue)
+        self.sock = sock
+        self.coalesce_bytes = coalesce_bytes
+        self.coalesce_delay = coalesce_delay
+        self.metrics = metrics
+
+        # send calls, batched or not
+        self.writes = 0
+
+        # guards `queue` and `closed`
+        self.cond = threading.Condition()
+        self.closed = False
+
+        # When the handler may go on reading from the client, 0 unless
+        # paused; see `pause_reading`
+        self.resume_at = 0.0
+
+        # The writer thread, None while there is none; guarded by `cond`
+        self.writer: Optional[threading.Thread] = None
+
+    def send(self, data, droppable: bool = False):
+        with self.cond:
+            if self.closed:
+                return
+
+            try:
+                self.queue.put(data, droppable)
+            except QueueOverflow as e:
+                logger.warning(
+                    "[%s] Outbound queue overflow, disconnecting: %s", self.conn_id, e
+                )
+            else:
+                self.wake_writer()
+                return
+
+        self.abort()
+
+    def wake_writer(self):
+        """
+        Hands what was queued to the writer, starting one if there is none.
+        Called with `cond` held.
+        """
+        if self.writer is None:
+            self.writer = threading.Thread(target=self.write_loop, daemon=True)
+            self.writer.start()
+        else:
+            self.cond.notify()
+
+    def write_loop(self):
+        while True:
+            with self.cond:
+                while len(self.queue) == 0 and not self.closed:
+                    if not self.cond.wait(self.WRITER_IDLE) and len(self.queue) == 0:
+                        # The next send starts another writer
+                        self.writer = None
+                        return
+                frames = self.queue.take()
+                if self.coalesce_bytes > 0 and self.coalesce_delay > 0:
+                    self.gather(frames)
+
+            if len(frames) == 0:
+                # Closed and nothing left to write
+                self.shutdown()
+                return
+
+            try:
+                if self.coalesce_bytes > 0:
+                    self.write_batch(frames)
+                else:
+                    for frame in frames:
+                        if isinstance(frame, tuple):
+                            sendmsg_all(self.sock, list(frame))
+                        else:
+                            self.sock.sendall(frame)
+                        self.writes += 1
+            except OSError:
+                with self.cond:
+                    self.queue.close()
+                    self.closed = True
+                return
+
+            if self.metrics is not None:
+                self.metrics.counters().bytes_out += sum(
+                    frame_size(frame) for frame in frames
+                )
+
+    def gather(self, frames: list):
+        """
+        Waits up to `coalesce_delay` for more frames while `frames` falls
+        short of `coalesce_bytes`. Called with `cond` held.
+        """
+        size = sum(frame_size(frame) for frame in frames)
+        deadline = time.monotonic() + self.coalesce_delay
+        while size < self.coalesce_bytes and not self.closed:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                return
+            self.cond.wait(timeout)
+            more = self.queue.take()
+            frames.extend(more)
+            size += sum(frame_size(frame) for frame in more)
+
+    def write_batch(self, frames: list):
+        batch = []
+        size = 0
+        for buffer in frame_buffers(frames):
+            batch.append(buffer)
+            size += len(buffer)
+            if size >= self.coalesce_bytes or len(batch) == IOV_MAX:
+                sendmsg_all(self.sock, batch)
+                self.writes += 1
+                batch = []
+                size = 0
+        if len(batch) > 0:
+            sendmsg_all(self.sock, batch)
+            self.writes += 1
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            # The writer shuts the socket down once it wrote what is queued
+            self.wake_writer()
+
+    def pause_reading(self, delay: float):
+        # Only the handler thread reads, and it checks this between reads
+        self.resume_at = max(self.resume_at, time.monotonic() + delay)
+
+    def abort(self):
+        with self.cond:
+            self.queue.close()
+            self.closed = True
+            self.cond.notify()
+        self.shutdown()
+
+    def shutdown(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            # Already closed by the peer
+            pass
 
 
 class Server(socketserver.ThreadingTCPServer):
+    """
+    Thread-per-connection server mode. Simple, but every client costs an OS
+    thread; see `aio.AsyncServer` for the event-loop based mode.
+    """
+
+    daemon_threads = True
+
+    # Pending connections the kernel queues for us; a reconnect storm easily
+    # overflows socketserver's default of 5
+    request_queue_size = 4096
+
     # How to pass argument to server constructor?
     # https://stackoverflow.com/a/14133194/9057530
-    def __init__(self, server_address, RequestHandlerClass):
+    def __init__(self, server_address, RequestHandlerClass, broker=None):
         socketserver.ThreadingTCPServer.__init__(
             self, server_address, RequestHandlerClass
         )
 
-        # maps topic name to client ids
-        self.subscriptions: Dict[str, Set[str]] = {}
-
-        # maps client id to socket
-        self.clients: Dict[str, socket] = {}
-
-        # maps packet-id to subscribers
-        self.at_least_once_messages: Dict[
-            bytes, Tuple[Tuple[MqttPublish, bytes], Set[str]]
-        ] = {}
-
-        # maps packet-id to message
-        self.releasable_exactly_once_messages: Dict[
-            bytes, Tuple[MqttPublish, bytes]
-        ] = {}
-
-        # maps packet-id to a list of (mesage, bytes, subscribers)
-        self.exactly_once_messages: Dict[
-            bytes, List[Tuple[Tuple[MqttPublish, bytes], Set[str]]]
-        ] = {}
-
-        # for debugging
-        self.thread_cnt = 0
+        self.broker = broker if broker is not None else Broker()
+        self.broker.fanout.start_threads()
 
-        threading.Thread(target=self.resend_messages).start()
+        threading.Thread(target=self.run_timers, daemon=True).start()
 
-    def resend_messages(self):
+    def run_timers(self):
+        timers = self.broker.timers
         while True:
-            dels = []
-            for packet_id, (_, subscribers) in self.at_least_once_messages.items():
-                subscribers = subscribers.intersection(self.clients.keys())
-                if len(subscribers) == 0:
-                    dels.append(packet_id)
-
-            for packet_id in dels:
-                del self.at_least_once_messages[packet_id]
-
-            dels = []
-            for packet_id, vs in self.exactly_once_messages.items():
-                noMoreSubscribers = True
-                for (msg, b), subscribers in vs:
-                    subscribers = subscribers.intersection(self.clients.keys())
-                    if len(subscribers) > 0:
-                        noMoreSubscribers = False
-
-                if noMoreSubscribers:
-                    dels.append(packet_id)
-
-            for packet_id in dels:
-                del self.exactly_once_messages[packet_id]
-
-            # At least once messages
-            if len(self.at_least_once_messages) > 0:
-                print("Retransmitting at-least-once messages!")
-
-                # Remove disconnected subscriber if any
-                for packet_id, (
-                    (msg, b),
-                    subscribers,
-                ) in self.at_least_once_messages.items():
-                    print(f"Retransmitting {msg} to {subscribers}")
-                    for subscriber in subscribers:
-                        socket = self.clients[subscriber]
-                        socket.sendall(b)
-
-            # Exactly once messages
-            if len(self.exactly_once_messages) > 0:
-                print("Retransmitting exactly-once messages!")
-
-                # Remove disconnected subscriber if any
-                for packet_id, msgs in self.exactly_once_messages.items():
-                    for (msg, b), subscribers in msgs:
-                        print(f"Retransmitting {msg} to {subscribers}")
-                        for subscriber in subscribers:
-                            socket = self.clients[subscriber]
-                            socket.sendall(b)
-
-            time.sleep(2)
+            timers.advance()
+            time.sleep(timers.tick)
 
     def server_activate(self):
-        print("Server is being activated!")
         super().server_activate()
+        logger.info("Listening on %s:%s", *self.server_address[:2])
+
+    def verify_request(self, request, client_address):
+        # Refused connections are closed before they get a thread
+        return self.broker.admit()
 
     def process_request(self, request, client_address):
-        print(f"Process request {request} from {client_address}")
+        logger.debug("Process request %s from %s", request, client_address)
         super().process_request(request, client_address)
 
 
 class Handler(socketserver.StreamRequestHandler):
+    # Seconds a closing connection gets to write what is queued for it
+    CLOSE_TIMEOUT = 5
+
     def handle(self):
         # How to share variables among handlers?
         # self refers to the handler object and is distinct for each request
         # self.server refers to the server object and is shared among handlers
         # https://stackoverflow.com/a/6875827/9057530
-        print(f"== Client connected ==")
 
-        # Variables used throughout the lifetime of this handler
-        self.client_id = None
-        self.thread_id = self.server.thread_cnt
-        self.server.thread_cnt += 1
+        broker = self.server.broker
+        conn = SocketConnection(
+            broker.next_conn_id(),
+            self.connection,
+            broker.new_outbound_queue(),
+            broker.coalesce_bytes,
+            broker.coalesce_delay,
+            broker.metrics,
+        )
+        broker.await_connect(conn)
 
-        while True:
-            # self.connection is a socket.socket
-            # https://docs.python.org/3/library/socket.html#socket-objects
-            # socket.recv() returns a bytes object
-            data = self.connection.recv(1024)
-            # print(data)
+        try:
+            self.serve(conn)
+        finally:
+            broker.disconnect(conn)
+            conn.close()
+
+            # The socket is closed once this returns; let the writer send
+            # what is queued first, like a CONNACK refusing the client
+            with conn.cond:
+                writer = conn.writer
+            if writer is not None:
+                writer.join(self.CLOSE_TIMEOUT)
 
-            if not data:
-                print(f"[{self.thread_id}] == Client {self.client_id} disconnected ==")
-                break
+    def serve(self, conn: SocketConnection):
+        broker = self.server.broker
+        framer = Framer(max_packet_size=broker.max_packet_size)
 
-            while len(data) > 0:
-                print(data)
+        while True:
+            try:
+                for data in framer.frames():
+                    request, _ = deserialize_mqtt_message(data)
+                    if not broker.handle_message(conn, request, data):
+                        return
+                    if conn.resume_at > 0:
+                        # Over its rate limits; the rest waits in the framer
+                        break
+            except Exception as e:
+                # Malformed or unexpected packets, like aio's handle_frames
+                logger.warning("[%s] Closing connection: %r", conn.conn_id, e)
+                return
+
+            if conn.resume_at > 0:
+                # Meanwhile what the client sends next stays in the socket
+                # buffers, and TCP makes the client wait
+                time.sleep(max(0.0, conn.resume_at - time.monotonic()))
+                conn.resume_at = 0.0
+                continue
 
-                request, bytes_consumed = deserialize_mqtt_message(data)
-                print(
-                    f"[{self.thread_id}] Received: {request} from client: {self.client_id}"
+            # self.connection is a socket.socket
+            # https://docs.python.org/3/library/socket.html#socket-objects
+            # recv_into() reads straight into the framer's buffer
+            try:
+                n = self.connection.recv_into(framer.recv_buffer())
+            except ConnectionResetError:
+                # Reset by the client, e.g. one closing with frames unread
+                # after it was taken over
+                n = 0
+
+            if n == 0:
+                logger.info(
+                    "[%s] Client %s disconnected", conn.conn_id, conn.client_id
                 )
+                return
 
-                match request:
-                    case MqttConnect(
-                        protocol_name,
-                        protocol_level,
-                        connect_flags,
-                        keep_alive,
-                        client_id,
-                    ):
-                        # Todo: validation
-                        print(f"[{self.thread_id}] Client(id='{client_id}') connected")
-
-                        if client_id == "":
-                            # The doc says we have two choices:
-                            # 1. Reject and respond return_code = 0x02
-                            # 2. Assign a unique id to the client
-                            #
-                            # `mqtt test` passes in an empty client id and
-                            # gives up if rejected, so we do #2.
-                            client_id = str(uuid.uuid4())
-                            print(
-                                f"[{self.thread_id}] Received empty client id. Assign an unique id: {client_id}"
-                            )
-
-                        self.client_id = client_id
-                        self.server.clients[client_id] = self.connection
-
-                        connack = MqttConnack(return_code=0)
-                        self.connection.sendall(connack.serialize())
-                        print(f"[{self.thread_id}] CONNACK sent")
-                    case MqttPublish(
-                        dup_flag, qos_level, retain, topic, packet_id, message
-                    ) as mqtt_publish:
-                        if topic not in self.server.subscriptions:
-                            self.server.subscriptions[topic] = set()
-
-                        match qos_level:
-                            case QosLevel.AT_MOST_ONCE:
-                                for client_id in self.server.subscriptions[topic]:
-                                    client_conn = self.server.clients[client_id]
-                                    client_conn.sendall(bytes_consumed)
-                            case QosLevel.AT_LEAST_ONCE:
-                                puback = MqttPuback(packet_id)
-                                self.connection.sendall(puback.serialize())
-                                print(f"[{self.thread_id}] PUBACK sent")
-
-                                for client_id in self.server.subscriptions[topic]:
-                                    client_conn = self.server.clients[client_id]
-                                    client_conn.sendall(bytes_consumed)
-
-                                # Mark message as to be delivered at least once
-                                self.server.at_least_once_messages[packet_id] = (
-                                    (mqtt_publish, bytes_consumed),
-                                    self.server.subscriptions[
-                                        topic
-                                    ].copy(),  # copy() is important here! Python pass by object reference
-                                )
-                            case QosLevel.EXACTLY_ONCE:
-                                puback = MqttPubrec(packet_id)
-                                self.connection.sendall(puback.serialize())
-                                print(f"[{self.thread_id}] PUBACK sent")
-
-                                # Mark message as pending release
-                                self.server.releasable_exactly_once_messages[
-                                    packet_id
-                                ] = (mqtt_publish, bytes_consumed)
-
-                    case MqttPuback(packet_id):
-                        print(
-                            f"[{self.thread_id}] Received PUBACK for {packet_id} from {client_id}"
-                        )
-
-                        if packet_id not in self.server.at_least_once_messages:
-                            # This is possible when we receive PUBACK for the
-                            # same packet_id from a client more than once.
-                            pass
-                        else:
-                            _, subscribers = self.server.at_least_once_messages[
-                                packet_id
-                            ]
-                            subscribers.discard(self.client_id)
-
-                            if len(subscribers) == 0:
-                                print(
-                                    f"[{self.thread_id}] Recevied PUBACK from all subscribers of {packet_id}!"
-                                )
-                                del self.server.at_least_once_messages[packet_id]
-
-                    case MqttPubrec(packet_id):
-                        print(
-                            f"[{self.thread_id}] Received PUBREC for {packet_id} from subscriber {self.client_id}"
-                        )
-
-                        # Send PUBREL
-                        pubrel = MqttPubrel(packet_id)
-                        self.connection.sendall(pubrel.serialize())
-                        print(f"[{self.thread_id}] PUBREL sent")
-                    case MqttPubrel(packet_id):
-                        print(
-                            f"[{self.thread_id}] Received PUBREL for {packet_id} from publisher {self.client_id}"
-                        )
-
-                        if packet_id in self.server.releasable_exactly_once_messages:
-                            # send PUBCOMP
-                            pubcomp = MqttPubcomp(packet_id)
-                            self.connection.sendall(pubcomp.serialize())
-                            print(f"[{self.thread_id}] PUBCOMP sent")
-
-                            mqtt_publish, mqtt_publish_bytes = (
-                                self.server.releasable_exactly_once_messages[packet_id]
-                            )
-
-                            if packet_id not in self.server.exactly_once_messages:
-                                self.server.exactly_once_messages[packet_id] = []
-
-                            current_subscribers = self.server.subscriptions[
-                                mqtt_publish.topic
-                            ].copy()
-
-                            for subscriber in current_subscribers:
-                                self.server.clients[subscriber].sendall(
-                                    mqtt_publish_bytes
-                                )
-
-                            self.server.exactly_once_messages[packet_id].append(
-                                (
-                                    (mqtt_publish, mqtt_publish_bytes),
-                                    current_subscribers,
-                                )
-                            )
-                            del self.server.releasable_exactly_once_messages[packet_id]
-
-                            print(
-                                f"[{self.thread_id}] Exactly once messages to be sent: {self.server.exactly_once_messages}"
-                            )
-
-                    case MqttPubcomp(packet_id):
-                        print(
-                            f"[{self.thread_id}] Received PUBCOMP for {packet_id} from subscriber {self.client_id}"
-                        )
-
-                        if packet_id not in self.server.exactly_once_messages:
-                            # This is possible when we receive PUBCOMP for the
-                            # same packet_id from a client more than once.
-                            pass
-                        else:
-                            messages = self.server.exactly_once_messages[packet_id]
-                            _, subscribers = messages[0]
-                            subscribers.discard(self.client_id)
-
-                            if len(subscribers) == 0:
-                                print(
-                                    f"[{self.thread_id}] Recevied PUBCOMP from all subscribers of {packet_id}!"
-                                )
-                                del messages[0]
-
-                                if len(messages) == 0:
-                                    del self.server.exactly_once_messages[packet_id]
-
-                    case MqttSubscribe(packet_id, topics):
-                        # Check unsupported qos-level
-                        return_codes = []
-                        for topic, qos_level in topics:
-                            # In MQTT, clients can subscribe to a topic before
-                            # any message is published to that topic.
-                            if topic not in self.server.subscriptions:
-                                self.server.subscriptions[topic] = set()
-
-                            self.server.subscriptions[topic].add(self.client_id)
-
-                            print(
-                                f"[{self.thread_id}] Subscribe to {topic}, {qos_level}"
-                            )
-                            return_codes.append(0x00)
-
-                        print(
-                            f"[{self.thread_id}] Subscriptions: {self.server.subscriptions}"
-                        )
-
-                        # Respond SUBACK
-                        suback = MqttSuback(packet_id, return_codes)
-                        self.connection.sendall(suback.serialize())
-                        print(f"[{self.thread_id}] SUBACK sent")
-                    case MqttPingreq():
-                        pingresp = MqttPingresp()
-                        self.connection.sendall(pingresp.serialize())
-                        print(f"[{self.thread_id}] PINGRESP sent")
-                    case MqttDisconnect():
-                        # Remove client
-                        del self.server.clients[self.client_id]
-
-                        for topic, subscribers in self.server.subscriptions.items():
-                            subscribers.discard(self.client_id)
+            framer.advance(n)
 
-                        break
-                    case unknown:
-                        print(f"[{self.thread_id}] Unknown: {unknown}")
-                        raise NotImplementedError
 
-                data = data[len(bytes_consumed) :]
+def raise_fd_limit():
+    """
+    Lifts the soft limit on open files to the hard limit. Every client holds
+    one file descriptor, so the default soft limit (often 1024) caps the
+    number of connections long before memory does.
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
 
-        if self.client_id in self.server.clients:
-            del self.server.clients[self.client_id]
 
-        for topic, subscribers in self.server.subscriptions.items():
-            subscribers.discard(self.client_id)
+def prefix_limit(value: str):
+    """
+    Parses a --prefix-limit, PREFIX:MESSAGES:BYTES.
+    """
+    prefix, message_rate, byte_rate = value.rsplit(":", 2)
+    return prefix, (float(message_rate), float(byte_rate))
 
 
 def main():
+    parser = argparse.ArgumentParser(description="A toy MQTT 3.1.1 broker")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=1883)
+    parser.add_argument(
+        "--mode",
+        choices=["threaded", "asyncio"],
+        default="threaded",
+        help="threaded: one OS thread per client; asyncio: one event loop for all clients",
+    )
+    parser.add_argument(
+        "--max-queue-depth",
+        type=int,
+        default=OutboundQueue.MAX_DEPTH,
+        help="frames buffered per client before the overflow policy applies",
+    )
+    parser.add_argument(
+        "--overflow-policy",
+        choices=[policy.value for policy in OverflowPolicy],
+        default=OverflowPolicy.DROP_QOS0.value,
+    )
+    parser.add_argument(
+        "--spill-dir", default=None, help="where the spill policy writes to"
+    )
+    parser.add_argument(
+        "--max-inflight",
+        type=int,
+        default=InflightWindow.MAX_INFLIGHT,
+        help="unacknowledged QoS 1/2 messages per client; more are queued",
+    )
+    parser.add_argument(
+        "--max-queued",
+        type=int,
+        default=InflightWindow.MAX_QUEUED,
+        help="QoS 1/2 messages queued per client behind the unacknowledged ones; beyond that the oldest is dropped",
+    )
+    parser.add_argument(
+        "--coalesce-bytes",
+        type=int,
+        default=OutboundQueue.COALESCE_BYTES,
+        help="bytes of frames for one client written by one send call; 0 sends every frame on its own",
+    )
+    parser.add_argument(
+        "--coalesce-delay",
+        type=float,
+        default=0.0,
+        help="seconds a write smaller than --coalesce-bytes may wait for more frames",
+    )
+    parser.add_argument(
+        "--offline-memory",
+        type=int,
+        default=OfflineQueue.MAX_MEMORY,
+        help="bytes of messages queued in memory for each offline persistent session; more go to --spill-dir",
+    )
+    parser.add_argument(
+        "--offline-total-memory",
+        type=int,
+        default=OfflineBudget.MAX_MEMORY,
+        help="bytes of messages queued in memory for all offline sessions together",
+    )
+    parser.add_argument(
+        "--offline-spill",
+        type=int,
+        default=OfflineQueue.MAX_SPILL,
+        help="bytes of messages queued on disk for each offline persistent session; beyond that new ones are dropped",
+    )
+    parser.add_argument(
+        "--max-connections",
+        type=int,
+        default=0,
+        help="connected clients; more get a server unavailable CONNACK. 0: no limit",
+    )
+    parser.add_argument(
+        "--accept-rate",
+        type=float,
+        default=0.0,
+        help="connections accepted per second; more are closed right away. 0: no limit",
+    )
+    parser.add_argument(
+        "--accept-burst",
+        type=float,
+        default=None,
+        help="connections accepted at once beyond --accept-rate; as many as --accept-rate by default",
+    )
+    parser.add_argument(
+        "--max-half-open",
+        type=int,
+        default=Admission.MAX_HALF_OPEN,
+        help="connections waiting for their CONNECT; more are closed right away. 0: no limit",
+    )
+    parser.add_argument(
+        "--connect-timeout",
+        type=float,
+        default=Admission.CONNECT_TIMEOUT,
+        help="seconds a connection has to send its CONNECT",
+    )
+    parser.add_argument(
+        "--client-message-rate",
+        type=float,
+        default=0.0,
+        help="messages per second a client may publish; beyond it the broker stops reading from the client for a while. 0: no limit",
+    )
+    parser.add_argument(
+        "--client-byte-rate",
+        type=float,
+        default=0.0,
+        help="bytes per second a client may publish, like --client-message-rate",
+    )
+    parser.add_argument(
+        "--prefix-limit",
+        type=prefix_limit,
+        action="append",
+        default=[],
+        metavar="PREFIX:MESSAGES:BYTES",
+        help="messages and bytes per second all clients together may publish to topics starting with PREFIX; 0: no limit. Repeatable",
+    )
+    parser.add_argument(
+        "--max-packet-size",
+        type=int,
+        default=Framer.MAX_PACKET_SIZE,
+        help="bytes of the largest packet a client may send, 1MB by default and up to 256MB; it is disconnected otherwise",
+    )
+    parser.add_argument(
+        "--fanout-threshold",
+        type=int,
+        default=FanOut.THRESHOLD,
+        help="subscribers from which a message is handed out in chunks, after the publisher's ack; 0 turns this off",
+    )
+    parser.add_argument(
+        "--fanout-chunk-size",
+        type=int,
+        default=FanOut.CHUNK_SIZE,
+        help="subscribers per fan-out chunk",
+    )
+    parser.add_argument(
+        "--fanout-workers",
+        type=int,
+        default=FanOut.WORKERS,
+        help="threads delivering fan-out chunks in the threaded mode",
+    )
+    parser.add_argument(
+        "--retained-memory",
+        type=int,
+        default=RetainedStore.MAX_MEMORY,
+        help="bytes of retained messages kept before the oldest are evicted",
+    )
+    parser.add_argument(
+        "--match-cache-size",
+        type=int,
+        default=MatchCache.MAX_SIZE,
+        help="topics whose subscribers are cached; 0 turns the cache off",
+    )
+    parser.add_argument(
+        "--share-strategy",
+        choices=[strategy.value for strategy in ShareStrategy],
+        default=ShareStrategy.ROUND_ROBIN.value,
+        help="how a shared subscription group picks the member a message goes to",
+    )
+    parser.add_argument(
+        "--sys-interval",
+        type=float,
+        default=Broker.SYS_INTERVAL,
+        help="seconds between updates of the $SYS topics; 0 turns them off",
+    )
+    parser.add_argument(
+        "--data-dir",
+        default=None,
+        help="where persistent sessions and retained messages are stored; kept in memory only if unset",
+    )
+    parser.add_argument(
+        "--commit-interval",
+        type=float,
+        default=WriteAheadLog.COMMIT_INTERVAL,
+        help="seconds between fsyncs of the store; a crash loses at most this much",
+    )
+    parser.add_argument(
+        "--log-level",
+        choices=["DEBUG", "INFO", "WARNING", "ERROR"],
+        default="INFO",
+    )
+    parser.add_argument(
+        "--trace",
+        action="store_true",
+        help="log every packet; slows the broker down considerably",
+    )
+    parser.add_argument(
+        "--trace-sample",
+        type=int,
+        default=1,
+        metavar="N",
+        help="with --trace, only log one packet in N",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="asyncio broker processes sharing the port, for multi-core hosts",
+    )
+    parser.add_argument(
+        "--cluster-port",
+        type=int,
+        default=None,
+        help="port other cluster nodes link to this one on",
+    )
+    parser.add_argument(
+        "--peer",
+        action="append",
+        default=[],
+        metavar="HOST:PORT",
+        help="cluster port of another node to link to; repeatable",
+    )
+    parser.add_argument(
+        "--node-id",
+        default=None,
+        help="unique name of this node in the cluster; HOST:PORT by default",
+    )
+    args = parser.parse_args()
+    if args.workers > 1 and (args.mode != "asyncio" or args.data_dir is not None):
+        parser.error("--workers needs --mode asyncio and no --data-dir")
+    clustered = args.cluster_port is not None or len(args.peer) > 0
+    if args.workers > 1 and clustered:
+        parser.error("--workers can't be combined with --cluster-port or --peer")
+
+    logging.basicConfig(
+        level=args.log_level,
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    )
+    # Per-packet traces are only worth their cost when asked for
+    logging.getLogger("broker.packets").setLevel(
+        logging.DEBUG if args.trace else logging.WARNING
+    )
+
+    raise_fd_limit()
+
+    if args.workers > 1:
+        run_workers(args)
+        return
+
+    broker = make_broker(args)
+    try:
+        match args.mode:
+            case "threaded":
+                serve_threaded(args, broker, clustered)
+            case "asyncio":
+                asyncio.run(serve_asyncio(args, broker, clustered))
+    finally:
+        broker.close()
+
+
+def serve_threaded(args, broker: Broker, clustered: bool):
     socketserver.ThreadingTCPServer.allow_reuse_address = 1
 
-    server = Server(("localhost", 1883), Handler)
-    server.serve_forever()
+    router = None
+    if clustered:
+        # The router gets an event loop of its own
+        loop = asyncio.new_event_loop()
+        threading.Thread(target=loop.run_forever, daemon=True).start()
+        router = asyncio.run_coroutine_threadsafe(
+            start_router(args, broker), loop
+        ).result()
+
+    server = Server((args.host, args.port), Handler, broker)
+    try:
+        server.serve_forever()
+    finally:
+        if router is not None:
+            asyncio.run_coroutine_threadsafe(router.close(), loop).result()
+
+
+async def serve_asyncio(args, broker: Broker, clustered: bool):
+    from aio import AsyncServer
+
+    server = AsyncServer((args.host, args.port), broker)
+    router = None
+    if clustered:
+        router = await start_router(args, broker)
+    try:
+        await server.serve_forever()
+    finally:
+        if router is not None:
+            await router.close()
+
+
+async def start_router(args, broker: Broker):
+    """
+    Links `broker` to the other nodes of its cluster.
+    """
+    from routing import Router
+
+    address = None
+    if args.cluster_port is not None:
+        address = f"{args.host}:{args.cluster_port}"
+    node_id = args.node_id if args.node_id is not None else f"{args.host}:{args.port}"
+
+    router = Router(broker, node_id, address)
+    if args.cluster_port is not None:
+        await router.listen_tcp(args.host, args.cluster_port)
+    for peer in args.peer:
+        router.connect_tcp(peer)
+    return router
+
+
+def make_broker(args) -> Broker:
+    store = None
+    if args.data_dir is not None:
+        store = WriteAheadLog(args.data_dir, commit_interval=args.commit_interval)
+
+    return Broker(
+        max_queue_depth=args.max_queue_depth,
+        overflow_policy=OverflowPolicy(args.overflow_policy),
+        spill_dir=args.spill_dir,
+        coalesce_bytes=args.coalesce_bytes,
+        coalesce_delay=args.coalesce_delay,
+        max_inflight=args.max_inflight,
+        max_queued=args.max_queued,
+        retained_memory=args.retained_memory,
+        store=store,
+        trace_sample=args.trace_sample,
+        share_strategy=ShareStrategy(args.share_strategy),
+        match_cache_size=args.match_cache_size,
+        sys_interval=args.sys_interval,
+        offline_memory=args.offline_memory,
+        offline_total_memory=args.offline_total_memory,
+        offline_spill=args.offline_spill,
+        admission=Admission(
+            args.accept_rate,
+            args.accept_burst,
+            args.max_half_open,
+            args.max_connections,
+            args.connect_timeout,
+        ),
+        throttle=Throttle(
+            args.client_message_rate, args.client_byte_rate, dict(args.prefix_limit)
+        ),
+        max_packet_size=args.max_packet_size,
+        fanout=FanOut(
+            args.fanout_threshold, args.fanout_chunk_size, args.fanout_workers
+        ),
+    )
+
+
+def run_workers(args):
+    """
+    Runs `args.workers` asyncio brokers, one process each, all listening on
+    the same port. The kernel spreads connections over them (SO_REUSEPORT);
+    each worker routes messages to the others over a Unix socket per worker,
+    see routing.py.
+    """
+    with tempfile.TemporaryDirectory(prefix="mqtt-broker-") as bus_dir:
+        workers = [
+            multiprocessing.Process(
+                target=run_worker, args=(args, i, bus_dir), name=f"worker-{i}"
+            )
+            for i in range(args.workers)
+        ]
+        for worker in workers:
+            worker.start()
+
+        # By default SIGTERM ends us on the spot, skipping the finally below
+        # and leaving the workers serving. Set only now: forked workers would
+        # inherit it.
+        signal.signal(signal.SIGTERM, exit_on_signal)
+        try:
+            for worker in workers:
+                worker.join()
+        finally:
+            for worker in workers:
+                worker.terminate()
+            for worker in workers:
+                worker.join()
+
+
+def exit_on_signal(signum, frame):
+    sys.exit(128 + signum)
+
+
+# Seconds between a worker's checks that its parent is still alive
+PARENT_CHECK_INTERVAL = 1.0
+
+
+def run_worker(args, i: int, bus_dir: str):
+    from aio import AsyncServer
+    from routing import Router
+
+    parent = os.getppid()
+
+    async def watch_parent(task: asyncio.Task):
+        # A worker whose parent was killed (SIGKILL, a crash) would keep
+        # serving its share of the port; it goes down with the parent instead
+        while os.getppid() == parent:
+            await asyncio.sleep(PARENT_CHECK_INTERVAL)
+        logger.warning("Parent process is gone, stopping worker-%d", i)
+        task.cancel()
+
+    async def serve():
+        broker = make_broker(args)
+        server = AsyncServer((args.host, args.port), broker, reuse_port=True)
+        router = Router(broker, f"worker-{i}")
+
+        # Every worker listens, and links to the workers started before it
+        await router.listen_unix(os.path.join(bus_dir, f"worker-{i}.sock"))
+        for j in range(i):
+            router.connect_unix(os.path.join(bus_dir, f"worker-{j}.sock"))
+
+        # SIGTERM, from the parent stopping us, shuts down cleanly
+        serving = asyncio.current_task()
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, serving.cancel)
+        watcher = asyncio.create_task(watch_parent(serving))
+        try:
+            await server.serve_forever()
+        finally:
+            watcher.cancel()
+            await router.close()
+            broker.close()
+
+    try:
+        asyncio.run(serve())
+    except (KeyboardInterrupt, asyncio.CancelledError):
+        pass
 
 
 if __name__ == "__main__":
@@ -0,0 +1,208 @@
+"""
+Broker metrics: packet counts and handling latency per packet type, bytes and
+messages in and out, retransmissions, messages over rate limits.
+
+Counting has to be cheap enough to leave on, so every thread bumps counters
+of its own (`Metrics.counters()`) without any lock; only reading them,
+which is rare, merges the counters of all threads. Threads that ended are
+folded into one set of counters so the threaded mode, with its threads per
+client, doesn't keep one set per connection ever made.
+
+Handling latency goes into histograms with power-of-two buckets of
+microseconds, so percentiles are upper bounds, exact within a factor of two.
+"""
+
+from typing import Dict, List, Tuple
+import threading
+import time
+from protocol import MessageType
+
+# Latency buckets: bucket i holds durations below 2**i microseconds, the
+# last one everything slower (about 35 minutes and up)
+BUCKETS = 32
+
+# Packet types are the upper 4 bits of the first byte
+PACKET_TYPES = 16
+
+
+class Counters:
+    """
+    Counters of one thread. Only that thread writes to them.
+    """
+
+    __slots__ = (
+        "packets",
+        "latency",
+        "bytes_in",
+        "bytes_out",
+        "messages_out",
+        "retransmits",
+        "throttled",
+        "dropped",
+    )
+
+    def __init__(self):
+        # packets received and their handling latency, by packet type
+        self.packets = [0] * PACKET_TYPES
+        self.latency = [[0] * BUCKETS for _ in range(PACKET_TYPES)]
+
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+        # messages handed to subscribers, including those queued behind a
+        # full inflight window; retransmissions are counted apart
+        self.messages_out = 0
+        self.retransmits = 0
+
+        # messages received over the publisher's rate limits
+        self.throttled = 0
+
+        # QoS 1/2 messages dropped from the queue behind a full inflight
+        # window
+        self.dropped = 0
+
+    def add(self, other: "Counters"):
+        for i in range(PACKET_TYPES):
+            self.packets[i] += other.packets[i]
+            buckets = self.latency[i]
+            for j, n in enumerate(other.latency[i]):
+                buckets[j] += n
+        self.bytes_in += other.bytes_in
+        self.bytes_out += other.bytes_out
+        self.messages_out += other.messages_out
+        self.retransmits += other.retransmits
+        self.throttled += other.throttled
+        self.dropped += other.dropped
+
+
+def percentile(buckets: List[int], p: float) -> int:
+    """
+    Returns the upper bound in microseconds of the bucket holding the `p`th
+    fraction of the samples.
+    """
+    total = sum(buckets)
+    if total == 0:
+        return 0
+    rank = max(1, round(total * p))
+    seen = 0
+    for i, n in enumerate(buckets):
+        seen += n
+        if seen >= rank:
+            return 1 << i
+    return 1 << (len(buckets) - 1)
+
+
+class Metrics:
+    def __init__(self):
+        self.started = time.monotonic()
+
+        self.local = threading.local()
+
+        # Counters of live threads, with their thread; guarded by `lock`
+        # like `retired`, which sums up those of threads that ended
+        self.lock = threading.Lock()
+        self.threads: List[Tuple[threading.Thread, Counters]] = []
+        self.retired = Counters()
+
+        # Fold the counters of ended threads once this many are registered
+        self.fold_at = 64
+
+    def counters(self) -> Counters:
+        """
+        Returns the counters of the calling thread.
+        """
+        try:
+            return self.local.counters
+        except AttributeError:
+            pass
+
+        counters = self.local.counters = Counters()
+        with self.lock:
+            self.threads.append((threading.current_thread(), counters))
+            if len(self.threads) >= self.fold_at:
+                self._fold()
+                self.fold_at = max(64, 2 * len(self.threads))
+        return counters
+
+    def record(self, packet_type: int, size: int, elapsed_ns: int):
+        """
+        Counts a packet of `size` bytes that took `elapsed_ns` to handle.
+        """
+        counters = self.counters()
+        counters.packets[packet_type] += 1
+        counters.bytes_in += size
+        bucket = min((elapsed_ns // 1000).bit_length(), BUCKETS - 1)
+        counters.latency[packet_type][bucket] += 1
+
+    def total(self) -> Counters:
+        """
+        Returns the sum of the counters of all threads. Counters of threads
+        still running may be a few increments behind.
+        """
+        res = Counters()
+        with self.lock:
+            self._fold()
+            res.add(self.retired)
+            for _, counters in self.threads:
+                res.add(counters)
+        return res
+
+    def snapshot(self) -> dict:
+        counters = self.total()
+        packets = {}
+        for packet_type in MessageType:
+            count = counters.packets[packet_type.value]
+            if count == 0:
+                continue
+            buckets = counters.latency[packet_type.value]
+            packets[packet_type.name.lower()] = {
+                "received": count,
+                "latency_us": {
+                    "p50": percentile(buckets, 0.5),
+                    "p99": percentile(buckets, 0.99),
+                    "p999": percentile(buckets, 0.999),
+                },
+                "histogram": buckets,
+            }
+
+        return {
+            "uptime": int(time.monotonic() - self.started),
+            "bytes": {"received": counters.bytes_in, "sent": counters.bytes_out},
+            "messages": {
+                "received": counters.packets[MessageType.PUBLISH.value],
+                "sent": counters.messages_out,
+                "retransmitted": counters.retransmits,
+                "throttled": counters.throttled,
+                "dropped": counters.dropped,
+            },
+            "packets": packets,
+        }
+
+    def _fold(self):
+        """
+        Moves the counters of threads that ended into `retired`. Called with
+        `lock` held.
+        """
+        live = []
+        for thread, counters in self.threads:
+            if thread.is_alive():
+                live.append((thread, counters))
+            else:
+                self.retired.add(counters)
+        self.threads = live
+
+
+def sys_topics(snapshot: dict, prefix: str = "$SYS/broker") -> Dict[str, str]:
+    """
+    Returns the $SYS topics for a `Broker.metrics_snapshot()` and their
+    values, one number per topic. Histograms are left out.
+    """
+    res = {}
+    for key, value in snapshot.items():
+        topic = f"{prefix}/{key}"
+        match value:
+            case dict():
+                res.update(sys_topics(value, topic))
+            case int() | float():
+                res[topic] = str(value)
+    return res
@@ -0,0 +1,242 @@
+"""
+Messages for persistent sessions whose client is offline.
+
+A client that connected with clean session 0 keeps its subscriptions when
+it goes away, and the QoS 1/2 messages matching them wait in the session's
+`OfflineQueue` until it comes back. Queued messages are held in memory up to
+a budget per session and one shared by all sessions (`OfflineBudget`);
+beyond either, they go to a segment file on disk. Once a message is on disk
+every later one goes there too, so the queue stays in order.
+
+On reconnect the queue is drained in batches that fit the session's inflight
+window, and refilled from as acks free up slots.
+"""
+
+from collections import deque
+from typing import Callable, Deque, List, Optional, Tuple
+import struct
+import tempfile
+import threading
+from protocol import QosLevel
+
+
+class OfflineBudget:
+    """
+    Memory all offline queues of a broker may use together.
+    """
+
+    MAX_MEMORY = 256 * 1024 * 1024
+
+    def __init__(self, max_memory: int = MAX_MEMORY):
+        self.max_memory = max_memory
+        self.used = 0
+        self.lock = threading.Lock()
+
+        # The message queued last, by any session. A publish matching many
+        # offline sessions queues the same message in each of them, and they
+        # share this one tuple instead of holding a copy apiece. Not locked:
+        # losing a race only costs a copy.
+        self.last: Optional[Tuple[bytes, QosLevel, bytes, bool, int]] = None
+
+    def record(
+        self, topic: bytes, qos_level: QosLevel, payload, retain: bool, seq: int
+    ) -> Tuple[bytes, QosLevel, bytes, bool, int]:
+        last = self.last
+        if (
+            last is not None
+            and last[2] is payload
+            and last[0] is topic
+            and last[1] is qos_level
+            and last[3] == retain
+            and last[4] == seq
+        ):
+            return last
+        self.last = (topic, qos_level, payload, retain, seq)
+        return self.last
+
+    def reserve(self, size: int) -> bool:
+        with self.lock:
+            if self.used + size > self.max_memory:
+                return False
+            self.used += size
+            return True
+
+    def release(self, size: int):
+        with self.lock:
+            self.used -= size
+
+
+class OfflineQueue:
+    __slots__ = (
+        "budget",
+        "max_memory",
+        "max_spill",
+        "spill_dir",
+        "messages",
+        "memory",
+        "segment",
+        "segment_read",
+        "segment_write",
+        "segment_depth",
+        "queued",
+        "spilled",
+        "dropped",
+        "on_drop",
+        "lock",
+        "drain_lock",
+    )
+
+    # Bytes of messages one session keeps in memory
+    MAX_MEMORY = 1024 * 1024
+
+    # Bytes of messages one session keeps on disk; later ones are dropped
+    MAX_SPILL = 1024 * 1024 * 1024
+
+    # Rough per-message cost of the tuple and deque slot on top of the topic
+    # and payload
+    OVERHEAD = 120
+
+    # (seq, qos, retain, topic length, payload length) of a message in the
+    # segment file
+    RECORD_HEADER = struct.Struct("!QB?HI")
+
+    def __init__(
+        self,
+        budget: OfflineBudget,
+        max_memory: int = MAX_MEMORY,
+        max_spill: int = MAX_SPILL,
+        spill_dir: Optional[str] = None,
+        on_drop: Optional[Callable[[tuple], None]] = None,
+    ):
+        self.budget = budget
+        self.max_memory = max_memory
+        self.max_spill = max_spill
+        self.spill_dir = spill_dir
+
+        # (encoded topic, qos, payload, retain, seq), oldest first
+        self.messages: Deque[Tuple[bytes, QosLevel, bytes, bool, int]] = deque()
+        self.memory = 0
+
+        self.segment = None
+        self.segment_read = 0
+        self.segment_write = 0
+        self.segment_depth = 0
+
+        # counters
+        self.queued = 0
+        self.spilled = 0
+        self.dropped = 0
+
+        # Told about every message dropped for lack of room on disk: its
+        # (encoded topic, qos, payload, retain, seq). Called with `lock` held.
+        self.on_drop = on_drop
+
+        # Publishers queue from their threads while the owner drains
+        self.lock = threading.Lock()
+
+        # Held while a batch moves on to the inflight window, so that
+        # batches taken by different threads keep their order
+        self.drain_lock = threading.Lock()
+
+    def put(self, topic: bytes, qos_level: QosLevel, payload, retain: bool, seq: int):
+        """
+        Queues a message. `payload` is kept as is unless it goes to disk.
+        """
+        size = len(topic) + len(payload) + self.OVERHEAD
+        with self.lock:
+            self.queued += 1
+            if (
+                self.segment_depth == 0
+                and self.memory + size <= self.max_memory
+                and self.budget.reserve(size)
+            ):
+                self.messages.append(
+                    self.budget.record(topic, qos_level, payload, retain, seq)
+                )
+                self.memory += size
+                return
+
+            size = self.RECORD_HEADER.size + len(topic) + len(payload)
+            if self.segment_write - self.segment_read + size > self.max_spill:
+                self.dropped += 1
+                if self.on_drop is not None:
+                    self.on_drop((topic, qos_level, payload, retain, seq))
+                return
+            self._spill(topic, qos_level, payload, retain, seq)
+
+    def take(self, n: int) -> List[Tuple[bytes, QosLevel, bytes, bool, int]]:
+        """
+        Removes and returns up to `n` of the oldest messages.
+        """
+        res = []
+        with self.lock:
+            while len(res) < n and len(self.messages) > 0:
+                message = self.messages.popleft()
+                res.append(message)
+                size = len(message[0]) + len(message[2]) + self.OVERHEAD
+                self.memory -= size
+                self.budget.release(size)
+
+            if len(res) < n and self.segment_depth > 0:
+                self._unspill(n - len(res), res)
+        return res
+
+    def __len__(self):
+        return len(self.messages) + self.segment_depth
+
+    def stats(self) -> dict:
+        return {
+            "depth": len(self),
+            "memory": self.memory,
+            "queued": self.queued,
+            "spilled": self.spilled,
+            "dropped": self.dropped,
+        }
+
+    def close(self):
+        """
+        Forgets every message.
+        """
+        with self.lock:
+            self.messages.clear()
+            self.budget.release(self.memory)
+            self.memory = 0
+            if self.segment is not None:
+                self.segment.close()
+                self.segment = None
+            self.segment_read = self.segment_write = self.segment_depth = 0
+
+    def _spill(
+        self, topic: bytes, qos_level: QosLevel, payload, retain: bool, seq: int
+    ):
+        if self.segment is None:
+            self.segment = tempfile.TemporaryFile(
+                prefix="mqtt-offline-", dir=self.spill_dir
+            )
+
+        self.segment.seek(self.segment_write)
+        header = self.RECORD_HEADER.pack(
+            seq, qos_level.value, retain, len(topic), len(payload)
+        )
+        self.segment.write(header)
+        self.segment.write(topic)
+        self.segment.write(payload)
+        self.segment_write = self.segment.tell()
+        self.segment_depth += 1
+        self.spilled += 1
+
+    def _unspill(self, n: int, res: list):
+        self.segment.seek(self.segment_read)
+        for _ in range(min(n, self.segment_depth)):
+            header = self.segment.read(self.RECORD_HEADER.size)
+            seq, qos, retain, topic_len, payload_len = self.RECORD_HEADER.unpack(header)
+            topic = self.segment.read(topic_len)
+            payload = self.segment.read(payload_len)
+            res.append((topic, QosLevel(qos), payload, retain, seq))
+            self.segment_depth -= 1
+        self.segment_read = self.segment.tell()
+
+        if self.segment_depth == 0:
+            # Drained; start over at the beginning
+            self.segment.truncate(0)
+            self.segment_read = self.segment_write = 0
@@ -0,0 +1,210 @@
+"""
+Per-connection outbound queues.
+
+Nothing on the receive path writes to a socket directly: frames for a client
+are put on its `OutboundQueue` and a writer dedicated to that connection (a
+thread in the threaded mode, the transport's write readiness in the asyncio
+mode) drains it. A subscriber on a slow link therefore only fills its own
+queue instead of blocking the publisher and every subscriber behind it.
+
+The queue is bounded. What happens when it is full is up to the
+`OverflowPolicy`.
+"""
+
+from enum import Enum
+from typing import List, Optional, Tuple
+import struct
+import tempfile
+
+
+class OverflowPolicy(Enum):
+    # Drop QoS 0 PUBLISHes, newest first; if only frames that can't be
+    # dropped are left, disconnect the client.
+    DROP_QOS0 = "drop_qos0"
+    # Disconnect the client
+    DISCONNECT = "disconnect"
+    # Move frames to a temporary file until the client catches up
+    SPILL = "spill"
+
+
+class QueueOverflow(Exception):
+    pass
+
+
+def frame_size(frame) -> int:
+    if isinstance(frame, tuple):
+        return sum(len(buffer) for buffer in frame)
+    return len(frame)
+
+
+def frame_buffers(frames: List) -> List:
+    """
+    Returns the buffers making up `frames`, in order, for one scatter-gather
+    write.
+    """
+    buffers = []
+    for frame in frames:
+        if isinstance(frame, tuple):
+            buffers.extend(frame)
+        else:
+            buffers.append(frame)
+    return buffers
+
+
+class OutboundQueue:
+    """
+    Bounded FIFO of frames waiting to be written to one connection.
+
+    Not thread-safe: the threaded mode guards it with the connection's
+    condition variable, the asyncio mode only touches it from the loop.
+    """
+
+    __slots__ = (
+        "max_depth",
+        "policy",
+        "spill_dir",
+        "frames",
+        "spill_file",
+        "spill_read",
+        "spill_write",
+        "spill_depth",
+        "dropped",
+        "spilled",
+        "high_watermark",
+    )
+
+    MAX_DEPTH = 1000
+
+    # Bytes of frames written together by one send call, see
+    # `Broker.coalesce_bytes`
+    COALESCE_BYTES = 64 * 1024
+
+    # (droppable, frame length) of a frame in the spill file
+    SPILL_HEADER = struct.Struct("!?I")
+
+    def __init__(
+        self,
+        max_depth: int = MAX_DEPTH,
+        policy: OverflowPolicy = OverflowPolicy.DROP_QOS0,
+        spill_dir: Optional[str] = None,
+    ):
+        self.max_depth = max_depth
+        self.policy = policy
+        self.spill_dir = spill_dir
+
+        # (frame, droppable). A frame is a buffer or a tuple of buffers.
+        # A list rather than a deque: it is drained all at once, and an
+        # empty one costs a tenth of an empty deque on every idle connection.
+        self.frames: List[Tuple[bytes, bool]] = []
+
+        self.spill_file = None
+        self.spill_read = 0
+        self.spill_write = 0
+        self.spill_depth = 0
+
+        # counters
+        self.dropped = 0
+        self.spilled = 0
+        self.high_watermark = 0
+
+    def put(self, frame: bytes, droppable: bool = False):
+        """
+        Queues `frame`. `droppable` marks QoS 0 PUBLISHes, which the
+        DROP_QOS0 policy may discard.
+
+        Raises QueueOverflow when the client should be disconnected.
+        """
+        if self.spill_depth > 0:
+            # Keep the order: once frames are on disk, new ones go there too
+            self._spill(frame, droppable)
+            return
+
+        if len(self.frames) >= self.max_depth:
+            match self.policy:
+                case OverflowPolicy.DROP_QOS0:
+                    if droppable:
+                        self.dropped += 1
+                        return
+                    if not self._drop_one():
+                        raise QueueOverflow(f"{len(self.frames)} frames queued")
+                case OverflowPolicy.DISCONNECT:
+                    raise QueueOverflow(f"{len(self.frames)} frames queued")
+                case OverflowPolicy.SPILL:
+                    self._spill(frame, droppable)
+                    return
+
+        self.frames.append((frame, droppable))
+        if len(self.frames) > self.high_watermark:
+            self.high_watermark = len(self.frames)
+
+    def take(self) -> List[bytes]:
+        """
+        Removes and returns every frame held in memory, refilling from the
+        spill file if there is one.
+        """
+        frames = [frame for frame, _ in self.frames]
+        self.frames.clear()
+
+        if self.spill_depth > 0:
+            self._unspill()
+
+        return frames
+
+    def __len__(self):
+        return len(self.frames) + self.spill_depth
+
+    def stats(self) -> dict:
+        return {
+            "depth": len(self),
+            "high_watermark": self.high_watermark,
+            "dropped": self.dropped,
+            "spilled": self.spilled,
+        }
+
+    def close(self):
+        self.frames.clear()
+        if self.spill_file is not None:
+            self.spill_file.close()
+            self.spill_file = None
+        self.spill_depth = 0
+
+    def _drop_one(self) -> bool:
+        """
+        Drops the newest droppable frame. Returns False if there is none.
+        """
+        for i in range(len(self.frames) - 1, -1, -1):
+            if self.frames[i][1]:
+                del self.frames[i]
+                self.dropped += 1
+                return True
+        return False
+
+    def _spill(self, frame, droppable: bool):
+        if isinstance(frame, tuple):
+            frame = b"".join(frame)
+
+        if self.spill_file is None:
+            self.spill_file = tempfile.TemporaryFile(
+                prefix="mqtt-spill-", dir=self.spill_dir
+            )
+
+        self.spill_file.seek(self.spill_write)
+        self.spill_file.write(self.SPILL_HEADER.pack(droppable, len(frame)))
+        self.spill_file.write(frame)
+        self.spill_write = self.spill_file.tell()
+        self.spill_depth += 1
+        self.spilled += 1
+
+    def _unspill(self):
+        self.spill_file.seek(self.spill_read)
+        while self.spill_depth > 0 and len(self.frames) < self.max_depth:
+            header = self.spill_file.read(self.SPILL_HEADER.size)
+            droppable, length = self.SPILL_HEADER.unpack(header)
+            self.frames.append((self.spill_file.read(length), droppable))
+            self.spill_depth -= 1
+        self.spill_read = self.spill_file.tell()
+
+        if self.spill_depth == 0:
+            # Everything is back in memory; start over at the beginning
+            self.spill_file.truncate(0)
+            self.spill_read = self.spill_write = 0
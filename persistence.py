@@ -0,0 +1,481 @@
+"""
+Durable sessions, MQTT 3.1.1 section 3.1.2.4.
+
+A client that connects with clean_session=0 expects its subscriptions and
+unacknowledged QoS 1/2 messages to survive a disconnect, and a broker that
+persists them lets them survive a restart too. `WriteAheadLog` records every
+change to that state as an append-only log:
+
+- Records are appended to an in-memory batch. A background thread writes the
+  batch and fsyncs it every `commit_interval` seconds (group commit), so the
+  cost of an fsync is shared by every message of the interval. A crash loses
+  at most the last interval.
+- The log is split into segments of about `segment_size` bytes. Compaction
+  folds the closed segments into a snapshot of the live state and deletes
+  them, so the log grows with the state, not with the traffic.
+- On startup the latest snapshot and the segments written after it are
+  memory-mapped and replayed into a `StoredState`.
+
+Only clean_session=0 sessions and retained messages are logged; clean
+sessions die with their connection anyway.
+"""
+
+from enum import IntEnum
+from typing import Dict, Iterator, List, Optional, Tuple
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+
+class RecordType(IntEnum):
+    # Each type is followed by the fields its records carry
+    SESSION = 1  # client id
+    DROP_SESSION = 2  # client id
+    SUBSCRIBE = 3  # client id, topic filter, qos
+    UNSUBSCRIBE = 4  # client id, topic filter
+    ENQUEUE = 5  # client id, seq, qos, retain, encoded topic, payload
+    RELEASE = 6  # client id, seq, packet id
+    ACK = 7  # client id, seq
+    INCOMING = 8  # client id, packet id, retain, topic, payload
+    INCOMING_DONE = 9  # client id, packet id
+    RETAIN = 10  # qos, topic, payload
+
+
+# Field encodings: s = utf-8 string, b = bytes, B/H/Q = unsigned integers of
+# 1/2/8 bytes
+SCHEMAS = {
+    RecordType.SESSION: "s",
+    RecordType.DROP_SESSION: "s",
+    RecordType.SUBSCRIBE: "ssB",
+    RecordType.UNSUBSCRIBE: "ss",
+    RecordType.ENQUEUE: "sQBBbb",
+    RecordType.RELEASE: "sQH",
+    RecordType.ACK: "sQ",
+    RecordType.INCOMING: "sHBsb",
+    RecordType.INCOMING_DONE: "sH",
+    RecordType.RETAIN: "Bsb",
+}
+
+# (crc32 of the rest of the record, body length, type)
+HEADER = struct.Struct("!IIB")
+U16 = struct.Struct("!H")
+U32 = struct.Struct("!I")
+U64 = struct.Struct("!Q")
+
+
+def encode_record(kind: RecordType, *fields) -> bytes:
+    parts = []
+    for code, value in zip(SCHEMAS[kind], fields):
+        match code:
+            case "s":
+                data = value.encode("utf-8")
+                parts.append(U16.pack(len(data)))
+                parts.append(data)
+            case "b":
+                parts.append(U32.pack(len(value)))
+                parts.append(value)
+            case "B":
+                parts.append(bytes((value,)))
+            case "H":
+                parts.append(U16.pack(value))
+            case "Q":
+                parts.append(U64.pack(value))
+
+    body = b"".join(parts)
+    crc = zlib.crc32(body, zlib.crc32(HEADER.pack(0, len(body), kind)[4:]))
+    return HEADER.pack(crc, len(body), kind) + body
+
+
+def decode_records(data) -> Iterator[Tuple[RecordType, list]]:
+    """
+    Yields (type, fields) of every record in `data`. Stops at the first
+    truncated or corrupt record: the tail of a segment the broker crashed
+    while writing.
+    """
+    view = memoryview(data)
+    pos = 0
+    while pos + HEADER.size <= len(view):
+        crc, length, kind = HEADER.unpack_from(view, pos)
+        start = pos + HEADER.size
+        end = start + length
+        if end > len(view) or kind not in SCHEMAS:
+            return
+        body = view[start:end]
+        if zlib.crc32(body, zlib.crc32(view[pos + 4 : start])) != crc:
+            return
+
+        yield RecordType(kind), _decode_fields(SCHEMAS[kind], body)
+        pos = end
+
+
+def _decode_fields(schema: str, body: memoryview) -> list:
+    fields = []
+    pos = 0
+    for code in schema:
+        match code:
+            case "s":
+                (n,) = U16.unpack_from(body, pos)
+                pos += U16.size
+                fields.append(str(body[pos : pos + n], "utf-8"))
+                pos += n
+            case "b":
+                (n,) = U32.unpack_from(body, pos)
+                pos += U32.size
+                fields.append(bytes(body[pos : pos + n]))
+                pos += n
+            case "B":
+                fields.append(body[pos])
+                pos += 1
+            case "H":
+                fields.append(U16.unpack_from(body, pos)[0])
+                pos += U16.size
+            case "Q":
+                fields.append(U64.unpack_from(body, pos)[0])
+                pos += U64.size
+    return fields
+
+
+class StoredMessage:
+    __slots__ = ("qos_level", "retain", "topic", "payload", "packet_id")
+
+    def __init__(self, qos_level: int, retain: bool, topic: bytes, payload: bytes):
+        self.qos_level = qos_level
+        self.retain = retain
+        # Encoded as in a PUBLISH, see `protocol.encode_topic`
+        self.topic = topic
+        self.payload = payload
+        # Set once the client sent PUBREC: only the PUBREL is left to send
+        self.packet_id: Optional[int] = None
+
+
+class StoredSession:
+    __slots__ = ("subscriptions", "messages", "incoming")
+
+    def __init__(self):
+        # maps topic filter to qos
+        self.subscriptions: Dict[str, int] = {}
+        # maps seq to message, for messages sent to the client and not acked
+        self.messages: Dict[int, StoredMessage] = {}
+        # maps packet id to (topic, payload, retain), for QoS 2 messages
+        # received from the client and not released yet
+        self.incoming: Dict[int, Tuple[str, bytes, bool]] = {}
+
+
+class StoredState:
+    """
+    The state a log describes, built by applying its records in order.
+    """
+
+    def __init__(self):
+        self.sessions: Dict[str, StoredSession] = {}
+        # maps topic to (qos, payload)
+        self.retained: Dict[str, Tuple[int, bytes]] = {}
+
+    def apply(self, kind: RecordType, fields: list):
+        if kind == RecordType.RETAIN:
+            qos_level, topic, payload = fields
+            if len(payload) == 0:
+                self.retained.pop(topic, None)
+            else:
+                self.retained[topic] = (qos_level, payload)
+            return
+
+        client_id = fields[0]
+        if kind == RecordType.SESSION:
+            self.sessions.setdefault(client_id, StoredSession())
+            return
+        if kind == RecordType.DROP_SESSION:
+            self.sessions.pop(client_id, None)
+            return
+
+        session = self.sessions.get(client_id)
+        if session is None:
+            return
+
+        match kind:
+            case RecordType.SUBSCRIBE:
+                session.subscriptions[fields[1]] = fields[2]
+            case RecordType.UNSUBSCRIBE:
+                session.subscriptions.pop(fields[1], None)
+            case RecordType.ENQUEUE:
+                _, seq, qos_level, retain, topic, payload = fields
+                session.messages[seq] = StoredMessage(
+                    qos_level, bool(retain), topic, payload
+                )
+            case RecordType.RELEASE:
+                message = session.messages.get(fields[1])
+                if message is not None:
+                    message.packet_id = fields[2]
+                    # The payload won't be sent again
+                    message.payload = b""
+            case RecordType.ACK:
+                session.messages.pop(fields[1], None)
+            case RecordType.INCOMING:
+                _, packet_id, retain, topic, payload = fields
+                session.incoming[packet_id] = (topic, payload, bool(retain))
+            case RecordType.INCOMING_DONE:
+                session.incoming.pop(fields[1], None)
+
+    def records(self) -> Iterator[bytes]:
+        """
+        Yields records that rebuild this state from scratch.
+        """
+        for topic, (qos_level, payload) in self.retained.items():
+            yield encode_record(RecordType.RETAIN, qos_level, topic, payload)
+
+        for client_id, session in self.sessions.items():
+            yield encode_record(RecordType.SESSION, client_id)
+            for topic_filter, qos_level in session.subscriptions.items():
+                yield encode_record(
+                    RecordType.SUBSCRIBE, client_id, topic_filter, qos_level
+                )
+            for seq, message in session.messages.items():
+                yield encode_record(
+                    RecordType.ENQUEUE,
+                    client_id,
+                    seq,
+                    message.qos_level,
+                    message.retain,
+                    message.topic,
+                    message.payload,
+                )
+                if message.packet_id is not None:
+                    yield encode_record(
+                        RecordType.RELEASE, client_id, seq, message.packet_id
+                    )
+            for packet_id, (topic, payload, retain) in session.incoming.items():
+                yield encode_record(
+                    RecordType.INCOMING, client_id, packet_id, retain, topic, payload
+                )
+
+
+class WriteAheadLog:
+    """
+    Segmented append-only log in `directory`.
+
+    Files are named `segment-<n>.log` and `snapshot-<n>.log`; a snapshot
+    replaces every segment numbered up to its own number.
+    """
+
+    # Seconds between group commits
+    COMMIT_INTERVAL = 0.01
+
+    SEGMENT_SIZE = 64 * 1024 * 1024
+
+    # Seconds between compactions
+    COMPACT_INTERVAL = 300
+
+    def __init__(
+        self,
+        directory: str,
+        commit_interval: float = COMMIT_INTERVAL,
+        segment_size: int = SEGMENT_SIZE,
+        compact_interval: float = COMPACT_INTERVAL,
+    ):
+        self.directory = directory
+        self.commit_interval = commit_interval
+        self.segment_size = segment_size
+        self.compact_interval = compact_interval
+
+        os.makedirs(directory, exist_ok=True)
+
+        # Records appended since the last commit. Guarded by `lock`, which is
+        # only ever held to swap the list, never during I/O.
+        self.batch: List[bytes] = []
+        self.lock = threading.Lock()
+
+        # Serializes commits, segment rolls and compactions
+        self.io_lock = threading.Lock()
+
+        self.file = None
+        self.segment = 0
+        self.segment_bytes = 0
+
+        self.closed = threading.Event()
+        self.thread: Optional[threading.Thread] = None
+
+        # counters
+        self.appended = 0
+        self.commits = 0
+        self.compactions = 0
+
+    def replay(self) -> StoredState:
+        """
+        Rebuilds the state recorded in the directory. Call before `start()`.
+        """
+        state = StoredState()
+        snapshot, segments = self._files()
+        paths = []
+        if snapshot is not None:
+            paths.append(self._path("snapshot", snapshot))
+        paths.extend(self._path("segment", n) for n in segments)
+
+        for path in paths:
+            for kind, fields in self._read(path):
+                state.apply(kind, fields)
+
+        if len(segments) > 0:
+            self.segment = segments[-1]
+        elif snapshot is not None:
+            self.segment = snapshot
+        return state
+
+    def start(self):
+        """
+        Opens a new segment and starts committing in the background.
+        """
+        self._roll()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def append(self, kind: RecordType, *fields):
+        """
+        Adds a record to the next commit. Never blocks on I/O.
+        """
+        record = encode_record(kind, *fields)
+        with self.lock:
+            self.batch.append(record)
+            self.appended += 1
+
+    def run(self):
+        last_compaction = time.monotonic()
+        while not self.closed.wait(self.commit_interval):
+            self.commit()
+            if time.monotonic() - last_compaction >= self.compact_interval:
+                self.compact()
+                last_compaction = time.monotonic()
+
+    def commit(self):
+        """
+        Writes and fsyncs every record appended so far.
+        """
+        with self.lock:
+            batch, self.batch = self.batch, []
+        if len(batch) == 0:
+            return
+
+        with self.io_lock:
+            data = b"".join(batch)
+            self.file.write(data)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.segment_bytes += len(data)
+            self.commits += 1
+
+            if self.segment_bytes >= self.segment_size:
+                self._roll()
+
+    def compact(self):
+        """
+        Folds every closed segment into a new snapshot.
+        """
+        with self.io_lock:
+            snapshot, segments = self._files()
+            closed = [n for n in segments if n < self.segment]
+            if len(closed) == 0:
+                return
+
+            state = StoredState()
+            paths = []
+            if snapshot is not None:
+                paths.append(self._path("snapshot", snapshot))
+            paths.extend(self._path("segment", n) for n in closed)
+            for path in paths:
+                for kind, fields in self._read(path):
+                    state.apply(kind, fields)
+
+            # Written aside and renamed into place, so a crash leaves either
+            # the old files or the complete snapshot
+            path = self._path("snapshot", closed[-1])
+            with open(path + ".tmp", "wb") as f:
+                for record in state.records():
+                    f.write(record)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path + ".tmp", path)
+            self._sync_directory()
+
+            # Everything up to it is covered by the snapshot now, including
+            # files a crash in the middle of an earlier compaction left behind
+            for name in os.listdir(self.directory):
+                kind, _, rest = name.partition("-")
+                if not rest.endswith(".log"):
+                    continue
+                n = int(rest[:-4])
+                if (kind == "segment" and n <= closed[-1]) or (
+                    kind == "snapshot" and n < closed[-1]
+                ):
+                    os.remove(os.path.join(self.directory, name))
+            self.compactions += 1
+
+    def close(self):
+        """
+        Stops the background thread and commits what is left.
+        """
+        self.closed.set()
+        if self.thread is not None:
+            self.thread.join()
+        if self.file is not None:
+            self.commit()
+            self.file.close()
+            self.file = None
+
+    def stats(self) -> dict:
+        return {
+            "appended": self.appended,
+            "commits": self.commits,
+            "compactions": self.compactions,
+            "segment": self.segment,
+        }
+
+    def _roll(self):
+        if self.file is not None:
+            self.file.close()
+        self.segment += 1
+        self.file = open(self._path("segment", self.segment), "ab")
+        self.segment_bytes = 0
+        self._sync_directory()
+
+    def _files(self) -> Tuple[Optional[int], List[int]]:
+        """
+        Returns the number of the latest snapshot and the numbers of the
+        segments written after it, in order.
+        """
+        snapshots = []
+        segments = []
+        for name in os.listdir(self.directory):
+            kind, _, rest = name.partition("-")
+            if not rest.endswith(".log"):
+                continue
+            if kind == "snapshot":
+                snapshots.append(int(rest[:-4]))
+            elif kind == "segment":
+                segments.append(int(rest[:-4]))
+
+        snapshot = max(snapshots) if len(snapshots) > 0 else None
+        if snapshot is not None:
+            segments = [n for n in segments if n > snapshot]
+        return snapshot, sorted(segments)
+
+    def _path(self, kind: str, n: int) -> str:
+        return os.path.join(self.directory, f"{kind}-{n:08d}.log")
+
+    @staticmethod
+    def _read(path: str) -> Iterator[Tuple[RecordType, list]]:
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                # Fields are copied out, so the map can go away after this
+                yield from decode_records(data)
+
+    def _sync_directory(self):
+        # Makes file creations and renames durable
+        fd = os.open(self.directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
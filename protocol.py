@@ -1,9 +1,3 @@
-from dataclasses import dataclass
-from decoder import Decoder
-from encoder import Encoder
-from enum import Enum
-from typing import List, Tuple
-
 """
 Message = | Fixed header | Variable header (optional) | Payload (optional)
 
@@ -15,8 +9,19 @@ Fixed header
 | Byte 2 |                               |
 |  ...   |      Remaining Length         |
 
+`deserialize_mqtt_message` reads the fixed header once and looks the first
+byte up in `DESERIALIZERS`; the per-type functions only decode what follows
+it, between `start` and `end`. Frames that never change (PINGRESP) or only
+depend on a packet id (the acks) are built once and reused.
 """
 
+from dataclasses import dataclass
+from decoder import Decoder
+from encoder import encode_varint
+from enum import Enum
+from typing import Callable, Dict, List, Optional, Tuple
+import struct
+
 
 class MessageType(Enum):
     CONNECT = 1
@@ -41,7 +46,20 @@ class QosLevel(Enum):
     EXACTLY_ONCE = 2
 
 
-@dataclass
+# Indexed by the QoS bits of a PUBLISH; 3 is reserved
+QOS_LEVELS = (QosLevel.AT_MOST_ONCE, QosLevel.AT_LEAST_ONCE, QosLevel.EXACTLY_ONCE)
+
+# Fixed headers of PUBLISHes with a one-byte remaining length, indexed by
+# flags and remaining length
+SHORT_FIXED_HEADERS = [
+    [bytes((0x30 | flags, remaining_len)) for remaining_len in range(0x80)]
+    for flags in range(16)
+]
+
+U16 = struct.Struct("!H")
+
+
+@dataclass(slots=True)
 class MqttConnect:
     protocol_name: str
     protocol_level: int
@@ -49,24 +67,24 @@ class MqttConnect:
     keep_alive: int
     client_id: str
 
-    def __repr__(self):
-        return f"{self.__class__.__name__}{str(self.__dict__)}"
-
+    def serialize(self) -> bytes:
+        # Clients send this one; the broker only needs it for testing and
+        # benchmarking
+        body = b"".join(
+            (
+                encode_topic(self.protocol_name),
+                bytes((self.protocol_level, self.connect_flags)),
+                U16.pack(self.keep_alive),
+                encode_topic(self.client_id),
+            )
+        )
+        return b"\x10" + encode_varint(len(body)) + body
 
-def deserialize_mqtt_connect(data):
-    """
-    Returns (message, bytes_used)
-    """
-    decoder = Decoder(data)
 
-    # Fixed header: MQTT type; Flags; Remaining length
-    # Flags shoudl all be zero
-    # Remaining length includes variable header and payload
-    b = decoder.byte()
-    mqtt_type = b >> 4
-    assert MessageType(mqtt_type) == MessageType.CONNECT
-    remaining_length = decoder.varint()
-    num_bytes_consumed = decoder.num_bytes_consumed()
+def deserialize_mqtt_connect(data, first_byte: int, start: int, end: int):
+    # Flags should all be zero. Remaining length includes variable header
+    # and payload.
+    decoder = Decoder(data, start)
 
     # Variable header
     protocol_name = decoder.string()
@@ -76,270 +94,246 @@ def deserialize_mqtt_connect(data):
 
     # payload
     client_id = decoder.string()
-    assert (decoder.num_bytes_consumed() - num_bytes_consumed) == remaining_length
+    if decoder.num_bytes_consumed() != end:
+        raise ValueError("malformed CONNECT")
 
-    return (
-        MqttConnect(
-            protocol_name, protocol_level, connect_flags, keep_alive, client_id
-        ),
-        decoder.bytes_consumed(),
+    return MqttConnect(
+        protocol_name, protocol_level, connect_flags, keep_alive, client_id
     )
 
 
-@dataclass
+@dataclass(slots=True)
 class MqttConnack:
     return_code: int
+    # Whether the broker resumed a stored session, MQTT 3.1.1 section 3.2.2.2
+    session_present: bool = False
 
     def serialize(self) -> bytes:
-        encoder = Encoder()
-
         # Fixed header
         # byte 1: \0x20. Packet type | flags
         # byte 2: Remaining length 2
-        encoder.append_byte(0x20)
-        encoder.append_varint(2)
-
         # variable header:
-        # byte 1: \x00. connect ack flags and session present flag
+        # byte 1: connect ack flags and session present flag
         # byte 2: connect return code
-        encoder.append_byte(0x00)
-        encoder.append_byte(self.return_code)
+        return bytes((0x20, 2, self.session_present, self.return_code))
 
-        return encoder.bytes()
 
-
-@dataclass
+@dataclass(slots=True)
 class MqttPublish:
     dup_flag: bool
     qos_level: QosLevel
     retain: bool
     topic: str
     packet_id: bytes  # 2 bytes; only present when qos is 1 or 2
-    message: str
+    # A view into the frame the message came in, forwarded as is. Only
+    # `text()` decodes it, for whoever needs it as a string.
+    payload: memoryview
 
+    def text(self, errors: str = "strict") -> str:
+        return str(self.payload, "utf-8", errors)
 
-def deserialize_mqtt_publish(data):
-    decoder = Decoder(data)
+    def __repr__(self):
+        return (
+            f"MqttPublish(dup_flag={self.dup_flag}, qos_level={self.qos_level}, "
+            f"retain={self.retain}, topic={self.topic!r}, "
+            f"packet_id={self.packet_id!r}, payload=<{len(self.payload)} bytes>)"
+        )
 
-    # Fixed header
-    b = decoder.byte()
-    mqtt_type = b >> 4
-    assert MessageType(mqtt_type) == MessageType.PUBLISH
 
-    dup_flag = ((b & 0x08)) > 0
-    qos_level = QosLevel((b & 0x06) >> 1)
-    retain = b & 0x01 > 0
-    remaining_len = decoder.varint()
-    num_bytes_consumed = decoder.num_bytes_consumed()
+def deserialize_mqtt_publish(data, first_byte: int, start: int, end: int):
+    qos_bits = (first_byte & 0x06) >> 1
+    if qos_bits == 3:
+        raise ValueError("malformed PUBLISH: QoS 3")
+    qos_level = QOS_LEVELS[qos_bits]
 
     # Variable header
-    topic = decoder.string()
-    if qos_level == QosLevel.AT_LEAST_ONCE or qos_level == QosLevel.EXACTLY_ONCE:
-        packet_id = decoder.bytes(2)
+    (topic_len,) = U16.unpack_from(data, start)
+    pos = start + 2 + topic_len
+    topic = str(data[start + 2 : pos], "utf-8")
+    if qos_bits != 0:
+        packet_id = bytes(data[pos : pos + 2])
+        pos += 2
     else:
         packet_id = None
-
-    # payload
-    message_length = remaining_len - (decoder.num_bytes_consumed() - num_bytes_consumed)
-    message = decoder.bytes(message_length).decode("utf-8")
-
-    return (
-        MqttPublish(dup_flag, qos_level, retain, topic, packet_id, message),
-        decoder.bytes_consumed(),
+    if pos > end:
+        raise ValueError("malformed PUBLISH")
+
+    # payload, sliced without copying whether `data` is bytes or a view
+    payload = memoryview(data)[pos:end]
+
+    return MqttPublish(
+        first_byte & 0x08 != 0,
+        qos_level,
+        first_byte & 0x01 != 0,
+        topic,
+        packet_id,
+        payload,
     )
 
 
-@dataclass
-class MqttPuback:
-    packet_id: bytes  # 2 byte
+def encode_topic(topic: str) -> bytes:
+    """
+    Returns `topic` as a length-prefixed UTF-8 string, ready to be passed to
+    `serialize_mqtt_publish_header`.
+    """
+    data = topic.encode("utf-8")
+    return U16.pack(len(data)) + data
+
+
+def serialize_mqtt_publish_header(
+    topic: bytes,
+    qos_level: QosLevel,
+    packet_id: bytes,
+    payload_len: int,
+    dup_flag: bool = False,
+    retain: bool = False,
+) -> bytes:
+    """
+    Returns the fixed and variable header of a PUBLISH, without the payload.
 
-    def serialize(self):
-        encoder = Encoder()
+    Fan-out builds one of these per subscriber and sends it together with
+    the payload shared by all subscribers, so `topic` is taken already
+    encoded (see `encode_topic`).
+    """
+    # This runs once per subscriber: no enum attribute lookups or hashing
+    # (both run Python code), and the fixed header of small messages comes
+    # ready-made.
+    qos_bits = qos_level._value_ << 1
+    flags = qos_bits | dup_flag << 3 | retain
+    if qos_bits == 0:
+        packet_id = b""
+
+    remaining_len = len(topic) + len(packet_id) + payload_len
+    if remaining_len < 0x80:
+        return SHORT_FIXED_HEADERS[flags][remaining_len] + topic + packet_id
+    return b"".join(
+        (bytes((0x30 | flags,)), encode_varint(remaining_len), topic, packet_id)
+    )
 
-        # fixed header
-        # byte1: 0x40
-        # byte2: remaining length 2
-        encoder.append_byte(0x40)
-        encoder.append_varint(2)
 
-        # variable header
-        encoder.append_bytes(self.packet_id)
+def set_dup_flag(header: bytes) -> bytes:
+    """
+    Returns a PUBLISH header marked as a redelivery.
+    """
+    return bytes([header[0] | 0x08]) + header[1:]
 
-        # no payload
 
-        return encoder.bytes()
+class Ack:
+    """
+    Base of the packets made of a fixed header and a packet id: PUBACK,
+    PUBREC, PUBREL, PUBCOMP and UNSUBACK. A frame only depends on the packet
+    id, so each one is built once and then reused.
+    """
 
+    __slots__ = ()
+
+    # First byte of the frame
+    FIRST_BYTE = 0
+
+    # Frames by packet id. Each subclass has its own; emptied once it holds
+    # this many, so it stays small for clients that use the whole id space.
+    FRAMES: Dict[bytes, bytes] = {}
+    MAX_FRAMES = 4096
+
+    @classmethod
+    def frame(cls, packet_id: bytes) -> bytes:
+        """
+        Returns the frame for `packet_id`, without building a message. The
+        broker sends its acks this way.
+        """
+        frames = cls.FRAMES
+        frame = frames.get(packet_id)
+        if frame is None:
+            if len(frames) >= cls.MAX_FRAMES:
+                frames.clear()
+            frame = frames[packet_id] = bytes((cls.FIRST_BYTE, 2)) + packet_id
+        return frame
 
-def deserialize_mqtt_puback(data):
-    decoder = Decoder(data)
+    def serialize(self) -> bytes:
+        return self.frame(self.packet_id)
 
-    # fixed header
-    b = decoder.byte()
-    mqtt_byte = b >> 4
-    assert MessageType(mqtt_byte) == MessageType.PUBACK
 
-    remaining_len = decoder.varint()
-    assert remaining_len == 2
+def deserialize_ack(cls):
+    """
+    Returns the deserializer of an `Ack` subclass.
+    """
 
-    # variable header
-    packet_id = decoder.bytes(2)
+    def deserialize(data, first_byte: int, start: int, end: int):
+        if end - start != 2:
+            raise ValueError(f"malformed {cls.__name__}")
+        return cls(bytes(data[start:end]))
 
-    return MqttPuback(packet_id), decoder.bytes_consumed()
+    return deserialize
 
 
-@dataclass
-class MqttPubrec:
+@dataclass(slots=True)
+class MqttPuback(Ack):
     packet_id: bytes  # 2 byte
 
-    def serialize(self):
-        encoder = Encoder()
-
-        # fixed header
-        # byte1: 0x50
-        # byte2: remaining length 2
-        encoder.append_byte(0x50)
-        encoder.append_varint(2)
-
-        # variable header
-        encoder.append_bytes(self.packet_id)
-
-        # no payload
-
-        return encoder.bytes()
-
+    FIRST_BYTE = 0x40
+    FRAMES = {}
 
-def deserialize_mqtt_pubrec(data):
-    decoder = Decoder(data)
 
-    # fixed header
-    b = decoder.byte()
-    mqtt_byte = b >> 4
-    assert MessageType(mqtt_byte) == MessageType.PUBREC
-
-    remaining_len = decoder.varint()
-    assert remaining_len == 2
-
-    # variable header
-    packet_id = decoder.bytes(2)
-
-    return MqttPubrec(packet_id), decoder.bytes_consumed()
-
-
-@dataclass
-class MqttPubrel:
+@dataclass(slots=True)
+class MqttPubrec(Ack):
     packet_id: bytes  # 2 byte
 
-    def serialize(self):
-        encoder = Encoder()
+    FIRST_BYTE = 0x50
+    FRAMES = {}
 
-        # fixed header
-        # byte1: 0x60
-        # byte2: remaining length 2
-        encoder.append_byte(0x60)
-        encoder.append_varint(2)
 
-        # variable header
-        encoder.append_bytes(self.packet_id)
-
-        # no payload
-
-        return encoder.bytes()
-
-
-def deserialize_mqtt_pubrel(data):
-    decoder = Decoder(data)
-
-    # fixed header
-    b = decoder.byte()
-    mqtt_byte = b >> 4
-    assert MessageType(mqtt_byte) == MessageType.PUBREL
-
-    remaining_len = decoder.varint()
-    assert remaining_len == 2
-
-    # variable header
-    packet_id = decoder.bytes(2)
-
-    return MqttPubrel(packet_id), decoder.bytes_consumed()
-
-
-@dataclass
-class MqttPubcomp:
+@dataclass(slots=True)
+class MqttPubrel(Ack):
     packet_id: bytes  # 2 byte
 
-    def serialize(self):
-        encoder = Encoder()
-
-        # fixed header
-        # byte1: 0x70
-        # byte2: remaining length 2
-        encoder.append_byte(0x70)
-        encoder.append_varint(2)
-
-        # variable header
-        encoder.append_bytes(self.packet_id)
+    # The reserved flags of PUBREL are 0010
+    FIRST_BYTE = 0x62
+    FRAMES = {}
 
-        # no payload
 
-        return encoder.bytes()
-
-
-def deserialize_mqtt_pubcomp(data):
-    decoder = Decoder(data)
-
-    # fixed header
-    b = decoder.byte()
-    mqtt_byte = b >> 4
-    assert MessageType(mqtt_byte) == MessageType.PUBCOMP
-
-    remaining_len = decoder.varint()
-    assert remaining_len == 2
-
-    # variable header
-    packet_id = decoder.bytes(2)
+@dataclass(slots=True)
+class MqttPubcomp(Ack):
+    packet_id: bytes  # 2 byte
 
-    return MqttPubcomp(packet_id), decoder.bytes_consumed()
+    FIRST_BYTE = 0x70
+    FRAMES = {}
 
 
-@dataclass
+@dataclass(slots=True)
 class MqttSubscribe:
     packet_id: bytes  # 2 bytes
     topics: List[Tuple[str, QosLevel]]
 
+    def serialize(self) -> bytes:
+        body = self.packet_id + b"".join(
+            encode_topic(topic) + bytes((qos_level.value,))
+            for topic, qos_level in self.topics
+        )
+        return b"\x82" + encode_varint(len(body)) + body
 
-def deserialize_mqtt_subscribe(data):
-    decoder = Decoder(data)
 
-    # Fixed header
-    b = decoder.byte()
-    mqtt_type = b >> 4
-    assert MessageType(mqtt_type) == MessageType.SUBSCRIBE
-    remaining_len = decoder.varint()
-    num_bytes_in_fixed_header = decoder.num_bytes_consumed()
+def deserialize_mqtt_subscribe(data, first_byte: int, start: int, end: int):
+    decoder = Decoder(data, start)
 
     # Variable header
-    packet_id = decoder.bytes(2)
+    packet_id = bytes(decoder.bytes(2))
 
     # Payload
     topics = []
-    while not decoder.consumed_all():
+    while decoder.num_bytes_consumed() < end:
         topic = decoder.string()
         qos_level = QosLevel(decoder.byte())
         topics.append((topic, qos_level))
 
-    if decoder.num_bytes_consumed() - num_bytes_in_fixed_header != remaining_len:
-        print(f"Consumed: {decoder.num_bytes_consumed()}")
-        print(f"Consumed after parsing fixed header: {num_bytes_in_fixed_header}")
-        print(
-            f"Consumed for variable header and payload: {decoder.num_bytes_consumed() - num_bytes_in_fixed_header}"
+    if decoder.num_bytes_consumed() != end:
+        raise ValueError(
+            f"Didn't fully consume message: consumed {decoder.num_bytes_consumed() - start} bytes after the fixed header, expected {end - start}"
         )
-        print(f"Expecrted: {remaining_len}")
-        raise Exception("Didn't fully consume message")
 
-    return (MqttSubscribe(packet_id, topics), decoder.bytes_consumed())
+    return MqttSubscribe(packet_id, topics)
 
 
-@dataclass
+@dataclass(slots=True)
 class MqttSuback:
     packet_id: bytes  # 2 bytes
     return_codes: List[int]  # matching the order of topics in SUBSCRIBE
@@ -348,77 +342,83 @@ class MqttSuback:
         # Fixed header
         # byte 1: \0x90
         # byte 2: remaining length, varint
-        encoder = Encoder()
+        # Variable header: packet id
+        # Payload: one return code per topic
+        return b"".join(
+            (
+                b"\x90",
+                encode_varint(2 + len(self.return_codes)),
+                self.packet_id,
+                bytes(self.return_codes),
+            )
+        )
 
-        encoder.append_byte(0x90)
-        variable_header_len = 2
-        payload_len = len(self.return_codes)
-        remaining_len = variable_header_len + payload_len
-        encoder.append_varint(remaining_len)
 
-        # Variable header
-        encoder.append_bytes(self.packet_id)
+@dataclass(slots=True)
+class MqttUnsubscribe:
+    packet_id: bytes  # 2 bytes
+    topics: List[str]
 
-        # Payload
-        for return_code in self.return_codes:
-            encoder.append_byte(return_code)
 
-        return encoder.bytes()
+def deserialize_mqtt_unsubscribe(data, first_byte: int, start: int, end: int):
+    decoder = Decoder(data, start)
 
+    # Variable header
+    packet_id = bytes(decoder.bytes(2))
 
-@dataclass
-class MqttDisconnect:
-    pass
+    # Payload
+    topics = []
+    while decoder.num_bytes_consumed() < end:
+        topics.append(decoder.string())
 
+    if decoder.num_bytes_consumed() != end:
+        raise ValueError("Didn't fully consume message")
 
-def deserialize_mqtt_disconnect(data):
-    decoder = Decoder(data)
+    return MqttUnsubscribe(packet_id, topics)
 
-    # Fixed header
-    b = decoder.byte()
-    mqtt_type = b >> 4
-    assert MessageType(mqtt_type) == MessageType.DISCONNECT
-    remaining_len = decoder.varint()
-    assert remaining_len == 0
 
-    # no variable header or payload
-    return (MqttDisconnect(), decoder.bytes_consumed())
+@dataclass(slots=True)
+class MqttUnsuback(Ack):
+    packet_id: bytes  # 2 bytes
 
+    FIRST_BYTE = 0xB0
+    FRAMES = {}
 
-@dataclass
-class MqttPingreq:
-    pass
 
+@dataclass(slots=True)
+class MqttDisconnect:
+    def serialize(self):
+        return b"\xe0\x00"
 
-def deserialize_mqtt_pingreq(data):
-    decoder = Decoder(data)
 
-    # Fixed header
-    b = decoder.byte()
-    mqtt_type = b >> 4
-    assert MessageType(mqtt_type) == MessageType.PINGREQ
-    remaining_len = decoder.varint()
-    assert remaining_len == 0
+@dataclass(slots=True)
+class MqttPingreq:
+    def serialize(self):
+        return b"\xc0\x00"
 
-    # no variable header or payload
-    return (MqttPingreq(), decoder.bytes_consumed())
 
+def deserialize_empty(cls):
+    """
+    Returns the deserializer of a packet made of its fixed header only.
+    """
+    # No variable header or payload, so one instance does for all
+    message = cls()
 
-@dataclass
-class MqttPingresp:
+    def deserialize(data, first_byte: int, start: int, end: int):
+        if end != start:
+            raise ValueError(f"malformed {cls.__name__}")
+        return message
 
-    def serialize(self):
-        encoder = Encoder()
+    return deserialize
 
-        # fixed header
-        # byte 1: \xD0
-        # byte 2: remaining length 0
-        encoder.append_byte(0xD0)
-        encoder.append_varint(0)
 
-        # no variable header or payload
+PINGRESP = b"\xd0\x00"
 
-        return encoder.bytes()
+
+@dataclass(slots=True)
+class MqttPingresp:
+    def serialize(self):
+        return PINGRESP
 
 
 # Albegraic type: https://stackoverflow.com/q/16258553/9057530
@@ -426,30 +426,73 @@ MqttRequest = (
     MqttConnect
     | MqttPublish
     | MqttPuback
+    | MqttPubrec
+    | MqttPubrel
+    | MqttPubcomp
     | MqttSubscribe
+    | MqttUnsubscribe
     | MqttDisconnect
     | MqttPingreq
 )
 
 
-def deserialize_mqtt_message(data) -> tuple[MqttRequest, bytes]:
+def dispatch_table() -> List[Optional[Callable]]:
     """
-    Returns (message, bytes_consumed)
+    Returns the deserializer of every first byte, None for packets clients
+    don't send. Deserializers are called as f(data, first_byte, start, end),
+    [start, end) being the variable header and payload.
     """
-    decoder = Decoder(data)
-
-    b = decoder.byte()
-    mqtt_type = MessageType(b >> 4)
-    deserialize_funcs = {
+    table: List[Optional[Callable]] = [None] * 256
+    deserializers = {
         MessageType.CONNECT: deserialize_mqtt_connect,
         MessageType.PUBLISH: deserialize_mqtt_publish,
-        MessageType.PUBACK: deserialize_mqtt_puback,
-        MessageType.PUBREC: deserialize_mqtt_pubrec,
-        MessageType.PUBREL: deserialize_mqtt_pubrel,
-        MessageType.PUBCOMP: deserialize_mqtt_pubcomp,
+        MessageType.PUBACK: deserialize_ack(MqttPuback),
+        MessageType.PUBREC: deserialize_ack(MqttPubrec),
+        MessageType.PUBREL: deserialize_ack(MqttPubrel),
+        MessageType.PUBCOMP: deserialize_ack(MqttPubcomp),
         MessageType.SUBSCRIBE: deserialize_mqtt_subscribe,
-        MessageType.PINGREQ: deserialize_mqtt_pingreq,
-        MessageType.DISCONNECT: deserialize_mqtt_disconnect,
+        MessageType.UNSUBSCRIBE: deserialize_mqtt_unsubscribe,
+        MessageType.PINGREQ: deserialize_empty(MqttPingreq),
+        MessageType.DISCONNECT: deserialize_empty(MqttDisconnect),
     }
-    msg, bytes_consumed = deserialize_funcs[mqtt_type](data)
-    return msg, bytes_consumed
+    for message_type, deserialize in deserializers.items():
+        # The low 4 bits are flags
+        for flags in range(16):
+            table[message_type.value << 4 | flags] = deserialize
+    return table
+
+
+DESERIALIZERS = dispatch_table()
+
+
+def deserialize_mqtt_message(data) -> tuple[MqttRequest, bytes]:
+    """
+    Returns (message, bytes_consumed)
+    """
+    first_byte = data[0]
+    deserialize = DESERIALIZERS[first_byte]
+    if deserialize is None:
+        raise ValueError(f"unexpected packet type {first_byte >> 4}")
+
+    # Remaining length, a varint of up to 4 bytes
+    remaining_len = data[1]
+    start = 2
+    if remaining_len & 0x80:
+        remaining_len &= 0x7F
+        shift = 7
+        while True:
+            b = data[start]
+            start += 1
+            remaining_len |= (b & 0x7F) << shift
+            if b & 0x80 == 0:
+                break
+            shift += 7
+            if shift > 21:
+                raise ValueError("malformed remaining length")
+
+    end = start + remaining_len
+    if end > len(data):
+        raise ValueError("incomplete packet")
+
+    message = deserialize(data, first_byte, start, end)
+    return message, data if end == len(data) else data[:end]
@@ -0,0 +1,137 @@
+"""
+Token buckets, for limits on how often something may happen.
+
+Publishers over their limits are slowed down rather than refused: a PUBLISH
+is charged to the buckets even when they are empty, and the debt says how
+long the broker stops reading from the client (`Broker.throttle`). The
+client's messages then back up in its socket and TCP's flow control pushes
+back on it, with nothing buffered or dropped in the broker.
+"""
+
+from typing import Callable, Dict, List, Optional, Tuple
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Allows `rate` events per second on average and bursts of up to `burst`
+    events. Not thread-safe; callers that share a bucket lock around it.
+    """
+
+    __slots__ = ("rate", "burst", "tokens", "updated", "clock")
+
+    def __init__(
+        self,
+        rate: float,
+        burst: Optional[float] = None,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self.tokens = self.burst
+        self.clock = clock
+        self.updated = clock()
+
+    def refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def take(self, n: float = 1.0) -> bool:
+        """
+        Takes `n` tokens if there are that many. Returns whether it did.
+        """
+        self.refill()
+        if self.tokens < n:
+            return False
+        self.tokens -= n
+        return True
+
+    def charge(self, n: float = 1.0) -> float:
+        """
+        Takes `n` tokens, going into debt if there aren't that many. Returns
+        the seconds until the debt is paid off, 0 if there is none.
+        """
+        self.refill()
+        self.tokens -= n
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+
+class RateLimit:
+    """
+    Messages and bytes per second, either 0 for no limit. Not thread-safe.
+    """
+
+    __slots__ = ("message_bucket", "byte_bucket")
+
+    def __init__(self, message_rate: float = 0.0, byte_rate: float = 0.0):
+        self.message_bucket = TokenBucket(message_rate) if message_rate > 0 else None
+        self.byte_bucket = TokenBucket(byte_rate) if byte_rate > 0 else None
+
+    def charge(self, size: int) -> float:
+        """
+        Charges a message of `size` bytes. Returns the seconds to wait
+        before the next one is within the limits.
+        """
+        delay = 0.0
+        if self.message_bucket is not None:
+            delay = self.message_bucket.charge()
+        if self.byte_bucket is not None:
+            delay = max(delay, self.byte_bucket.charge(size))
+        return delay
+
+
+class Throttle:
+    """
+    Publish limits of a broker: one per client, and one per topic prefix
+    shared by every client publishing under it. `prefixes` maps prefixes to
+    their message and byte rates.
+    """
+
+    def __init__(
+        self,
+        client_message_rate: float = 0.0,
+        client_byte_rate: float = 0.0,
+        prefixes: Optional[Dict[str, Tuple[float, float]]] = None,
+    ):
+        self.client_message_rate = client_message_rate
+        self.client_byte_rate = client_byte_rate
+
+        # (prefix, its limit, the lock guarding it); clients publish from
+        # their own threads in threaded mode
+        self.prefixes: List[Tuple[str, RateLimit, threading.Lock]] = [
+            (prefix, RateLimit(message_rate, byte_rate), threading.Lock())
+            for prefix, (message_rate, byte_rate) in (prefixes or {}).items()
+        ]
+
+        # Messages over the limit of each prefix; guarded by the prefix's
+        # lock
+        self.prefix_throttled = {prefix: 0 for prefix, _, _ in self.prefixes}
+
+    def client_limit(self) -> Optional[RateLimit]:
+        """
+        Returns the limit for a new client, None if there is none.
+        """
+        if self.client_message_rate <= 0 and self.client_byte_rate <= 0:
+            return None
+        return RateLimit(self.client_message_rate, self.client_byte_rate)
+
+    def charge(self, limit: Optional[RateLimit], topic: str, size: int) -> float:
+        """
+        Charges a message of `size` bytes published to `topic` by a client
+        with `limit`. Returns the seconds the client has to wait.
+        """
+        delay = 0.0
+        if limit is not None:
+            delay = limit.charge(size)
+        for prefix, prefix_limit, lock in self.prefixes:
+            if topic.startswith(prefix):
+                with lock:
+                    prefix_delay = prefix_limit.charge(size)
+                    if prefix_delay > 0:
+                        self.prefix_throttled[prefix] += 1
+                delay = max(delay, prefix_delay)
+        return delay
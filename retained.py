@@ -0,0 +1,191 @@
+"""
+Retained messages, MQTT 3.1.1 section 3.3.1.3.
+
+The broker keeps the last message published with the RETAIN flag on each
+topic and hands it to every new subscription whose filter matches. Messages
+are indexed in a trie of topic levels, so a SUBSCRIBE only visits the part
+of the store its filter can match: "a/b/+" looks at the children of "a/b",
+"a/#" at the subtree under "a", never at the whole store.
+"""
+
+from typing import Dict, List, Optional
+import sys
+import threading
+from protocol import QosLevel
+
+
+class RetainedMessage:
+    __slots__ = ("topic", "qos_level", "payload")
+
+    def __init__(self, topic: str, qos_level: QosLevel, payload: bytes):
+        self.topic = topic
+        self.qos_level = qos_level
+        self.payload = payload
+
+
+class _Node:
+    __slots__ = ("children", "message")
+
+    def __init__(self):
+        # Most nodes are leaves; their dict is only created when needed
+        self.children: Optional[Dict[str, _Node]] = None
+        self.message: Optional[RetainedMessage] = None
+
+
+class RetainedStore:
+    # Bytes of retained messages kept before the oldest ones are evicted
+    MAX_MEMORY = 256 * 1024 * 1024
+
+    # Rough per-message cost of the trie node, message object and dict entry
+    # on top of the topic and payload
+    OVERHEAD = 200
+
+    def __init__(self, max_memory: int = MAX_MEMORY):
+        self.max_memory = max_memory
+        self.memory = 0
+
+        self.root = _Node()
+        self.root.children = {}
+
+        # maps topic to message, least recently set first; used for
+        # eviction and exact lookups
+        self.messages: Dict[str, RetainedMessage] = {}
+
+        self.evicted = 0
+
+        self.lock = threading.Lock()
+
+    def set(self, topic: str, qos_level: QosLevel, payload: bytes):
+        """
+        Retains `payload` on `topic`. An empty payload clears the topic.
+
+        `payload` is kept as is, not copied: pass the same bytes object that
+        is fanned out so both share one buffer.
+        """
+        with self.lock:
+            self._remove(topic)
+            if len(payload) == 0:
+                return
+
+            size = self._size(topic, payload)
+            if size > self.max_memory:
+                self.evicted += 1
+                return
+
+            # Topics of a deployment share most of their levels ("devices",
+            # "telemetry", ...); interning stores each level string once.
+            node = self.root
+            for level in topic.split("/"):
+                if node.children is None:
+                    node.children = {}
+                child = node.children.get(level)
+                if child is None:
+                    child = node.children[sys.intern(level)] = _Node()
+                node = child
+
+            message = RetainedMessage(sys.intern(topic), qos_level, payload)
+            node.message = message
+            self.messages[message.topic] = message
+            self.memory += size
+
+            while self.memory > self.max_memory:
+                self._remove(next(iter(self.messages)))
+                self.evicted += 1
+
+    def get(self, topic: str) -> Optional[RetainedMessage]:
+        return self.messages.get(topic)
+
+    def match(self, topic_filter: str) -> List[RetainedMessage]:
+        """
+        Returns the retained messages whose topic matches `topic_filter`.
+        """
+        res = []
+        levels = topic_filter.split("/")
+
+        with self.lock:
+            # (node, index of the next filter level)
+            stack = [(self.root, 0)]
+            while len(stack) > 0:
+                node, i = stack.pop()
+
+                if i == len(levels):
+                    if node.message is not None:
+                        res.append(node.message)
+                    continue
+
+                level = levels[i]
+                if level == "#":
+                    # "a/#" matches "a" as well as everything below it
+                    if node.message is not None:
+                        res.append(node.message)
+                    self._collect(node, res, i == 0)
+                elif node.children is None:
+                    continue
+                elif level == "+":
+                    for name, child in node.children.items():
+                        if i == 0 and name.startswith("$"):
+                            continue
+                        stack.append((child, i + 1))
+                else:
+                    child = node.children.get(level)
+                    if child is not None:
+                        stack.append((child, i + 1))
+
+        return res
+
+    def __len__(self):
+        return len(self.messages)
+
+    def stats(self) -> dict:
+        return {
+            "messages": len(self.messages),
+            "memory": self.memory,
+            "evicted": self.evicted,
+        }
+
+    @classmethod
+    def _size(cls, topic: str, payload: bytes) -> int:
+        return len(topic) + len(payload) + cls.OVERHEAD
+
+    @staticmethod
+    def _collect(node: _Node, res: List[RetainedMessage], skip_dollar: bool):
+        """
+        Appends every message below `node`.
+        """
+        if node.children is None:
+            return
+
+        stack = [
+            child
+            for name, child in node.children.items()
+            if not (skip_dollar and name.startswith("$"))
+        ]
+        while len(stack) > 0:
+            node = stack.pop()
+            if node.message is not None:
+                res.append(node.message)
+            if node.children is not None:
+                stack.extend(node.children.values())
+
+    def _remove(self, topic: str):
+        message = self.messages.pop(topic, None)
+        if message is None:
+            return
+
+        self.memory -= self._size(topic, message.payload)
+
+        path = [self.root]
+        levels = topic.split("/")
+        for level in levels:
+            path.append(path[-1].children[level])
+        path[-1].message = None
+
+        # Prune nodes left without messages or children
+        for i in range(len(levels), 0, -1):
+            node = path[i]
+            if node.message is not None or node.children:
+                break
+            parent = path[i - 1]
+            del parent.children[levels[i - 1]]
+            if len(parent.children) == 0 and parent is not self.root:
+                parent.children = None
@@ -0,0 +1,473 @@
+"""
+Message routing between brokers.
+
+Several brokers act as one by linking every broker with every other one:
+the worker processes of one node (`main.py --workers`, over Unix sockets) or
+the nodes of a cluster (`main.py --cluster-port/--peer`, over TCP). Over a
+link each side announces the topic filters it has local subscribers for, as
+they come and go, and forwards a PUBLISH only to the brokers that announced a
+matching filter. Retained messages go to every broker, so a later subscriber
+finds them wherever it connects.
+
+Messages received over a link are only delivered locally, never forwarded
+again: with every broker linked to every other, the publisher's broker
+already sent them everywhere they are needed, and nothing can loop. A
+PUBLISH also carries the node id of its origin, and a broker drops the ones
+it originated itself.
+
+Cluster nodes only need to be given some of their peers: every node tells
+its peers the addresses of the nodes it knows, and of two nodes that learn
+about each other this way, the one with the smaller node id dials the other,
+until every node is linked with every other. Should two nodes still end up
+with two links between them (both dialed the other), both keep the one
+dialed by the smaller node id.
+
+Delivery across a link is as reliable as the stream it runs on: the
+brokers' QoS 1/2 guarantees apply between a broker and its clients only.
+
+Link frames are a (body length, type) header followed by the body:
+HELLO: node id
+SUBSCRIBE, UNSUBSCRIBE: topic filter
+PUBLISH: (origin length, qos, retain, topic length), origin node id, topic,
+payload
+PEERS: "<node id> <address>" lines
+"""
+
+import asyncio
+import logging
+import struct
+import threading
+from enum import IntEnum
+from typing import Dict, List, Optional, Set, Tuple
+from broker import Broker
+from protocol import QOS_LEVELS, QosLevel
+from topics import TopicTrie
+
+logger = logging.getLogger(__name__)
+
+
+class FrameType(IntEnum):
+    HELLO = 1
+    SUBSCRIBE = 2
+    UNSUBSCRIBE = 3
+    PUBLISH = 4
+    PEERS = 5
+
+
+FRAME_HEADER = struct.Struct("!IB")
+PUBLISH_HEADER = struct.Struct("!BBBH")
+
+
+def encode_frame(kind: FrameType, body: bytes) -> bytes:
+    return FRAME_HEADER.pack(len(body), kind) + body
+
+
+def encode_peers(peers: List[Tuple[str, str]]) -> bytes:
+    lines = "\n".join(f"{node_id} {address}" for node_id, address in peers)
+    return encode_frame(FrameType.PEERS, lines.encode("utf-8"))
+
+
+def split_address(address: str) -> Tuple[str, int]:
+    """
+    Splits "host:port".
+    """
+    host, _, port = address.rpartition(":")
+    return host, int(port)
+
+
+class Link(asyncio.Protocol):
+    """
+    One end of a link to another broker.
+
+    Frames sent during one iteration of the event loop are written together
+    in a single write.
+    """
+
+    # Bytes the transport may buffer before PUBLISHes to this peer are
+    # dropped instead
+    MAX_BUFFERED = 64 * 1024 * 1024
+
+    def __init__(self, router: "Router", address: Optional[str] = None):
+        self.router = router
+        self.transport: Optional[asyncio.Transport] = None
+        self.buffer = bytearray()
+
+        # The address we dialed; None if the peer dialed us
+        self.address = address
+
+        # Set once the peer said hello
+        self.node_id: Optional[str] = None
+
+        # Filters the peer has subscribers for; the subscriber is the link
+        self.filters = TopicTrie()
+
+        # Frames waiting for the next flush
+        self.pending: List[bytes] = []
+
+        self.closed = router.loop.create_future()
+
+        # counters
+        self.sent = 0
+        self.received = 0
+        self.dropped = 0
+        self.flushes = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.send(encode_frame(FrameType.HELLO, self.router.encoded_node_id))
+
+    def connection_lost(self, exc):
+        self.transport = None
+        if not self.closed.done():
+            self.closed.set_result(None)
+        self.router.link_lost(self)
+
+    def data_received(self, data):
+        self.buffer.extend(data)
+
+        view = memoryview(self.buffer)
+        pos = 0
+        while len(view) - pos >= FRAME_HEADER.size:
+            length, kind = FRAME_HEADER.unpack_from(view, pos)
+            start = pos + FRAME_HEADER.size
+            if len(view) - start < length:
+                break
+            try:
+                self.handle(kind, view[start : start + length])
+            except Exception as e:
+                logger.warning("Closing link to %s: %r", self.node_id, e)
+                view.release()
+                self.close()
+                return
+            pos = start + length
+
+        view.release()
+        del self.buffer[:pos]
+
+    def handle(self, kind: int, body: memoryview):
+        if kind == FrameType.HELLO:
+            self.node_id = str(body, "utf-8")
+            self.router.link_ready(self)
+            return
+
+        if self.node_id is None:
+            raise ValueError("frame before HELLO")
+
+        match kind:
+            case FrameType.SUBSCRIBE:
+                topic_filter = str(body, "utf-8")
+                self.filters.subscribe("", topic_filter, QosLevel.AT_MOST_ONCE)
+            case FrameType.UNSUBSCRIBE:
+                self.filters.unsubscribe("", str(body, "utf-8"))
+            case FrameType.PUBLISH:
+                origin_len, qos, retain, topic_len = PUBLISH_HEADER.unpack_from(
+                    body
+                )
+                pos = PUBLISH_HEADER.size + origin_len
+                if body[PUBLISH_HEADER.size : pos] == self.router.encoded_node_id:
+                    # Ours, come back around
+                    self.dropped += 1
+                    return
+                topic = str(body[pos : pos + topic_len], "utf-8")
+                # Copied out of the link's receive buffer, which gets reused
+                payload = bytes(body[pos + topic_len :])
+                self.received += 1
+                self.router.deliver(topic, QOS_LEVELS[qos], payload, bool(retain))
+            case FrameType.PEERS:
+                for line in str(body, "utf-8").splitlines():
+                    node_id, address = line.split(" ")
+                    self.router.learn(node_id, address, self)
+            case _:
+                raise ValueError(f"unknown link frame type {kind}")
+
+    def send(self, *frame):
+        """
+        Queues a frame, given as one or more buffers, for the next flush.
+        """
+        if self.transport is None:
+            return
+        if len(self.pending) == 0:
+            self.router.loop.call_soon(self.flush)
+        self.pending.extend(frame)
+
+    def flush(self):
+        if self.transport is not None and len(self.pending) > 0:
+            self.transport.writelines(self.pending)
+            self.flushes += 1
+        self.pending = []
+
+    def forward(self, header: bytes, payload):
+        if (
+            self.transport is None
+            or self.transport.get_write_buffer_size() > self.MAX_BUFFERED
+        ):
+            self.dropped += 1
+            return
+        self.send(header, payload)
+        self.sent += 1
+
+    def close(self):
+        if self.transport is not None:
+            self.flush()
+            self.transport.close()
+
+    def dialer(self) -> str:
+        """
+        Returns the node id of the side that dialed the link.
+        """
+        return self.router.node_id if self.address is not None else self.node_id
+
+    def stats(self) -> dict:
+        return {
+            "filters": len(self.filters),
+            "sent": self.sent,
+            "received": self.received,
+            "dropped": self.dropped,
+            "flushes": self.flushes,
+        }
+
+
+class Router:
+    """
+    Links a broker to its peers. Installs itself as the broker's router and
+    as the listener of its subscriptions.
+
+    A router lives in an event loop and has to be created in it. The broker
+    may call it from other threads (the threaded server mode); such calls
+    are handed over to the loop, in batches.
+    """
+
+    # Seconds between attempts to reach a peer that isn't up
+    RETRY_INTERVAL = 0.5
+
+    def __init__(self, broker: Broker, node_id: str, address: Optional[str] = None):
+        self.broker = broker
+        self.node_id = node_id
+        self.encoded_node_id = node_id.encode("utf-8")
+
+        # Where peers reach us, told to the other peers; None if they can't
+        self.address = address
+
+        self.loop = asyncio.get_running_loop()
+        self.thread_id = threading.get_ident()
+
+        # Calls from other threads waiting for the loop
+        self.calls: List[tuple] = []
+        self.calls_lock = threading.Lock()
+
+        # Links whose peer said hello, by peer node id
+        self.links: Dict[str, Link] = {}
+
+        # Addresses of the cluster nodes we know about, by node id
+        self.addresses: Dict[str, str] = {}
+
+        # maps the addresses we dial to the node id last found there
+        self.dialing: Dict[str, Optional[str]] = {}
+
+        self.servers: List[asyncio.base_events.Server] = []
+        self.tasks: Set[asyncio.Task] = set()
+
+        broker.router = self
+        broker.subscriptions.listener = self
+
+    async def listen_unix(self, path: str):
+        self.servers.append(
+            await self.loop.create_unix_server(lambda: Link(self), path)
+        )
+
+    async def listen_tcp(self, host: str, port: int):
+        self.servers.append(
+            await self.loop.create_server(
+                lambda: Link(self), host, port, reuse_address=True
+            )
+        )
+
+    def port(self) -> int:
+        return self.servers[0].sockets[0].getsockname()[1]
+
+    def connect_unix(self, path: str):
+        """
+        Links to the broker listening on `path`, and links again whenever the
+        link is lost.
+        """
+        self.dial(
+            path,
+            lambda: self.loop.create_unix_connection(lambda: Link(self, path), path),
+        )
+
+    def connect_tcp(self, address: str):
+        """
+        Like `connect_unix`, for a broker listening on "host:port".
+        """
+        host, port = split_address(address)
+        self.dial(
+            address,
+            lambda: self.loop.create_connection(
+                lambda: Link(self, address), host, port
+            ),
+        )
+
+    def dial(self, address: str, connect):
+        if address in self.dialing:
+            return
+        self.dialing[address] = None
+
+        task = self.loop.create_task(self._dial(address, connect))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _dial(self, address: str, connect):
+        while True:
+            node_id = self.dialing[address]
+            if node_id == self.node_id:
+                # That's us
+                return
+
+            if node_id is None or node_id not in self.links:
+                try:
+                    _, link = await connect()
+                    await link.closed
+                except OSError:
+                    pass
+
+            await asyncio.sleep(self.RETRY_INTERVAL)
+
+    def link_ready(self, link: Link):
+        if link.address is not None:
+            self.dialing[link.address] = link.node_id
+
+        if link.node_id == self.node_id:
+            link.close()
+            return
+
+        existing = self.links.get(link.node_id)
+        if existing is not None:
+            # Both sides keep the link dialed by the smaller node id
+            if existing.dialer() <= link.dialer():
+                link.close()
+                return
+            existing.close()
+
+        self.links[link.node_id] = link
+        logger.info("Linked to %s", link.node_id)
+
+        # Our subscriptions so far; changes follow as they happen
+        for topic_filter in self.broker.subscriptions.active_filters():
+            frame = encode_frame(FrameType.SUBSCRIBE, topic_filter.encode("utf-8"))
+            link.send(frame)
+
+        peers = list(self.addresses.items())
+        if self.address is not None:
+            peers.append((self.node_id, self.address))
+        if len(peers) > 0:
+            link.send(encode_peers(peers))
+
+    def link_lost(self, link: Link):
+        if link.node_id is not None and self.links.get(link.node_id) is link:
+            del self.links[link.node_id]
+            logger.info("Link to %s lost", link.node_id)
+
+    def learn(self, node_id: str, address: str, source: Link):
+        """
+        Records the address of a cluster node, told by the peer at `source`.
+        """
+        if node_id == self.node_id or self.addresses.get(node_id) == address:
+            return
+        self.addresses[node_id] = address
+
+        frame = encode_peers([(node_id, address)])
+        for link in self.links.values():
+            if link is not source:
+                link.send(frame)
+
+        if self.node_id < node_id and node_id not in self.links:
+            self.connect_tcp(address)
+
+    def call(self, function, *args):
+        """
+        Runs `function` in the router's loop: right away if we are in it,
+        else in its next iteration.
+        """
+        if threading.get_ident() == self.thread_id:
+            function(*args)
+            return
+
+        with self.calls_lock:
+            self.calls.append((function, args))
+            wake_up = len(self.calls) == 1
+        if wake_up:
+            self.loop.call_soon_threadsafe(self.run_calls)
+
+    def run_calls(self):
+        with self.calls_lock:
+            calls, self.calls = self.calls, []
+        for function, args in calls:
+            function(*args)
+
+    def filter_added(self, topic_filter: str):
+        self.call(self.broadcast, FrameType.SUBSCRIBE, topic_filter)
+
+    def filter_removed(self, topic_filter: str):
+        self.call(self.broadcast, FrameType.UNSUBSCRIBE, topic_filter)
+
+    def broadcast(self, kind: FrameType, topic_filter: str):
+        frame = encode_frame(kind, topic_filter.encode("utf-8"))
+        for link in self.links.values():
+            link.send(frame)
+
+    def route(self, topic: str, qos_level: QosLevel, payload, retain: bool):
+        """
+        Forwards a message published by a local client to the peers that
+        need it.
+        """
+        if len(self.links) == 0:
+            return
+        # The payload waits for the next flush: copy it out of the receive
+        # buffer
+        self.call(self.forward, topic, qos_level, bytes(payload), retain)
+
+    def forward(self, topic: str, qos_level: QosLevel, payload: bytes, retain: bool):
+        header = None
+        for link in self.links.values():
+            if not retain and not link.filters.matches(topic):
+                continue
+
+            if header is None:
+                # Built once and shared by every link, like the payload
+                origin = self.encoded_node_id
+                encoded_topic = topic.encode("utf-8")
+                body_len = (
+                    PUBLISH_HEADER.size
+                    + len(origin)
+                    + len(encoded_topic)
+                    + len(payload)
+                )
+                header = (
+                    FRAME_HEADER.pack(body_len, FrameType.PUBLISH)
+                    + PUBLISH_HEADER.pack(
+                        len(origin), qos_level.value, retain, len(encoded_topic)
+                    )
+                    + origin
+                    + encoded_topic
+                )
+            link.forward(header, payload)
+
+    def deliver(
+        self, topic: str, qos_level: QosLevel, payload: bytes, retain: bool
+    ):
+        """
+        Publishes a message received from a peer to the local subscribers.
+        """
+        self.broker.publish(topic, qos_level, payload, retain, route=False)
+
+    def stats(self) -> Dict[str, dict]:
+        return {node_id: link.stats() for node_id, link in self.links.items()}
+
+    async def close(self):
+        for task in self.tasks:
+            task.cancel()
+        for link in list(self.links.values()):
+            link.close()
+        for server in self.servers:
+            server.close()
+            await server.wait_closed()
@@ -0,0 +1,99 @@
+"""
+Shared subscriptions: "$share/<group>/<filter>".
+
+Clients subscribing with the same group and filter form a group, and each
+message matching the filter goes to only one member of the group instead of
+to all of them, so the members split the load of a topic. A client can be
+in a group and hold plain subscriptions as well; it gets a copy for each.
+
+Which member gets a message is up to the broker's strategy. Members that
+aren't connected (persistent sessions whose client is away) are passed over.
+The group as a whole is a single subscriber in the topic trie, so matching a
+topic costs the same no matter how many members a group has.
+"""
+
+from enum import Enum
+from typing import Callable, Dict, List, Optional, Tuple
+import zlib
+from protocol import QosLevel
+
+
+class ShareStrategy(Enum):
+    # Members take turns
+    ROUND_ROBIN = "round_robin"
+    # The member with the fewest unacked and queued QoS 1/2 messages; ties
+    # are broken by taking turns
+    LEAST_INFLIGHT = "least_inflight"
+    # Messages on the same topic keep going to the same member, as long as
+    # the members stay the same
+    STICKY = "sticky"
+
+
+class ShareGroup:
+    __slots__ = ("name", "topic_filter", "members", "turn")
+
+    def __init__(self, name: str, topic_filter: str):
+        self.name = name
+        self.topic_filter = topic_filter
+
+        # maps client id to the qos it subscribed with, in joining order.
+        # Replaced rather than changed when members join or leave, so picks
+        # can go through it without a lock.
+        self.members: Dict[str, QosLevel] = {}
+
+        # Bumped on every pick, for the strategies taking turns
+        self.turn = 0
+
+    def pick(
+        self, strategy: ShareStrategy, topic: bytes, clients: Dict[str, "Connection"]
+    ) -> Optional[Tuple["Connection", QosLevel]]:
+        """
+        Returns the connection of the member that gets a message on `topic`
+        (encoded) and the qos the member subscribed with, None if no member
+        is connected.
+        """
+        candidates = []
+        for client_id, qos_level in self.members.items():
+            conn = clients.get(client_id)
+            if conn is not None:
+                candidates.append((conn, qos_level))
+        if len(candidates) == 0:
+            return None
+
+        return candidates[STRATEGIES[strategy](self, topic, candidates)]
+
+    def __repr__(self):
+        return f"ShareGroup({self.name!r}, {self.topic_filter!r})"
+
+
+# A strategy returns the index of the candidate (connection, qos) to pick
+Strategy = Callable[[ShareGroup, bytes, List[tuple]], int]
+
+
+def round_robin(group: ShareGroup, topic: bytes, candidates: List[tuple]) -> int:
+    group.turn += 1
+    return group.turn % len(candidates)
+
+
+def least_inflight(group: ShareGroup, topic: bytes, candidates: List[tuple]) -> int:
+    group.turn += 1
+    n = len(candidates)
+    best = group.turn % n
+    best_load = len(candidates[best][0].session.inflight)
+    for i in range(1, n):
+        j = (group.turn + i) % n
+        load = len(candidates[j][0].session.inflight)
+        if load < best_load:
+            best, best_load = j, load
+    return best
+
+
+def sticky(group: ShareGroup, topic: bytes, candidates: List[tuple]) -> int:
+    return zlib.crc32(topic) % len(candidates)
+
+
+STRATEGIES: Dict[ShareStrategy, Strategy] = {
+    ShareStrategy.ROUND_ROBIN: round_robin,
+    ShareStrategy.LEAST_INFLIGHT: least_inflight,
+    ShareStrategy.STICKY: sticky,
+}
@@ -1,7 +1,76 @@
+import asyncio
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
 import unittest
 from encoder import Encoder
 from decoder import Decoder
-from protocol import deserialize_mqtt_message
+from protocol import (
+    MqttConnect,
+    MqttDisconnect,
+    MqttPingreq,
+    MqttSubscribe,
+    MqttPubcomp,
+    MqttPuback,
+    MqttPubrel,
+    deserialize_mqtt_message,
+    encode_topic,
+    serialize_mqtt_publish_header,
+    set_dup_flag,
+)
+from protocol import QosLevel
+from topics import TopicTrie, is_valid_filter
+from framer import Framer
+from outbound import OutboundQueue, OverflowPolicy, QueueOverflow, frame_buffers
+from inflight import InflightState, InflightWindow
+from offline import OfflineBudget, OfflineQueue
+from ratelimit import Throttle, TokenBucket
+from admission import Admission
+from fanout import FanOut
+from timerwheel import TimerWheel
+from retained import RetainedStore
+from shared import ShareGroup, ShareStrategy
+from persistence import RecordType, WriteAheadLog
+from broker import Broker, Session
+from aio import AsyncServer, MqttProtocol
+from main import Server, Handler, SocketConnection
+from routing import Router
+from metrics import Metrics, percentile, sys_topics
+from benchmarks.client import Client
+from benchmarks.suite import BrokerProcess, regressions
+
+
+def frame(first_byte, body):
+    encoder = Encoder()
+    encoder.append_byte(first_byte)
+    encoder.append_varint(len(body))
+    encoder.append_bytes(body)
+    return encoder.bytes()
+
+
+def string(s):
+    encoder = Encoder()
+    encoder.append_int(len(s))
+    encoder.append_bytes(s.encode("utf-8"))
+    return encoder.bytes()
+
+
+def connect_frame(client_id, keep_alive=60, flags=0x02):
+    return frame(
+        0x10,
+        string("MQTT") + bytes([4, flags]) + keep_alive.to_bytes(2, "big") + string(client_id),
+    )
+
+
+def subscribe_frame(packet_id, topic, qos=0):
+    return frame(0x82, packet_id + string(topic) + bytes([qos]))
+
+
+def publish_frame(topic, payload, qos=0, packet_id=b"", retain=False):
+    return frame(0x30 | (qos << 1) | int(retain), string(topic) + packet_id + payload)
 
 
 class TestEncoder(unittest.TestCase):
@@ -52,6 +121,1840 @@ class TestProtocol(unittest.TestCase):
         res, bytes_consumed = deserialize_mqtt_message(data)
         self.assertEqual(len(data), len(bytes_consumed))
 
+    def test_publish_header(self):
+        topic = encode_topic("a/b")
+        header = serialize_mqtt_publish_header(
+            topic, QosLevel.AT_LEAST_ONCE, b"\x00\x05", 3
+        )
+        data = publish_frame("a/b", b"xyz", qos=1, packet_id=b"\x00\x05")
+        self.assertEqual(header + b"xyz", data)
+        message, _ = deserialize_mqtt_message(data)
+        self.assertEqual(message.payload, b"xyz")
+        self.assertEqual(message.text(), "xyz")
+        self.assertEqual(set_dup_flag(header)[0], 0x3A)
+
+        header = serialize_mqtt_publish_header(topic, QosLevel.AT_MOST_ONCE, b"", 3)
+        self.assertEqual(header + b"xyz", publish_frame("a/b", b"xyz"))
+
+    def test_large_publish_header(self):
+        topic = encode_topic("a/b")
+        payload = b"x" * 300
+        header = serialize_mqtt_publish_header(
+            topic, QosLevel.EXACTLY_ONCE, b"\x00\x01", len(payload), retain=True
+        )
+        data = publish_frame("a/b", payload, qos=2, packet_id=b"\x00\x01", retain=True)
+        self.assertEqual(header + payload, data)
+
+        message, _ = deserialize_mqtt_message(data)
+        self.assertEqual(message.qos_level, QosLevel.EXACTLY_ONCE)
+        self.assertTrue(message.retain)
+        self.assertEqual(message.packet_id, b"\x00\x01")
+
+    def test_ack_frames(self):
+        frame = MqttPubrel(b"\x00\x05").serialize()
+        self.assertEqual(frame, b"\x62\x02\x00\x05")
+        self.assertIs(MqttPubrel(b"\x00\x05").serialize(), frame)
+        self.assertIs(MqttPubrel.frame(b"\x00\x05"), frame)
+        self.assertEqual(MqttPuback(b"\x00\x05").serialize(), b"\x40\x02\x00\x05")
+
+        message, _ = deserialize_mqtt_message(b"\x70\x02\x00\x05")
+        self.assertEqual(message, MqttPubcomp(b"\x00\x05"))
+
+    def test_client_frames(self):
+        for message in [
+            MqttConnect("MQTT", 4, 0x02, 60, "c"),
+            MqttSubscribe(
+                b"\x00\x01", [("a/+", QosLevel.AT_LEAST_ONCE), ("b", QosLevel(0))]
+            ),
+            MqttDisconnect(),
+            MqttPingreq(),
+        ]:
+            data = message.serialize()
+            self.assertEqual(deserialize_mqtt_message(data), (message, data))
+
+    def test_malformed(self):
+        for data in [
+            b"\x00\x00",  # reserved packet type
+            b"\x20\x02\x00\x00",  # CONNACK is only sent by brokers
+            b"\x40\x03\x00\x05\x00",  # PUBACK too long
+            b"\x36\x02\x00\x00",  # QoS 3
+            b"\xc0\x80\x80\x80\x80\x01",  # 5-byte remaining length
+        ]:
+            with self.assertRaises(ValueError, msg=data):
+                deserialize_mqtt_message(data)
+
+
+class TestTopicTrie(unittest.TestCase):
+    def test_valid_filter(self):
+        for f in ["a", "a/b", "+", "#", "a/+/c", "a/#", "+/+", "/", "$SYS/#"]:
+            self.assertTrue(is_valid_filter(f), f)
+        for f in ["", "a#", "a/#/c", "a+/b", "#/a"]:
+            self.assertFalse(is_valid_filter(f), f)
+        for f in ["$share/g/a", "$share/g/#", "$share/g//"]:
+            self.assertTrue(is_valid_filter(f), f)
+        for f in ["$share/g", "$share/g/", "$share//a", "$share/+/a", "$share/g/a#"]:
+            self.assertFalse(is_valid_filter(f), f)
+
+    def test_match(self):
+        trie = TopicTrie()
+        trie.subscribe("exact", "sport/tennis/player1", QosLevel.AT_MOST_ONCE)
+        trie.subscribe("single", "sport/+/player1", QosLevel.AT_LEAST_ONCE)
+        trie.subscribe("multi", "sport/#", QosLevel.EXACTLY_ONCE)
+        trie.subscribe("all", "#", QosLevel.AT_MOST_ONCE)
+        trie.subscribe("other", "news/+", QosLevel.AT_MOST_ONCE)
+
+        self.assertEqual(
+            trie.match("sport/tennis/player1"),
+            {
+                "exact": QosLevel.AT_MOST_ONCE,
+                "single": QosLevel.AT_LEAST_ONCE,
+                "multi": QosLevel.EXACTLY_ONCE,
+                "all": QosLevel.AT_MOST_ONCE,
+            },
+        )
+        self.assertEqual(set(trie.match("sport")), {"multi", "all"})
+        self.assertEqual(set(trie.match("sport/tennis")), {"multi", "all"})
+        self.assertEqual(set(trie.match("news")), {"all"})
+        self.assertEqual(set(trie.match("news/today")), {"other", "all"})
+        self.assertEqual(set(trie.match("news/today/sport")), {"all"})
+
+    def test_match_dollar_topics(self):
+        trie = TopicTrie()
+        trie.subscribe("all", "#", QosLevel.AT_MOST_ONCE)
+        trie.subscribe("plus", "+/broker", QosLevel.AT_MOST_ONCE)
+        trie.subscribe("sys", "$SYS/#", QosLevel.AT_MOST_ONCE)
+        self.assertEqual(set(trie.match("$SYS/broker")), {"sys"})
+
+    def test_max_qos_of_overlapping_filters(self):
+        trie = TopicTrie()
+        trie.subscribe("c", "a/+", QosLevel.AT_LEAST_ONCE)
+        trie.subscribe("c", "a/#", QosLevel.AT_MOST_ONCE)
+        self.assertEqual(trie.match("a/b"), {"c": QosLevel.AT_LEAST_ONCE})
+
+    def test_unsubscribe_and_remove_client(self):
+        trie = TopicTrie()
+        trie.subscribe("c1", "a/b/c", QosLevel.AT_MOST_ONCE)
+        trie.subscribe("c1", "a/+", QosLevel.AT_MOST_ONCE)
+        trie.subscribe("c2", "a/b", QosLevel.AT_MOST_ONCE)
+
+        self.assertTrue(trie.unsubscribe("c1", "a/b/c"))
+        self.assertFalse(trie.unsubscribe("c1", "a/b/c"))
+        self.assertEqual(set(trie.match("a/b")), {"c1", "c2"})
+
+        trie.remove_client("c1")
+        self.assertEqual(set(trie.match("a/b")), {"c2"})
+        self.assertEqual(len(trie), 1)
+
+        trie.remove_client("c2")
+        self.assertEqual(trie.root.children, {})
+
+    def test_match_cache(self):
+        trie = TopicTrie(cache_size=3)
+        trie.subscribe("c1", "a/+", QosLevel.AT_MOST_ONCE)
+        for topic in ["a/b", "a/c", "x/y", "a/b"]:
+            trie.match(topic)
+        self.assertEqual(trie.cache.stats()["hits"], 1)
+
+        # Only the cached topics the filter matches are evicted
+        trie.subscribe("c2", "a/#", QosLevel.AT_LEAST_ONCE)
+        self.assertEqual(trie.cache.topics(), ["x/y"])
+        self.assertEqual(
+            trie.match("a/b"),
+            {"c1": QosLevel.AT_MOST_ONCE, "c2": QosLevel.AT_LEAST_ONCE},
+        )
+        trie.subscribe("c3", "x/y", QosLevel.AT_MOST_ONCE)
+        self.assertEqual(trie.cache.topics(), ["a/b"])
+        trie.match("x/y")
+        trie.remove_client("c2")
+        self.assertEqual(trie.cache.topics(), ["x/y"])
+        self.assertEqual(trie.match("a/b"), {"c1": QosLevel.AT_MOST_ONCE})
+
+        # Bounded, least recently used out first
+        for topic in ["x/y", "p", "q", "r"]:
+            trie.match(topic)
+        self.assertEqual(trie.cache.topics(), ["p", "q", "r"])
+        self.assertEqual(trie.cache.stats()["evicted"], 2)
+        trie.subscribe("c4", "#", QosLevel.AT_MOST_ONCE)
+        self.assertEqual(len(trie.cache), 0)
+        self.assertEqual(trie.cache.shards[0].root.children, {})
+
+    def test_concurrent_changes(self):
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        self.addCleanup(sys.setswitchinterval, switch_interval)
+
+        trie = TopicTrie(cache_size=100)
+        trie.subscribe("stable", "a/b/c", QosLevel.AT_LEAST_ONCE)
+        filters = ["a/b/c", "a/+/c", "a/#", "+/b/+", "a/b/c/d"]
+        errors = []
+        done = threading.Event()
+
+        def churn(i):
+            try:
+                for j in range(300):
+                    client_id = f"c{i}-{j % 3}"
+                    trie.subscribe(client_id, filters[j % 5], QosLevel.AT_MOST_ONCE)
+                    if j % 2 == 0:
+                        trie.remove_client(client_id)
+            except Exception as e:
+                errors.append(e)
+
+        def match():
+            try:
+                while not done.is_set():
+                    res = trie.match("a/b/c")
+                    assert res["stable"] == QosLevel.AT_LEAST_ONCE, res
+                    trie.active_filters()
+            except Exception as e:
+                errors.append(e)
+
+        readers = [threading.Thread(target=match) for _ in range(2)]
+        writers = [threading.Thread(target=churn, args=(i,)) for i in range(4)]
+        for thread in readers + writers:
+            thread.start()
+        for thread in writers:
+            thread.join()
+        done.set()
+        for thread in readers:
+            thread.join()
+        self.assertEqual(errors, [])
+
+        for i in range(4):
+            for j in range(3):
+                trie.remove_client(f"c{i}-{j}")
+        self.assertEqual(trie.active_filters(), ["a/b/c"])
+        self.assertEqual(len(trie), 1)
+        for topic in ["a/b/c", "a/x/c", "a/b/c/d", "x/b/y"]:
+            self.assertEqual(trie.match(topic), trie._match(topic), topic)
+
+    def test_listener(self):
+        events = []
+
+        class Listener:
+            def filter_added(self, topic_filter):
+                events.append(("+", topic_filter))
+
+            def filter_removed(self, topic_filter):
+                events.append(("-", topic_filter))
+
+        trie = TopicTrie()
+        trie.listener = Listener()
+        trie.subscribe("c1", "a/+", QosLevel.AT_MOST_ONCE)
+        trie.subscribe("c2", "a/+", QosLevel.AT_LEAST_ONCE)
+        trie.subscribe("c2", "b", QosLevel.AT_MOST_ONCE)
+        self.assertEqual(sorted(trie.active_filters()), ["a/+", "b"])
+        trie.remove_client("c1")
+        trie.remove_client("c2")
+        self.assertEqual(events, [("+", "a/+"), ("+", "b"), ("-", "a/+"), ("-", "b")])
+
+
+class TestFramer(unittest.TestCase):
+    def receive(self, framer, data):
+        buf = framer.recv_buffer()
+        n = min(len(buf), len(data))
+        buf[:n] = data[:n]
+        framer.advance(n)
+        return data[n:]
+
+    def test_pipelined_frames(self):
+        framer = Framer()
+        data = b"\xc0\x00" * 100 + publish_frame("a", b"x")
+        framer.feed(data)
+        frames = [bytes(f) for f in framer.frames()]
+        self.assertEqual(frames, [b"\xc0\x00"] * 100 + [publish_frame("a", b"x")])
+
+    def test_frame_split_across_reads(self):
+        framer = Framer()
+        data = publish_frame("a/b", b"x" * 5000)
+        for i in range(len(data)):
+            self.assertEqual(list(framer.frames()), [])
+            framer.feed(data[i : i + 1])
+        self.assertEqual([bytes(f) for f in framer.frames()], [data])
+
+    def test_large_frame_grows_buffer(self):
+        framer = Framer()
+        data = publish_frame("a", b"y" * 200000)
+        while len(data) > 0:
+            data = self.receive(framer, data)
+        frames = list(framer.frames())
+        self.assertEqual(len(frames), 1)
+        self.assertEqual(bytes(frames[0]), publish_frame("a", b"y" * 200000))
+
+    def test_frames_stay_valid_after_reallocation(self):
+        framer = Framer(recv_size=256)
+        kept = []
+        for i in range(100):
+            framer.feed(publish_frame("t", bytes([i]) * 10))
+            kept.extend(framer.frames())
+        for i, f in enumerate(kept):
+            self.assertEqual(bytes(f), publish_frame("t", bytes([i]) * 10))
+
+    def test_claimed_length_does_not_size_buffer(self):
+        framer = Framer(max_packet_size=Framer.PROTOCOL_MAX_PACKET_SIZE)
+        framer.feed(b"\x30\xff\xff\xff\x7f" + b"x" * 1000)
+        self.assertEqual(list(framer.frames()), [])
+        framer.recv_buffer()
+        self.assertLessEqual(len(framer.buf), 1005 + Framer.RECV_SIZE)
+
+    def test_idle_framer_releases_buffer(self):
+        framer = Framer()
+        framer.feed(b"\xc0\x00" + publish_frame("a", b"x"))
+        frames = list(framer.frames())
+        self.assertEqual(len(framer.buf), 0)
+        self.assertEqual(bytes(frames[1]), publish_frame("a", b"x"))
+
+        framer.feed(b"\xc0")
+        self.assertEqual(list(framer.frames()), [])
+        self.assertGreater(len(framer.buf), 0)
+        framer.feed(b"\x00")
+        self.assertEqual([bytes(f) for f in framer.frames()], [b"\xc0\x00"])
+
+    def test_malformed_remaining_length(self):
+        framer = Framer()
+        framer.feed(b"\x30\xff\xff\xff\xff\x01")
+        with self.assertRaises(ValueError):
+            list(framer.frames())
+
+    def test_max_packet_size(self):
+        framer = Framer(max_packet_size=100)
+        framer.feed(publish_frame("a", b"x" * 90))
+        self.assertEqual(len(list(framer.frames())), 1)
+
+        # Refused on its header, without a buffer for the body
+        framer.feed(publish_frame("a", b"x" * 100000)[:10])
+        self.assertLess(len(framer.recv_buffer()), 1000)
+        with self.assertRaises(ValueError):
+            list(framer.frames())
+
+        # Bounded by default too
+        framer = Framer()
+        framer.feed(b"\x30\xff\xff\xff\x7f")
+        with self.assertRaises(ValueError):
+            list(framer.frames())
+
+
+class TestOutboundQueue(unittest.TestCase):
+    def test_drop_qos0(self):
+        queue = OutboundQueue(max_depth=3, policy=OverflowPolicy.DROP_QOS0)
+        queue.put(b"ack1")
+        queue.put(b"pub1", droppable=True)
+        queue.put(b"pub2", droppable=True)
+        queue.put(b"pub3", droppable=True)
+        queue.put(b"ack2")
+        self.assertEqual(queue.take(), [b"ack1", b"pub1", b"ack2"])
+        self.assertEqual(queue.stats()["dropped"], 2)
+
+        for i in range(3):
+            queue.put(b"ack")
+        with self.assertRaises(QueueOverflow):
+            queue.put(b"ack")
+
+    def test_disconnect(self):
+        queue = OutboundQueue(max_depth=1, policy=OverflowPolicy.DISCONNECT)
+        queue.put(b"1", droppable=True)
+        with self.assertRaises(QueueOverflow):
+            queue.put(b"2", droppable=True)
+
+    def test_spill_keeps_order(self):
+        queue = OutboundQueue(max_depth=2, policy=OverflowPolicy.SPILL)
+        for i in range(7):
+            queue.put(bytes([i]) * 100, droppable=i % 2 == 0)
+        self.assertEqual(queue.stats()["depth"], 7)
+        self.assertEqual(queue.stats()["spilled"], 5)
+
+        taken = queue.take()
+        queue.put(b"late")
+        while len(queue) > 0:
+            taken.extend(queue.take())
+        self.assertEqual(taken, [bytes([i]) * 100 for i in range(7)] + [b"late"])
+        self.assertEqual(queue.stats()["dropped"], 0)
+        queue.close()
+
+
+class TestCoalescing(unittest.TestCase):
+    frames = [b"\x40\x02\x00" + bytes([i]) for i in range(100)] + [
+        (b"\x30\x05\x00\x01t", memoryview(b"xy"))
+    ]
+
+    def test_threaded(self):
+        ours, theirs = socket.socketpair()
+        self.addCleanup(theirs.close)
+        conn = SocketConnection(
+            0, ours, OutboundQueue(), coalesce_bytes=65536, coalesce_delay=0.05
+        )
+        for frame in self.frames:
+            conn.send(frame)
+        conn.close()
+
+        received = b""
+        while chunk := theirs.recv(65536):
+            received += chunk
+        self.assertEqual(received, b"".join(frame_buffers(self.frames)))
+        self.assertLess(conn.writes, 10)
+
+    def test_asyncio(self):
+        class Transport:
+            def __init__(self):
+                self.writes = []
+
+            def writelines(self, buffers):
+                self.writes.append(b"".join(buffers))
+
+            def is_closing(self):
+                return False
+
+        async def send(broker):
+            conn = MqttProtocol(broker)
+            conn.connection_made(Transport())
+            for frame in self.frames:
+                conn.send(frame)
+            await asyncio.sleep(0)
+            return conn.transport.writes
+
+        expected = b"".join(frame_buffers(self.frames))
+        self.assertEqual(asyncio.run(send(Broker())), [expected])
+        # A write every 100 bytes
+        writes = asyncio.run(send(Broker(coalesce_bytes=100)))
+        self.assertEqual(b"".join(writes), expected)
+        self.assertEqual(len(writes), 5)
+
+
+class TestInflightWindow(unittest.TestCase):
+    def test_window_and_queue(self):
+        window = InflightWindow(max_inflight=2)
+        topic = encode_topic("t")
+        m1 = window.submit(topic, QosLevel.AT_LEAST_ONCE, b"1")
+        m2 = window.submit(topic, QosLevel.EXACTLY_ONCE, b"2")
+        self.assertEqual((m1.packet_id, m2.packet_id), (1, 2))
+        self.assertIsNone(window.submit(topic, QosLevel.AT_LEAST_ONCE, b"3"))
+        self.assertEqual(len(window), 3)
+
+        # Wrong kind of ack, then a duplicate one
+        self.assertEqual(window.ack(1, InflightState.RELEASED), [])
+        [m3] = window.ack(1, InflightState.PUBLISHED)
+        self.assertEqual(window.ack(1, InflightState.PUBLISHED), [])
+        self.assertEqual((m3.packet_id, m3.payload), (3, b"3"))
+        self.assertEqual(m3.header + b"3", publish_frame("t", b"3", 1, b"\x00\x03"))
+
+        self.assertTrue(window.release(2))
+        self.assertFalse(window.release(3))
+        self.assertEqual(window.ack(2, InflightState.RELEASED), [])
+        self.assertEqual([m.packet_id for m in window.pending()], [3])
+
+    def test_packet_ids_wrap_and_skip_ids_in_use(self):
+        window = InflightWindow(max_inflight=2)
+        topic = encode_topic("t")
+        window.packet_id = 0xFFFE
+        m1 = window.submit(topic, QosLevel.AT_LEAST_ONCE, b"")
+        self.assertEqual(m1.packet_id, 0xFFFF)
+        window.packet_id = 0xFFFE
+        m2 = window.submit(topic, QosLevel.AT_LEAST_ONCE, b"")
+        self.assertEqual(m2.packet_id, 1)
+
+    def test_queue_overflow_drops_oldest(self):
+        dropped = []
+        window = InflightWindow(max_inflight=1, max_queued=2, on_drop=dropped.append)
+        topic = encode_topic("t")
+        for i in range(5):
+            window.submit(topic, QosLevel.AT_LEAST_ONCE, b"%d" % i, seq=i + 1)
+        self.assertEqual([m[4] for m in dropped], [2, 3])
+        self.assertEqual(window.dropped, 2)
+        [m] = window.ack(1, InflightState.PUBLISHED)
+        self.assertEqual(m.payload, b"3")
+
+    def test_queue_keeps_order_across_drops_and_acks(self):
+        window = InflightWindow(max_inflight=2, max_queued=5)
+        topic = encode_topic("t")
+        for i in range(20):
+            window.submit(topic, QosLevel.AT_LEAST_ONCE, b"%d" % i)
+        self.assertEqual(len(window), 7)
+
+        sent = []
+        while len(window) > 0:
+            message = window.pending()[0]
+            sent.append(message.payload)
+            window.ack(message.packet_id, InflightState.PUBLISHED)
+            if len(sent) == 3:
+                window.submit(topic, QosLevel.AT_LEAST_ONCE, b"20")
+        self.assertEqual(sent, [b"0", b"1", b"15", b"16", b"17", b"18", b"19", b"20"])
+
+
+class TestRetainedStore(unittest.TestCase):
+    def topics(self, store, topic_filter):
+        return sorted(m.topic for m in store.match(topic_filter))
+
+    def test_match(self):
+        store = RetainedStore()
+        for topic in ["a", "a/b", "a/b/c", "a/x/c", "b/b", "$SYS/uptime"]:
+            store.set(topic, QosLevel.AT_MOST_ONCE, topic.encode())
+
+        self.assertEqual(self.topics(store, "a/b"), ["a/b"])
+        self.assertEqual(self.topics(store, "a/+"), ["a/b"])
+        self.assertEqual(self.topics(store, "a/+/c"), ["a/b/c", "a/x/c"])
+        self.assertEqual(self.topics(store, "a/#"), ["a", "a/b", "a/b/c", "a/x/c"])
+        self.assertEqual(self.topics(store, "+/b"), ["a/b", "b/b"])
+        self.assertEqual(len(store.match("#")), 5)
+        self.assertEqual(self.topics(store, "$SYS/#"), ["$SYS/uptime"])
+        self.assertEqual(self.topics(store, "c/#"), [])
+
+    def test_empty_payload_clears(self):
+        store = RetainedStore()
+        store.set("a/b", QosLevel.AT_LEAST_ONCE, b"1")
+        store.set("a/b", QosLevel.AT_LEAST_ONCE, b"2")
+        self.assertEqual(store.get("a/b").payload, b"2")
+        store.set("a/b", QosLevel.AT_MOST_ONCE, b"")
+        self.assertIsNone(store.get("a/b"))
+        self.assertEqual(store.match("#"), [])
+        self.assertEqual(store.root.children, {})
+        self.assertEqual(store.memory, 0)
+
+    def test_memory_cap_evicts_oldest(self):
+        size = RetainedStore.OVERHEAD + 101
+        store = RetainedStore(max_memory=3 * size)
+        for topic in "abcd":
+            store.set(topic, QosLevel.AT_MOST_ONCE, b"x" * 100)
+        self.assertEqual(sorted(store.messages), ["b", "c", "d"])
+        self.assertEqual(store.stats(), {"messages": 3, "memory": 3 * size, "evicted": 1})
+
+
+class TestMetrics(unittest.TestCase):
+    def test_threads(self):
+        metrics = Metrics()
+
+        def work():
+            for _ in range(100):
+                metrics.record(3, 10, 1500)
+            metrics.counters().bytes_out += 7
+
+        for _ in range(10):
+            thread = threading.Thread(target=work)
+            thread.start()
+            thread.join()
+        work()
+
+        snapshot = metrics.snapshot()
+        # Only counters of live threads are kept apart
+        self.assertEqual(len(metrics.threads), 1)
+        self.assertEqual(snapshot["bytes"], {"received": 11000, "sent": 77})
+        self.assertEqual(snapshot["messages"]["received"], 1100)
+        self.assertEqual(
+            snapshot["packets"]["publish"]["latency_us"],
+            {"p50": 2, "p99": 2, "p999": 2},
+        )
+
+    def test_percentile(self):
+        buckets = [0] * 8
+        buckets[3] = 90
+        buckets[6] = 10
+        self.assertEqual(percentile(buckets, 0.5), 8)
+        self.assertEqual(percentile(buckets, 0.9), 8)
+        self.assertEqual(percentile(buckets, 0.99), 64)
+        self.assertEqual(percentile([0] * 8, 0.5), 0)
+
+    def test_sys_topics(self):
+        broker = Broker()
+        self.assertEqual(
+            sys_topics({"a": {"b": 1, "histogram": [1, 2]}, "c": 2}),
+            {"$SYS/broker/a/b": "1", "$SYS/broker/c": "2"},
+        )
+
+        broker.publish_sys()
+        message = broker.retained.get("$SYS/broker/clients/connected")
+        self.assertEqual(message.payload, b"0")
+        self.assertIsNotNone(broker.retained.get("$SYS/broker/uptime"))
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TestShareGroup(unittest.TestCase):
+    class Conn:
+        def __init__(self, inflight):
+            self.session = Session("c", max_inflight=2)
+            for _ in range(inflight):
+                self.session.inflight.submit(b"t", QosLevel.AT_LEAST_ONCE, b"")
+
+    def pick(self, group, strategy, topic, clients):
+        conn, _ = group.pick(strategy, topic, clients)
+        return next(c for c, other in clients.items() if other is conn)
+
+    def test_strategies(self):
+        group = ShareGroup("g", "jobs/#")
+        clients = {"a": self.Conn(3), "b": self.Conn(1), "c": self.Conn(2)}
+        for client_id in ["a", "b", "c", "offline"]:
+            group.members[client_id] = QosLevel.AT_LEAST_ONCE
+
+        picked = [
+            self.pick(group, ShareStrategy.ROUND_ROBIN, b"jobs", clients)
+            for _ in range(6)
+        ]
+        self.assertEqual(sorted(picked), ["a", "a", "b", "b", "c", "c"])
+
+        for _ in range(3):
+            self.assertEqual(
+                self.pick(group, ShareStrategy.LEAST_INFLIGHT, b"jobs", clients), "b"
+            )
+
+        topics = [f"jobs/{i}".encode() for i in range(20)]
+        first = [self.pick(group, ShareStrategy.STICKY, t, clients) for t in topics]
+        again = [self.pick(group, ShareStrategy.STICKY, t, clients) for t in topics]
+        self.assertEqual(first, again)
+        self.assertEqual(set(first), {"a", "b", "c"})
+
+        self.assertIsNone(group.pick(ShareStrategy.ROUND_ROBIN, b"jobs", {}))
+
+
+class TestAdmission(unittest.TestCase):
+    def test_token_bucket(self):
+        clock = FakeClock()
+        bucket = TokenBucket(rate=10, burst=3, clock=clock)
+        self.assertEqual([bucket.take() for _ in range(4)], [True] * 3 + [False])
+        clock.now = 0.15
+        self.assertTrue(bucket.take())
+        self.assertFalse(bucket.take())
+        clock.now = 10
+        self.assertEqual([bucket.take() for _ in range(4)], [True] * 3 + [False])
+
+    def test_half_open_and_max_connections(self):
+        admission = Admission(max_half_open=2, max_connections=3)
+        self.assertEqual([admission.accept() for _ in range(3)], [True, True, False])
+        admission.release()
+        self.assertTrue(admission.accept())
+        self.assertFalse(admission.full(2))
+        self.assertTrue(admission.full(3))
+        self.assertEqual(admission.stats()["refused"], 1)
+        self.assertEqual(admission.stats()["rejected"], 1)
+        self.assertEqual(admission.stats()["half_open"], 2)
+
+    def test_throttle(self):
+        clock = FakeClock()
+        bucket = TokenBucket(rate=10, burst=2, clock=clock)
+        self.assertEqual([bucket.charge() for _ in range(3)], [0, 0, 0.1])
+        self.assertAlmostEqual(bucket.charge(2), 0.3)
+        clock.now = 0.3
+        self.assertEqual(bucket.charge(), 0.1)
+
+        throttle = Throttle(client_byte_rate=1000, prefixes={"a/": (1, 0)})
+        limit = throttle.client_limit()
+        self.assertEqual(throttle.charge(limit, "b/c", 1000), 0)
+        self.assertGreater(throttle.charge(limit, "b/c", 100), 0)
+        self.assertIsNone(Throttle(prefixes={"a/": (1, 0)}).client_limit())
+        self.assertEqual(throttle.charge(None, "a/b", 10), 0)
+        self.assertGreater(throttle.charge(None, "a/b", 10), 0)
+        self.assertEqual(throttle.prefix_throttled, {"a/": 1})
+
+
+class TestFanOut(unittest.TestCase):
+    def test_order_per_subscriber(self):
+        fanout = FanOut(threshold=10, chunk_size=3, workers=3)
+        received = {i: [] for i in range(20)}
+        lock = threading.Lock()
+
+        def deliver(message, subscribers):
+            with lock:
+                for subscriber, _ in subscribers:
+                    received[subscriber].append(message)
+
+        everyone = {i: QosLevel.AT_MOST_ONCE for i in range(20)}
+        few = {i: QosLevel.AT_MOST_ONCE for i in range(5)}
+
+        # Not started: everything is left to the caller
+        self.assertFalse(fanout.submit(everyone, lambda subscribers: None))
+
+        fanout.start_threads()
+        for message in range(50):
+            subscribers = everyone if message % 5 == 0 else few
+            if not fanout.submit(subscribers, lambda s, m=message: deliver(m, s)):
+                deliver(message, subscribers.items())
+
+        deadline = time.monotonic() + 5
+        while fanout.pending > 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        for i in range(5):
+            self.assertEqual(received[i], list(range(50)))
+        for i in range(5, 20):
+            self.assertEqual(received[i], list(range(0, 50, 5)))
+        self.assertGreaterEqual(fanout.stats()["broadcasts"], 10)
+
+
+class TestTimerWheel(unittest.TestCase):
+    def test_timers_fire_in_order(self):
+        clock = FakeClock()
+        wheel = TimerWheel(tick=1, clock=clock)
+        fired = []
+        delays = [1, 5, 63, 64, 65, 200, 4095, 4096, 5000, 262143, 262144, 300000]
+        for delay in delays:
+            wheel.schedule(delay, fired.append, delay)
+        self.assertEqual(len(wheel), len(delays))
+
+        for delay in delays:
+            clock.now = delay - 1
+            wheel.advance()
+            self.assertNotIn(delay, fired)
+            clock.now = delay
+            wheel.advance()
+            self.assertEqual(fired[-1], delay)
+        self.assertEqual(fired, delays)
+        self.assertEqual(len(wheel), 0)
+
+    def test_cancel(self):
+        clock = FakeClock()
+        wheel = TimerWheel(tick=1, clock=clock)
+        fired = []
+        timer = wheel.schedule(3, fired.append, "cancelled")
+        wheel.schedule(3, fired.append, "kept")
+        timer.cancel()
+        clock.now = 10
+        self.assertEqual(wheel.advance(), 1)
+        self.assertEqual(fired, ["kept"])
+
+    def test_callbacks_can_reschedule(self):
+        clock = FakeClock()
+        wheel = TimerWheel(tick=1, clock=clock)
+        fired = []
+
+        def callback(n):
+            fired.append(clock.now)
+            if n > 0:
+                wheel.schedule(2, callback, n - 1)
+
+        wheel.schedule(2, callback, 2)
+        for now in range(10):
+            clock.now = now
+            wheel.advance()
+        self.assertEqual(fired, [2, 4, 6])
+
+    def test_tick_cost_is_independent_of_pending_timers(self):
+        clock = FakeClock()
+        wheel = TimerWheel(tick=1, clock=clock)
+        for i in range(100000):
+            wheel.schedule(1000 + i % 1000, lambda: None)
+        wheel.schedule(1, lambda: None)
+        clock.now = 1
+        self.assertEqual(wheel.advance(), 1)
+
+
+class TestWriteAheadLog(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+
+    def open(self, **kwargs):
+        log = WriteAheadLog(self.dir.name, commit_interval=60, **kwargs)
+        state = log.replay()
+        log.start()
+        return log, state
+
+    def test_replay(self):
+        log, _ = self.open()
+        log.append(RecordType.SESSION, "c")
+        log.append(RecordType.SUBSCRIBE, "c", "a/#", 1)
+        log.append(RecordType.ENQUEUE, "c", 1, 1, False, b"\x00\x01t", b"one")
+        log.append(RecordType.ENQUEUE, "c", 2, 2, True, b"\x00\x01t", b"two")
+        log.append(RecordType.ENQUEUE, "c", 3, 2, False, b"\x00\x01t", b"three")
+        log.append(RecordType.ACK, "c", 1)
+        log.append(RecordType.RELEASE, "c", 3, 7)
+        log.append(RecordType.INCOMING, "c", 9, False, "in", b"x")
+        log.append(RecordType.RETAIN, 0, "r", b"kept")
+        log.append(RecordType.SESSION, "gone")
+        log.append(RecordType.DROP_SESSION, "gone")
+        log.close()
+
+        # A record the broker crashed in the middle of writing
+        path = os.path.join(self.dir.name, "segment-00000001.log")
+        with open(path, "ab") as f:
+            f.write(b"\x00\x00\x00\x00\x00\x00\x00\x30\x05partial")
+
+        log, state = self.open()
+        log.close()
+        self.assertEqual(list(state.sessions), ["c"])
+        self.assertEqual(state.retained, {"r": (0, b"kept")})
+        session = state.sessions["c"]
+        self.assertEqual(session.subscriptions, {"a/#": 1})
+        self.assertEqual(list(session.messages), [2, 3])
+        self.assertEqual(session.messages[2].payload, b"two")
+        self.assertTrue(session.messages[2].retain)
+        self.assertEqual(session.messages[3].packet_id, 7)
+        self.assertEqual(session.incoming, {9: ("in", b"x", False)})
+
+    def test_compaction(self):
+        log, _ = self.open(segment_size=256)
+        log.append(RecordType.SESSION, "c")
+        for seq in range(1, 101):
+            log.append(RecordType.ENQUEUE, "c", seq, 1, False, b"\x00\x01t", b"x")
+            if seq % 10 != 0:
+                log.append(RecordType.ACK, "c", seq)
+            log.commit()
+        self.assertGreater(len(os.listdir(self.dir.name)), 10)
+
+        log.compact()
+        log.append(RecordType.ACK, "c", 100)
+        log.close()
+        snapshot, segment = sorted(os.listdir(self.dir.name))[::-1]
+        self.assertTrue(snapshot.startswith("snapshot-"))
+        self.assertTrue(segment.startswith("segment-"))
+
+        _, state = self.open()
+        self.assertEqual(list(state.sessions["c"].messages), list(range(10, 100, 10)))
+
+
+class TestOfflineQueue(unittest.TestCase):
+    def test_spill_keeps_order(self):
+        budget = OfflineBudget(max_memory=1000)
+        dropped = []
+        first = OfflineQueue(
+            budget, max_memory=400, max_spill=1900, on_drop=dropped.append
+        )
+        second = OfflineQueue(budget, max_memory=1000)
+        messages = [
+            (b"t", QosLevel.AT_LEAST_ONCE, bytes([i]) * 100, False, i)
+            for i in range(20)
+        ]
+        for message in messages[:10]:
+            first.put(*message)
+        self.assertEqual(first.stats()["spilled"], 9)
+
+        # The shared budget is what's left after the first queue
+        for message in messages[:10]:
+            second.put(*message)
+        self.assertEqual(second.stats()["spilled"], 7)
+
+        taken = first.take(3)
+        for message in messages[10:]:
+            first.put(*message)
+        while len(first) > 0:
+            taken.extend(first.take(4))
+        self.assertEqual(taken, messages[:19])
+        self.assertEqual(first.stats()["dropped"], 1)
+        self.assertEqual(dropped, [messages[19]])
+
+        second.close()
+        first.close()
+        self.assertEqual(budget.used, 0)
+
+    def test_fan_out_shares_records(self):
+        budget = OfflineBudget()
+        queues = [OfflineQueue(budget) for _ in range(3)]
+        payload = b"x" * 10
+        for queue in queues:
+            queue.put(b"t", QosLevel.AT_LEAST_ONCE, payload, False, 0)
+        records = [queue.take(1)[0] for queue in queues]
+        self.assertIs(records[0], records[1])
+        self.assertIs(records[1], records[2])
+
+        # Stored sessions number their messages, so nothing is shared
+        queues[0].put(b"t", QosLevel.AT_LEAST_ONCE, payload, False, 1)
+        queues[1].put(b"t", QosLevel.AT_LEAST_ONCE, payload, False, 2)
+        self.assertEqual(queues[1].take(1)[0][4], 2)
+
+
+class BrokerClient:
+    """
+    Minimal blocking client used to drive a running broker.
+    """
+
+    def __init__(self, address, client_id="", keep_alive=60, clean=True):
+        self.sock = socket.create_connection(address, timeout=5)
+        self.buffer = b""
+        flags = 0x02 if clean else 0x00
+        self.sock.sendall(connect_frame(client_id, keep_alive, flags))
+        connack = self.recv()
+        assert connack[:2] == b"\x20\x02" and connack[3] == 0, connack
+        self.session_present = connack[2] == 1
+
+    def recv(self) -> bytes:
+        """
+        Returns the next complete frame sent by the broker.
+        """
+        while True:
+            if len(self.buffer) >= 2:
+                decoder = Decoder(self.buffer)
+                decoder.byte()
+                try:
+                    length = decoder.varint()
+                except IndexError:
+                    length = None
+                if length is not None:
+                    total = decoder.num_bytes_consumed() + length
+                    if len(self.buffer) >= total:
+                        data, self.buffer = self.buffer[:total], self.buffer[total:]
+                        return data
+
+            chunk = self.sock.recv(65536)
+            if not chunk:
+                raise ConnectionError("broker closed the connection")
+            self.buffer += chunk
+
+    def send(self, data):
+        self.sock.sendall(data)
+
+    def subscribe(self, topic, qos=0, packet_id=b"\x00\x01"):
+        self.send(subscribe_frame(packet_id, topic, qos))
+        suback = self.recv()
+        assert suback[:4] == b"\x90\x03" + packet_id, suback
+
+    def assert_recv(self, expected):
+        data = self.recv()
+        if data != expected:
+            raise AssertionError(f"{data!r} != {expected!r}")
+
+    def close(self):
+        self.sock.close()
+
+
+class ServerModeTests:
+    """
+    End-to-end flows run against every server mode.
+    """
+
+    def start_server(self):
+        raise NotImplementedError
+
+    def setUp(self):
+        self.address = self.start_server()
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        self.stop_server()
+
+    def client(self, client_id="", keep_alive=60, clean=True):
+        client = BrokerClient(self.address, client_id, keep_alive, clean)
+        self.clients.append(client)
+        return client
+
+    def test_qos0_forwarding(self):
+        sub = self.client("sub")
+        sub.subscribe("a/b")
+        pub = self.client("pub")
+        pub.send(publish_frame("a/b", b"hello"))
+        sub.assert_recv(publish_frame("a/b", b"hello"))
+
+    def test_qos1_forwarding(self):
+        sub = self.client("sub")
+        sub.subscribe("a/b", qos=1)
+        pub = self.client("pub")
+        pub.send(publish_frame("a/b", b"hello", qos=1, packet_id=b"\x00\x07"))
+        pub.assert_recv(b"\x40\x02\x00\x07")
+        data = sub.recv()
+        self.assertEqual(data[0] & 0xF0, 0x30)
+        self.assertTrue(data.endswith(b"hello"))
+
+    def test_large_publish_in_fragments(self):
+        sub = self.client("sub")
+        sub.subscribe("big")
+        pub = self.client("pub")
+        # Not valid UTF-8: payloads are forwarded as they are
+        data = publish_frame("big", bytes(range(256)) * 400)
+        for i in range(0, len(data), 1000):
+            pub.send(data[i : i + 1000])
+        sub.assert_recv(data)
+
+    def test_slow_subscriber_does_not_block_publisher(self):
+        self.server.broker.max_queue_depth = 10
+        slow = self.client("slow")
+        slow.subscribe("firehose")
+        pub = self.client("pub")
+        for i in range(200):
+            pub.send(publish_frame("firehose", b"x" * 65536))
+        pub.send(b"\xc0\x00")
+        pub.assert_recv(b"\xd0\x00")
+        self.assertGreater(self.server.broker.queue_stats()["slow"]["dropped"], 0)
+
+    def test_wildcard_forwarding(self):
+        sub = self.client("sub")
+        sub.subscribe("a/+/c")
+        sub.subscribe("x/#", packet_id=b"\x00\x02")
+        pub = self.client("pub")
+        pub.send(publish_frame("a/b/c", b"1"))
+        sub.assert_recv(publish_frame("a/b/c", b"1"))
+        pub.send(publish_frame("x", b"2"))
+        sub.assert_recv(publish_frame("x", b"2"))
+
+        sub.send(frame(0xA2, b"\x00\x03" + string("x/#")))
+        sub.assert_recv(b"\xb0\x02\x00\x03")
+        pub.send(publish_frame("x/y", b"3"))
+        pub.send(publish_frame("a/z/c", b"4"))
+        sub.assert_recv(publish_frame("a/z/c", b"4"))
+
+    def test_qos_downgrade(self):
+        sub = self.client("sub")
+        sub.subscribe("a", qos=0)
+        pub = self.client("pub")
+        pub.send(publish_frame("a", b"hi", qos=1, packet_id=b"\x00\x07"))
+        pub.assert_recv(b"\x40\x02\x00\x07")
+        sub.assert_recv(publish_frame("a", b"hi"))
+
+    def test_packet_ids_are_per_subscriber(self):
+        sub = self.client("sub")
+        sub.subscribe("a", qos=1)
+        pub1 = self.client("pub1")
+        pub2 = self.client("pub2")
+        pub1.send(publish_frame("a", b"1", qos=1, packet_id=b"\x00\x07"))
+        pub1.assert_recv(b"\x40\x02\x00\x07")
+        pub2.send(publish_frame("a", b"2", qos=1, packet_id=b"\x00\x07"))
+        pub2.assert_recv(b"\x40\x02\x00\x07")
+
+        # Both publishers used packet id 7; the subscriber sees ids 1 and 2
+        received = {sub.recv(), sub.recv()}
+        self.assertEqual(len(received), 2)
+        for data in received:
+            self.assertIn(data[-3:-1], [b"\x00\x01", b"\x00\x02"])
+        broker = self.server.broker
+        self.assertEqual(len(broker.sessions["sub"].inflight), 2)
+        sub.send(b"\x40\x02\x00\x01")
+        sub.send(b"\x40\x02\x00\x02")
+        sub.send(b"\xc0\x00")
+        sub.assert_recv(b"\xd0\x00")
+        self.assertEqual(len(broker.sessions["sub"].inflight), 0)
+
+    def test_qos2_flow(self):
+        sub = self.client("sub")
+        sub.subscribe("a", qos=2)
+        pub = self.client("pub")
+        pub.send(publish_frame("a", b"hi", qos=2, packet_id=b"\x00\x09"))
+        pub.assert_recv(b"\x50\x02\x00\x09")
+        pub.send(b"\x62\x02\x00\x09")
+        pub.assert_recv(b"\x70\x02\x00\x09")
+
+        sub.assert_recv(publish_frame("a", b"hi", qos=2, packet_id=b"\x00\x01"))
+        sub.send(b"\x50\x02\x00\x01")
+        sub.assert_recv(b"\x62\x02\x00\x01")
+        sub.send(b"\x70\x02\x00\x01")
+        sub.send(b"\xc0\x00")
+        sub.assert_recv(b"\xd0\x00")
+        self.assertEqual(len(self.server.broker.sessions["sub"].inflight), 0)
+
+    def test_retransmission_with_dup_flag(self):
+        broker = self.server.broker
+        broker.retry_interval = 0.2
+        broker.max_retries = 2
+        sub = self.client("sub")
+        sub.subscribe("a", qos=1)
+        pub = self.client("pub")
+        pub.send(publish_frame("a", b"hi", qos=1, packet_id=b"\x00\x07"))
+        pub.assert_recv(b"\x40\x02\x00\x07")
+
+        data = publish_frame("a", b"hi", qos=1, packet_id=b"\x00\x01")
+        sub.assert_recv(data)
+        dup = bytes([data[0] | 0x08]) + data[1:]
+        sub.assert_recv(dup)
+        sub.assert_recv(dup)
+
+        # Out of retries: the broker gives up on the client
+        with self.assertRaises(ConnectionError):
+            sub.recv()
+
+    def test_keep_alive_expiry(self):
+        client = self.client(keep_alive=1)
+        client.send(b"\xc0\x00")
+        client.assert_recv(b"\xd0\x00")
+        with self.assertRaises(ConnectionError):
+            client.recv()
+
+    def test_connect_timeout(self):
+        self.server.broker.admission.connect_timeout = 0.2
+        sock = socket.create_connection(self.address, timeout=5)
+        self.addCleanup(sock.close)
+        self.assertEqual(sock.recv(1), b"")
+        self.assertEqual(self.server.broker.admission.stats()["timed_out"], 1)
+
+    def test_max_connections(self):
+        self.server.broker.admission.max_connections = 1
+        first = self.client("first")
+        with self.assertRaises(AssertionError):
+            self.client("second")
+
+        # A client taking over its own id is let in, and the connection it
+        # replaces is closed
+        again = self.client("first")
+        with self.assertRaises(ConnectionError):
+            first.recv()
+        again.send(b"\xc0\x00")
+        again.assert_recv(b"\xd0\x00")
+        stats = self.server.broker.admission.stats()
+        self.assertEqual((stats["rejected"], stats["taken_over"]), (1, 1))
+
+    def test_publish_throttling(self):
+        broker = self.server.broker
+        broker.throttle = Throttle(client_message_rate=20)
+        sub = self.client("sub")
+        sub.subscribe("a/b")
+        pub = self.client("pub")
+        start = time.monotonic()
+        for i in range(30):
+            pub.send(publish_frame("a/b", b"%d" % i))
+        pub.send(b"\xc0\x00")
+
+        # Handled once the 10 messages over the burst were paid for, and
+        # nothing was dropped meanwhile
+        pub.assert_recv(b"\xd0\x00")
+        self.assertGreater(time.monotonic() - start, 0.45)
+        for i in range(30):
+            sub.assert_recv(publish_frame("a/b", b"%d" % i))
+        throttled = broker.throttle_stats()["clients"]["pub"]
+        self.assertGreater(throttled, 5)
+        self.assertEqual(broker.metrics_snapshot()["messages"]["throttled"], throttled)
+
+    def test_chunked_fan_out(self):
+        fanout = self.server.broker.fanout
+        fanout.threshold = 3
+        fanout.chunk_size = 2
+        subs = [self.client(f"sub-{i}") for i in range(5)]
+        for sub in subs:
+            sub.subscribe("notice", qos=1)
+        pub = self.client("pub")
+        pub.send(publish_frame("notice", b"first", qos=1, packet_id=b"\x00\x01"))
+        pub.assert_recv(b"\x40\x02\x00\x01")
+        for i in range(10):
+            pub.send(publish_frame("notice", b"%d" % i))
+
+        for sub in subs:
+            data = sub.recv()
+            self.assertEqual(data[0] & 0xF0, 0x30)
+            self.assertTrue(data.endswith(b"first"))
+            for i in range(10):
+                sub.assert_recv(publish_frame("notice", b"%d" % i))
+        self.assertGreater(fanout.stats()["chunks"], 2)
+
+    def test_packets_before_connect_close_connection(self):
+        sub = self.client("sub")
+        sub.subscribe("a/b")
+        for packet in [
+            publish_frame("a/b", b"early", qos=1, packet_id=b"\x00\x01"),
+            b"\x82\x08\x00\x01\x00\x03a/b\x00",
+            b"\x40\x02\x00\x01",
+        ]:
+            with socket.create_connection(self.address) as sock:
+                sock.settimeout(5)
+                sock.sendall(packet)
+                self.assertEqual(sock.recv(16), b"")
+
+        # Nothing of it was forwarded
+        sub.send(b"\xc0\x00")
+        sub.assert_recv(b"\xd0\x00")
+
+    def test_malformed_packet_closes_connection(self):
+        client = self.client("bad")
+        # SUBSCRIBE cut off in its first topic filter
+        client.send(b"\x82\x03\x00\x01\x00")
+        with self.assertRaises(ConnectionError):
+            client.recv()
+
+    def test_max_packet_size(self):
+        self.server.broker.max_packet_size = 100
+        client = self.client("big")
+        client.send(publish_frame("a/b", b"x" * 200))
+        with self.assertRaises(ConnectionError):
+            client.recv()
+
+    def test_retained_messages(self):
+        pub = self.client("pub")
+        pub.send(publish_frame("r/1", b"one", retain=True))
+        pub.send(publish_frame("r/2", b"two", qos=1, packet_id=b"\x00\x01", retain=True))
+        pub.assert_recv(b"\x40\x02\x00\x01")
+        pub.send(publish_frame("r/3", b"three", retain=True))
+        pub.send(publish_frame("r/3", b"", retain=True))
+        pub.send(b"\xc0\x00")
+        pub.assert_recv(b"\xd0\x00")
+
+        sub = self.client("sub")
+        sub.subscribe("r/+", qos=1)
+        received = {sub.recv(), sub.recv()}
+        self.assertEqual(
+            received,
+            {
+                publish_frame("r/1", b"one", retain=True),
+                publish_frame("r/2", b"two", qos=1, packet_id=b"\x00\x01", retain=True),
+            },
+        )
+
+        # Live messages are forwarded with RETAIN cleared
+        pub.send(publish_frame("r/1", b"new", retain=True))
+        sub.assert_recv(publish_frame("r/1", b"new"))
+
+    def test_shared_subscription(self):
+        members = [self.client(f"m{i}") for i in range(2)]
+        for member in members:
+            member.subscribe("$share/g/jobs/+")
+        other = self.client("other")
+        other.subscribe("jobs/#")
+
+        pub = self.client("pub")
+        frames = [publish_frame(f"jobs/{i}", b"job") for i in range(4)]
+        for frame in frames:
+            pub.send(frame)
+
+        # Split between the members; plain subscribers still get everything
+        received = [member.recv() for member in members for _ in range(2)]
+        self.assertEqual(sorted(received), frames)
+        for frame in frames:
+            other.assert_recv(frame)
+
+    def test_shared_subscription_redistribution(self):
+        first = self.client("first")
+        first.subscribe("$share/g/jobs", qos=1)
+        pub = self.client("pub")
+        pub.send(publish_frame("jobs", b"j1", qos=1, packet_id=b"\x00\x01"))
+        pub.assert_recv(b"\x40\x02\x00\x01")
+        self.assertTrue(first.recv().endswith(b"j1"))
+
+        second = self.client("second")
+        second.subscribe("$share/g/jobs", qos=1)
+
+        # Unacked when the first member leaves: the second one takes over
+        first.close()
+        data = second.recv()
+        self.assertEqual(data[0], 0x32)
+        self.assertTrue(data.endswith(b"j1"))
+
+    def test_pingreq(self):
+        client = self.client()
+        client.send(b"\xc0\x00")
+        client.assert_recv(b"\xd0\x00")
+
+    def test_metrics(self):
+        sub = self.client("sub")
+        sub.subscribe("a", qos=1)
+        pub = self.client("pub")
+        pub.send(publish_frame("a", b"x", qos=1, packet_id=b"\x00\x01"))
+        pub.assert_recv(b"\x40\x02\x00\x01")
+        sub.recv()
+
+        # Counted once handled, which may be after the response went out
+        broker = self.server.broker
+        deadline = time.monotonic() + 5
+        while broker.metrics_snapshot()["bytes"]["sent"] < 4 + 5 + 4 + 8:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+        snapshot = broker.metrics_snapshot()
+        self.assertEqual(snapshot["clients"]["connected"], 2)
+        self.assertEqual(snapshot["clients"]["total"], 2)
+        self.assertEqual(snapshot["clients"]["half_open"], 0)
+        self.assertEqual(snapshot["messages"]["received"], 1)
+        self.assertEqual(snapshot["messages"]["sent"], 1)
+        self.assertEqual(snapshot["messages"]["inflight"], 1)
+        self.assertEqual(snapshot["subscriptions"], 1)
+        self.assertEqual(snapshot["packets"]["connect"]["received"], 2)
+        self.assertGreater(snapshot["packets"]["publish"]["latency_us"]["p50"], 0)
+
+    def test_packet_trace_sampling(self):
+        self.server.broker.trace_sample = 3
+        with self.assertLogs("broker.packets", "DEBUG") as logs:
+            client = self.client()
+            for _ in range(5):
+                client.send(b"\xc0\x00")
+                client.assert_recv(b"\xd0\x00")
+
+        # CONNECT and 5 PINGREQs: every third packet is traced
+        received = [line for line in logs.output if "Received:" in line]
+        self.assertEqual(len(received), 2)
+
+    def test_persistent_session(self):
+        sub = self.client("sub", clean=False)
+        self.assertFalse(sub.session_present)
+        sub.subscribe("a/b")
+        sub.close()
+
+        # Resumed without subscribing again
+        sub = self.client("sub", clean=False)
+        self.assertTrue(sub.session_present)
+        pub = self.client("pub")
+        pub.send(publish_frame("a/b", b"1"))
+        sub.assert_recv(publish_frame("a/b", b"1"))
+        sub.close()
+
+        # A clean session replaces it
+        sub = self.client("sub")
+        self.assertFalse(sub.session_present)
+        pub.send(publish_frame("a/b", b"2"))
+        pub.send(b"\xc0\x00")
+        pub.assert_recv(b"\xd0\x00")
+        sub.send(b"\xc0\x00")
+        sub.assert_recv(b"\xd0\x00")
+
+    def test_offline_queue(self):
+        broker = self.server.broker
+        broker.max_inflight = 2
+        broker.offline_memory = 500
+        sub = self.client("sub", clean=False)
+        sub.subscribe("a/+", qos=1)
+        sub.send(b"\xe0\x00")
+        while broker.clients.get("sub") is not None:
+            time.sleep(0.01)
+
+        pub = self.client("pub")
+        for i in range(10):
+            packet_id = (i + 1).to_bytes(2, "big")
+            pub.send(publish_frame("a/b", b"%d" % i, qos=1, packet_id=packet_id))
+            pub.assert_recv(b"\x40\x02" + packet_id)
+        pub.send(publish_frame("a/b", b"dropped"))
+        pub.send(b"\xc0\x00")
+        pub.assert_recv(b"\xd0\x00")
+        self.assertEqual(broker.metrics_snapshot()["messages"]["offline"], 10)
+
+        # Drained into the inflight window as the client acks
+        sub = self.client("sub", clean=False)
+        self.assertTrue(sub.session_present)
+        for i in range(10):
+            data = sub.recv()
+            self.assertEqual(data[0], 0x32)
+            self.assertTrue(data.endswith(b"a/b" + data[7:9] + b"%d" % i))
+            sub.send(b"\x40\x02" + data[7:9])
+        pub.send(publish_frame("a/b", b"live", qos=1, packet_id=b"\x00\x0a"))
+        self.assertTrue(sub.recv().endswith(b"live"))
+
+
+class TestThreadedServer(ServerModeTests, unittest.TestCase):
+    def start_server(self):
+        self.server = Server(("localhost", 0), Handler)
+        threading.Thread(
+            target=self.server.serve_forever, args=(0.05,), daemon=True
+        ).start()
+        return self.server.server_address
+
+    def stop_server(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class TestAsyncServer(ServerModeTests, unittest.TestCase):
+    def start_server(self):
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        self.server = AsyncServer(("localhost", 0))
+        asyncio.run_coroutine_threadsafe(self.server.start(), self.loop).result()
+        return self.server.address()
+
+    def stop_server(self):
+        asyncio.run_coroutine_threadsafe(self.server.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+class TestPersistence(unittest.TestCase):
+    """
+    Persistent sessions surviving a broker restart.
+    """
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.clients = []
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+
+    def start_server(self, **kwargs):
+        store = WriteAheadLog(self.dir.name, commit_interval=0.01)
+        self.server = Server(("localhost", 0), Handler, Broker(store=store, **kwargs))
+        threading.Thread(
+            target=self.server.serve_forever, args=(0.05,), daemon=True
+        ).start()
+
+    def stop_server(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.server.broker.close()
+
+    def client(self, client_id, clean=True):
+        client = BrokerClient(self.server.server_address, client_id, clean=clean)
+        self.clients.append(client)
+        return client
+
+    def test_session_survives_restart(self):
+        self.start_server()
+        sub = self.client("sub", clean=False)
+        sub.subscribe("a/b", qos=1)
+        pub = self.client("pub")
+        pub.send(publish_frame("a/b", b"unacked", qos=1, packet_id=b"\x00\x01"))
+        pub.assert_recv(b"\x40\x02\x00\x01")
+        first = sub.recv()
+        self.assertTrue(first.endswith(b"unacked"))
+        pub.send(publish_frame("r", b"kept", retain=True))
+        pub.send(b"\xc0\x00")
+        pub.assert_recv(b"\xd0\x00")
+        self.stop_server()
+
+        self.start_server()
+        sub = self.client("sub", clean=False)
+        self.assertTrue(sub.session_present)
+
+        # The unacked message comes again, flagged as a duplicate
+        data = sub.recv()
+        self.assertEqual(data[0], 0x3A)
+        self.assertTrue(data.endswith(b"unacked"))
+        sub.send(b"\x40\x02" + data[7:9])
+
+        # The subscription and the retained message are back too
+        pub = self.client("pub")
+        pub.send(publish_frame("a/b", b"again"))
+        sub.assert_recv(publish_frame("a/b", b"again"))
+        sub.subscribe("r", packet_id=b"\x00\x02")
+        sub.assert_recv(publish_frame("r", b"kept", retain=True))
+        self.stop_server()
+
+        # Acked before the restart, so not sent again
+        self.start_server()
+        sub = self.client("sub", clean=False)
+        sub.send(b"\xc0\x00")
+        sub.assert_recv(b"\xd0\x00")
+        self.stop_server()
+
+    def test_dropped_messages_are_not_restored(self):
+        self.start_server(max_inflight=1, max_queued=2)
+        sub = self.client("sub", clean=False)
+        sub.subscribe("a/b", qos=1)
+        pub = self.client("pub")
+        for i in range(5):
+            packet_id = (i + 1).to_bytes(2, "big")
+            pub.send(publish_frame("a/b", b"%d" % i, qos=1, packet_id=packet_id))
+            pub.assert_recv(b"\x40\x02" + packet_id)
+        self.assertTrue(sub.recv().endswith(b"0"))
+        snapshot = self.server.broker.metrics_snapshot()
+        self.assertEqual(snapshot["messages"]["dropped"], 2)
+        sub.close()
+        self.stop_server()
+
+        # The unacked one and the two still queued, not those dropped
+        self.start_server()
+        session = self.server.broker.sessions["sub"]
+        self.assertEqual(len(session.inflight) + len(session.offline), 3)
+        self.stop_server()
+
+    def test_offline_drops_are_not_restored(self):
+        # Room for one message in memory and two on disk
+        self.start_server(offline_memory=300, offline_spill=300)
+        sub = self.client("sub", clean=False)
+        sub.subscribe("a/b", qos=1)
+        sub.close()
+        pub = self.client("pub")
+        for i in range(5):
+            packet_id = (i + 1).to_bytes(2, "big")
+            pub.send(publish_frame("a/b", b"x" * 100, qos=1, packet_id=packet_id))
+            pub.assert_recv(b"\x40\x02" + packet_id)
+        # Handled after the last PUBLISH is fanned out
+        pub.send(b"\xc0\x00")
+        pub.assert_recv(b"\xd0\x00")
+        snapshot = self.server.broker.metrics_snapshot()
+        self.assertEqual(snapshot["messages"]["dropped"], 2)
+        self.stop_server()
+
+        self.start_server()
+        session = self.server.broker.sessions["sub"]
+        self.assertEqual(len(session.inflight) + len(session.offline), 3)
+        self.stop_server()
+
+    def test_restart_keeps_every_queued_message(self):
+        self.start_server()
+        sub = self.client("sub", clean=False)
+        sub.subscribe("a/b", qos=1)
+        sub.close()
+        pub = self.client("pub")
+        count = InflightWindow.MAX_QUEUED + 500
+        for i in range(count):
+            packet_id = (i + 1).to_bytes(2, "big")
+            pub.send(publish_frame("a/b", b"%d" % i, qos=1, packet_id=packet_id))
+            pub.assert_recv(b"\x40\x02" + packet_id)
+        self.stop_server()
+
+        self.start_server()
+        session = self.server.broker.sessions["sub"]
+        self.assertEqual(len(session.inflight) + len(session.offline), count)
+        sub = self.client("sub", clean=False)
+        for i in range(count):
+            data = sub.recv()
+            self.assertTrue(data.endswith(b"%d" % i))
+            sub.send(b"\x40\x02" + data[7:9])
+        self.stop_server()
+
+
+class TestConcurrency(unittest.TestCase):
+    """
+    Many clients of the threaded server publishing, subscribing and taking
+    over each other's client ids at once.
+    """
+
+    def setUp(self):
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-5)
+        self.addCleanup(sys.setswitchinterval, switch_interval)
+
+        self.errors = []
+        errors = self.errors
+
+        class RecordingServer(Server):
+            def handle_error(self, request, client_address):
+                errors.append(sys.exc_info()[1])
+
+        self.server = RecordingServer(("localhost", 0), Handler)
+        threading.Thread(
+            target=self.server.serve_forever, args=(0.05,), daemon=True
+        ).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+    def run_threads(self, target, count):
+        threads = [threading.Thread(target=target, args=(i,)) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        return threads
+
+    def test_stress(self):
+        address = self.server.server_address
+        publishers, messages, subscribers = 4, 100, 4
+        received = [[] for _ in range(subscribers)]
+        done = threading.Event()
+
+        subs = []
+        for i in range(subscribers):
+            sub = BrokerClient(address, f"sub-{i}")
+            sub.subscribe("s/+", qos=1)
+            subs.append(sub)
+
+        def receive(i):
+            sub = subs[i]
+            while len(received[i]) < publishers * messages:
+                data = sub.recv()
+                packet_id = data[-6:-4]
+                sub.send(b"\x40\x02" + packet_id)
+                received[i].append(data[-4:])
+
+        def publish(i):
+            pub = BrokerClient(address, f"pub-{i}")
+            for j in range(messages):
+                payload = bytes([i]) + j.to_bytes(3, "big")
+                packet_id = (j + 1).to_bytes(2, "big")
+                pub.send(publish_frame(f"s/{i}", payload, 1, packet_id))
+                pub.assert_recv(b"\x40\x02" + packet_id)
+            pub.close()
+
+        def churn(i):
+            # Subscribe, join a group and get taken over by the next thread,
+            # which closes this connection
+            j = 0
+            while not done.is_set():
+                j += 1
+                try:
+                    client = BrokerClient(address, f"churn-{j % 3}", clean=j % 2 == 0)
+                except ConnectionError:
+                    continue
+                try:
+                    client.send(subscribe_frame(b"\x00\x01", "s/#"))
+                    client.send(subscribe_frame(b"\x00\x02", f"$share/g{i % 2}/s/+", 1))
+                    client.send(subscribe_frame(b"\x00\x03", f"x/{j}"))
+                    client.send(b"\xc0\x00")
+                    while client.recv() != b"\xd0\x00":
+                        pass
+                except OSError:
+                    pass
+                client.close()
+
+        readers = self.run_threads(receive, subscribers)
+        churners = self.run_threads(churn, 4)
+        for thread in self.run_threads(publish, publishers):
+            thread.join()
+        for thread in readers:
+            thread.join(10)
+        done.set()
+        for thread in churners:
+            thread.join()
+        for sub in subs:
+            sub.close()
+
+        # Every message exactly once, in order per publisher
+        expected = [
+            bytes([i]) + j.to_bytes(3, "big")
+            for i in range(publishers)
+            for j in range(messages)
+        ]
+        for messages_received in received:
+            self.assertEqual(sorted(messages_received), expected)
+        self.assertEqual(self.errors, [])
+
+        # Nothing left behind once the persistent sessions are gone too
+        for j in range(3):
+            BrokerClient(address, f"churn-{j}").close()
+        broker = self.server.broker
+        deadline = time.monotonic() + 5
+        while len(broker.sessions) > 0:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+        self.assertEqual(broker.clients, {})
+        self.assertEqual(broker.share_groups, {})
+        self.assertEqual(len(broker.subscriptions), 0)
+        self.assertEqual(broker.subscriptions.active_filters(), [])
+
+
+class TestRouting(unittest.TestCase):
+    """
+    Brokers of one node linked by routers, as run by `main.py --workers`.
+    """
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        self.clients = []
+
+        self.servers = []
+        self.routers = []
+        for i in range(3):
+            self.run_in_loop(self.start_worker(i))
+        self.wait_for(lambda: all(len(r.links) == 2 for r in self.routers))
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        for server, router in zip(self.servers, self.routers):
+            self.run_in_loop(router.close())
+            self.run_in_loop(server.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    async def start_worker(self, i):
+        server = AsyncServer(("localhost", 0))
+        await server.start()
+        router = Router(server.broker, f"worker-{i}")
+        await router.listen_unix(os.path.join(self.dir.name, f"{i}.sock"))
+        for j in range(i):
+            router.connect_unix(os.path.join(self.dir.name, f"{j}.sock"))
+        self.servers.append(server)
+        self.routers.append(router)
+
+    def run_in_loop(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def wait_for(self, predicate):
+        deadline = time.monotonic() + 5
+        while not predicate():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+    def client(self, worker, client_id):
+        client = BrokerClient(self.servers[worker].address(), client_id)
+        self.clients.append(client)
+        return client
+
+    def test_forwarding(self):
+        sub = self.client(1, "sub")
+        sub.subscribe("a/+")
+        self.wait_for(lambda: self.routers[0].links["worker-1"].filters.matches("a/b"))
+
+        pub = self.client(0, "pub")
+        pub.send(publish_frame("a/b", b"hello"))
+        sub.assert_recv(publish_frame("a/b", b"hello"))
+
+        # Only sent where there are subscribers
+        pub.send(publish_frame("c", b"nobody"))
+        pub.send(b"\xc0\x00")
+        pub.assert_recv(b"\xd0\x00")
+        stats = self.routers[0].stats()
+        self.assertEqual(stats["worker-1"]["sent"], 1)
+        self.assertEqual(stats["worker-2"]["sent"], 0)
+
+        # Disconnecting removes the filter everywhere
+        sub.close()
+        self.wait_for(
+            lambda: all(len(r.links["worker-1"].filters) == 0 for r in self.routers[::2])
+        )
+
+    def test_retained_messages(self):
+        pub = self.client(0, "pub")
+        pub.send(publish_frame("r", b"kept", retain=True))
+        self.wait_for(lambda: self.servers[2].broker.retained.get("r") is not None)
+
+        sub = self.client(2, "sub")
+        sub.subscribe("r")
+        sub.assert_recv(publish_frame("r", b"kept", retain=True))
+
+    def test_duplicate_link(self):
+        router = self.routers[2]
+        self.run_in_loop(self.connect(router, 0))
+        self.assertEqual(len(router.links), 2)
+
+    async def connect(self, router, i):
+        router.connect_unix(os.path.join(self.dir.name, f"{i}.sock"))
+        await asyncio.sleep(0.1)
+
+
+class TestCluster(unittest.TestCase):
+    """
+    Threaded servers on localhost linked into a cluster, each by a router in
+    a shared event loop.
+    """
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        threading.Thread(target=self.loop.run_forever, daemon=True).start()
+        self.clients = []
+
+        # Each node is only told about the one before it
+        self.servers = []
+        self.routers = []
+        for i in range(3):
+            self.start_node(i, peers=[self.routers[i - 1].address] if i > 0 else [])
+        self.wait_for(lambda: all(len(r.links) == 2 for r in self.routers))
+
+    def tearDown(self):
+        for client in self.clients:
+            client.close()
+        for server, router in zip(self.servers, self.routers):
+            self.run_in_loop(router.close())
+            server.shutdown()
+            server.server_close()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+    def start_node(self, i, peers):
+        server = Server(("localhost", 0), Handler)
+        threading.Thread(target=server.serve_forever, args=(0.05,), daemon=True).start()
+        self.servers.append(server)
+        self.routers.append(self.run_in_loop(self.start_router(server, i, peers)))
+
+    async def start_router(self, server, i, peers):
+        router = Router(server.broker, f"node-{i}")
+        await router.listen_tcp("localhost", 0)
+        router.address = f"localhost:{router.port()}"
+        for peer in peers:
+            router.connect_tcp(peer)
+        return router
+
+    def run_in_loop(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def wait_for(self, predicate):
+        deadline = time.monotonic() + 5
+        while not predicate():
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+    def client(self, node, client_id):
+        client = BrokerClient(self.servers[node].server_address, client_id)
+        self.clients.append(client)
+        return client
+
+    def subscribe_everywhere(self, topic_filter):
+        subs = []
+        for node in range(3):
+            sub = self.client(node, f"sub-{node}")
+            sub.subscribe(topic_filter)
+            subs.append(sub)
+        self.wait_for(
+            lambda: all(
+                len(link.filters) == 1 for r in self.routers for link in r.links.values()
+            )
+        )
+        return subs
+
+    def test_forwarded_once(self):
+        subs = self.subscribe_everywhere("#")
+        pub = self.client(1, "pub")
+        pub.send(publish_frame("a/b", b"hello"))
+        for sub in subs:
+            sub.assert_recv(publish_frame("a/b", b"hello"))
+            sub.send(b"\xc0\x00")
+            sub.assert_recv(b"\xd0\x00")
+
+    def test_duplicate_links(self):
+        # Dialed by gossip already; both ends keep one of the two links
+        router = self.routers[2]
+        self.loop.call_soon_threadsafe(router.connect_tcp, self.routers[0].address)
+        self.wait_for(lambda: router.dialing.get(self.routers[0].address) == "node-0")
+        time.sleep(0.1)
+        self.assertEqual(len(router.links), 2)
+        self.assertIs(
+            router.links["node-0"].transport is None,
+            self.routers[0].links["node-2"].transport is None,
+        )
+        self.test_forwarded_once()
+
+    def test_batched_writes(self):
+        sub = self.subscribe_everywhere("a")[0]
+        pub = self.client(2, "pub")
+        frame = publish_frame("a", b"x" * 100)
+        pub.send(frame * 1000)
+        for _ in range(1000):
+            sub.assert_recv(frame)
+
+        stats = self.routers[2].stats()["node-0"]
+        self.assertEqual(stats["sent"], 1000)
+        self.assertLess(stats["flushes"], 1000)
+
+
+class TestWorkers(unittest.TestCase):
+    def test_sigterm_stops_workers(self):
+        broker = BrokerProcess("asyncio", ["--workers", "2"])
+        pid = broker.process.pid
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            workers = [int(child) for child in f.read().split()]
+        self.assertEqual(len(workers), 2)
+
+        # SIGTERM
+        broker.stop()
+        for worker in workers:
+            with self.assertRaises(ProcessLookupError):
+                os.kill(worker, 0)
+
+
+class TestBenchmarks(unittest.TestCase):
+    def test_client(self):
+        async def run():
+            server = AsyncServer(("localhost", 0))
+            await server.start()
+            host, port = server.address()
+
+            received = []
+            sub = Client(lambda topic, payload, qos: received.append((topic, qos)))
+            self.assertFalse(await sub.connect(host, port, "sub"))
+            codes = await sub.subscribe(
+                [("a/+", QosLevel.EXACTLY_ONCE), ("$bad/#/x", QosLevel(0))]
+            )
+            self.assertEqual(codes, b"\x02\x80")
+
+            pub = Client()
+            await pub.connect(host, port, "pub")
+            for qos in QosLevel:
+                await pub.publish("a/b", b"x", qos)
+            await pub.ping()
+            await pub.disconnect()
+            while len(received) < 3:
+                await asyncio.sleep(0.01)
+            await sub.disconnect()
+            await server.close()
+            return received
+
+        self.assertEqual(asyncio.run(run()), [("a/b", qos) for qos in QosLevel])
+
+    def test_regressions(self):
+        def results(rate, p99, rss):
+            return {
+                "scenarios": {
+                    "fan_out": {
+                        "msgs_per_s": rate,
+                        "latency_ms": {"p99": p99},
+                        "peak_rss_mb": rss,
+                    }
+                }
+            }
+
+        baseline = results(1000, 10, 50)
+        self.assertEqual(regressions(results(950, 10.5, 52), baseline, 0.1), [])
+        found = regressions(results(800, 20, 50), baseline, 0.1)
+        self.assertEqual(
+            found,
+            [
+                "fan_out msgs/s: 1000.00 -> 800.00 (-20%)",
+                "fan_out p99 ms: 10.00 -> 20.00 (+100%)",
+            ],
+        )
+
 
 if __name__ == "__main__":
     unittest.main()
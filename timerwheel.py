@@ -0,0 +1,145 @@
+"""
+Hierarchical timing wheel, the structure kernels use for their timers.
+
+Level 0 has one slot per tick for the next 64 ticks, level 1 one slot per 64
+ticks for the next 64 * 64 ticks, and so on. A timer goes into the coarsest
+slot that still pins down when it expires. Each tick only looks at one
+level-0 slot; every 64 ticks one slot of the next level is cascaded, i.e.
+its timers are spread over the finer level. Scheduling, cancelling and
+expiring a timer are all O(1) (amortized over cascades), so a tick costs
+O(expired timers) no matter how many are pending.
+"""
+
+from typing import Callable, List, Optional
+import math
+import threading
+import time
+
+
+class Timer:
+    __slots__ = ("expires", "callback", "args")
+
+    def __init__(self, expires: int, callback: Callable, args: tuple):
+        self.expires = expires
+        self.callback: Optional[Callable] = callback
+        self.args = args
+
+    def cancel(self):
+        # Cancelled timers stay in their slot until it is processed; drop the
+        # references so they don't keep anything alive meanwhile.
+        self.callback = None
+        self.args = ()
+
+    def cancelled(self) -> bool:
+        return self.callback is None
+
+
+class TimerWheel:
+    # Seconds per tick
+    TICK = 0.1
+
+    SLOT_BITS = 6
+    SLOTS = 1 << SLOT_BITS
+    LEVELS = 4
+
+    def __init__(self, tick: float = TICK, clock: Callable[[], float] = time.monotonic):
+        self.tick = tick
+        self.clock = clock
+        self.origin = clock()
+
+        # Next tick to process
+        self.current = 0
+
+        self.wheels: List[List[List[Timer]]] = [
+            [[] for _ in range(self.SLOTS)] for _ in range(self.LEVELS)
+        ]
+        self.count = 0
+
+        # Timers are scheduled from any thread in the threaded mode
+        self.lock = threading.Lock()
+
+    def schedule(self, delay: float, callback: Callable, *args) -> Timer:
+        """
+        Calls `callback(*args)` in `delay` seconds, rounded up to the next
+        tick.
+        """
+        with self.lock:
+            now = self._now_ticks()
+            ticks = max(1, math.ceil(delay / self.tick))
+            # Ticks up to `current` are processed already
+            timer = Timer(max(now + ticks, self.current), callback, args)
+            self._add(timer)
+            self.count += 1
+            return timer
+
+    def advance(self) -> int:
+        """
+        Runs every timer that expired by now. Returns how many ran.
+        """
+        expired = []
+        with self.lock:
+            now = self._now_ticks()
+            while self.current <= now:
+                index = self.current & (self.SLOTS - 1)
+                if index == 0:
+                    self._cascade(1)
+
+                slot = self.wheels[0][index]
+                if len(slot) > 0:
+                    self.wheels[0][index] = []
+                    self.count -= len(slot)
+                    expired.extend(t for t in slot if not t.cancelled())
+
+                self.current += 1
+
+        # Callbacks may schedule new timers, so run them unlocked
+        for timer in expired:
+            callback, args = timer.callback, timer.args
+            if callback is not None:
+                timer.cancel()
+                callback(*args)
+
+        return len(expired)
+
+    def __len__(self):
+        """
+        Returns the number of scheduled timers, cancelled ones included until
+        their slot is processed.
+        """
+        return self.count
+
+    def _now_ticks(self) -> int:
+        return int((self.clock() - self.origin) / self.tick)
+
+    def _add(self, timer: Timer):
+        delta = timer.expires - self.current
+        for level in range(self.LEVELS):
+            if delta < 1 << (self.SLOT_BITS * (level + 1)):
+                break
+        else:
+            # Further out than the wheel reaches: park it in the last slot of
+            # the top level, from where it gets cascaded again
+            level = self.LEVELS - 1
+            horizon = self.current + (1 << (self.SLOT_BITS * self.LEVELS)) - 1
+            index = (horizon >> (self.SLOT_BITS * level)) & (self.SLOTS - 1)
+            self.wheels[level][index].append(timer)
+            return
+
+        index = (timer.expires >> (self.SLOT_BITS * level)) & (self.SLOTS - 1)
+        self.wheels[level][index].append(timer)
+
+    def _cascade(self, level: int):
+        if level >= self.LEVELS:
+            return
+
+        index = (self.current >> (self.SLOT_BITS * level)) & (self.SLOTS - 1)
+        if index == 0:
+            self._cascade(level + 1)
+
+        slot = self.wheels[level][index]
+        self.wheels[level][index] = []
+        for timer in slot:
+            if not timer.cancelled():
+                self._add(timer)
+            else:
+                self.count -= 1
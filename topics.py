@@ -0,0 +1,456 @@
+"""
+Topic names and topic filters, MQTT 3.1.1 section 4.7.
+
+A topic is split into levels on "/". In a filter, "+" matches exactly one
+level and "#" matches any number of levels, including the parent level
+("sport/#" matches "sport"). Both must occupy a whole level, and "#" must be
+the last one. Topics starting with "$" are not matched by filters starting
+with a wildcard.
+
+"$share/<group>/<filter>" subscribes to <filter> as a member of a shared
+subscription, see shared.py.
+"""
+
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+import sys
+import threading
+from protocol import QosLevel
+
+SHARE_PREFIX = "$share/"
+
+
+def split_shared(topic_filter: str) -> Optional[Tuple[str, str]]:
+    """
+    Returns the group and filter of a shared subscription, None for other
+    filters.
+    """
+    if not topic_filter.startswith(SHARE_PREFIX):
+        return None
+    group, _, topic_filter = topic_filter[len(SHARE_PREFIX) :].partition("/")
+    return group, topic_filter
+
+
+def is_valid_filter(topic_filter: str) -> bool:
+    shared = split_shared(topic_filter)
+    if shared is not None:
+        group, topic_filter = shared
+        if group == "" or "+" in group or "#" in group:
+            return False
+
+    if topic_filter == "":
+        return False
+
+    levels = topic_filter.split("/")
+    for i, level in enumerate(levels):
+        if "#" in level and (level != "#" or i != len(levels) - 1):
+            return False
+        if "+" in level and level != "+":
+            return False
+    return True
+
+
+def is_valid_topic(topic: str) -> bool:
+    return topic != "" and "+" not in topic and "#" not in topic
+
+
+class _Node:
+    __slots__ = ("children", "subscribers")
+
+    def __init__(self):
+        self.children: Dict[str, _Node] = {}
+        # maps client id to the qos it subscribed with
+        self.subscribers: Dict[str, QosLevel] = {}
+
+
+class _CacheNode:
+    __slots__ = ("children", "cached")
+
+    def __init__(self):
+        self.children: Dict[str, _CacheNode] = {}
+        self.cached = False
+
+
+class _CacheShard:
+    """
+    Part of a `MatchCache`: its own topics, LRU order, index and lock.
+    """
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+
+        # maps topic to its subscribers, least recently used first
+        self.entries: OrderedDict[str, Dict[str, QosLevel]] = OrderedDict()
+        self.root = _CacheNode()
+
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.invalidated = 0
+
+        self.lock = threading.Lock()
+
+    def get(self, topic: str) -> Optional[Dict[str, QosLevel]]:
+        with self.lock:
+            res = self.entries.get(topic)
+            if res is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(topic)
+            self.hits += 1
+            return res
+
+    def put(self, topic: str, res: Dict[str, QosLevel], stale):
+        with self.lock:
+            # Checked with the lock held, see `MatchCache.version`
+            if stale() or topic in self.entries:
+                return
+
+            self.entries[topic] = res
+            node = self.root
+            for level in topic.split("/"):
+                child = node.children.get(level)
+                if child is None:
+                    child = node.children[level] = _CacheNode()
+                node = child
+            node.cached = True
+
+            if len(self.entries) > self.max_size:
+                oldest, _ = self.entries.popitem(last=False)
+                self._remove(oldest)
+                self.evicted += 1
+
+    def invalidate(self, topic_filter: str):
+        with self.lock:
+            for topic in self._match(topic_filter):
+                del self.entries[topic]
+                self._remove(topic)
+                self.invalidated += 1
+
+    def _match(self, topic_filter: str) -> List[str]:
+        """
+        Returns the cached topics matching `topic_filter`. Wildcards match
+        topics starting with "$" here too: evicting more than needed is safe.
+        """
+        res = []
+        levels = topic_filter.split("/")
+
+        # (node, index of the next filter level, topic levels so far)
+        stack = [(self.root, 0, [])]
+        while len(stack) > 0:
+            node, i, path = stack.pop()
+            if i == len(levels):
+                if node.cached:
+                    res.append("/".join(path))
+                continue
+
+            level = levels[i]
+            if level == "#":
+                # "a/#" matches "a" as well as everything below it
+                if node.cached and i > 0:
+                    res.append("/".join(path))
+                below = [(node, path)]
+                while len(below) > 0:
+                    parent, parent_path = below.pop()
+                    for name, child in parent.children.items():
+                        child_path = parent_path + [name]
+                        if child.cached:
+                            res.append("/".join(child_path))
+                        below.append((child, child_path))
+            elif level == "+":
+                for name, child in node.children.items():
+                    stack.append((child, i + 1, path + [name]))
+            else:
+                child = node.children.get(level)
+                if child is not None:
+                    stack.append((child, i + 1, path + [level]))
+        return res
+
+    def _remove(self, topic: str):
+        path = [self.root]
+        levels = topic.split("/")
+        for level in levels:
+            path.append(path[-1].children[level])
+        path[-1].cached = False
+
+        # Prune nodes left without topics or children
+        for i in range(len(levels), 0, -1):
+            node = path[i]
+            if node.cached or len(node.children) > 0:
+                break
+            del path[i - 1].children[levels[i - 1]]
+
+
+class MatchCache:
+    """
+    Least recently used topics and their subscribers, as returned by
+    `TopicTrie.match`.
+
+    When the subscribers of a filter change, only the cached topics the filter
+    matches are evicted. Cached topics are indexed in a trie of their own for
+    that, so evicting for "a/+/c" only visits the children of "a".
+
+    Topics are spread over shards by hash, each with its own lock, so
+    concurrent publishers rarely wait for each other on a lookup. Recency is
+    tracked per shard.
+    """
+
+    MAX_SIZE = 100_000
+
+    SHARDS = 16
+
+    # Caches smaller than this per shard get fewer shards
+    MIN_SHARD_SIZE = 1024
+
+    def __init__(self, max_size: int = MAX_SIZE):
+        self.max_size = max_size
+
+        count = max(1, min(self.SHARDS, max_size // self.MIN_SHARD_SIZE))
+        self.shards = [_CacheShard(max(1, max_size // count)) for _ in range(count)]
+
+        # Bumped by every invalidation, before any shard is swept. A match
+        # computed while the subscriptions changed (another thread) could
+        # already be stale, and isn't cached.
+        self.version = 0
+
+    def shard(self, topic: str) -> _CacheShard:
+        return self.shards[hash(topic) % len(self.shards)]
+
+    def get(self, topic: str) -> Optional[Dict[str, QosLevel]]:
+        return self.shard(topic).get(topic)
+
+    def put(self, topic: str, res: Dict[str, QosLevel], version: int):
+        """
+        Caches `res`, computed when the cache was at `version`.
+        """
+        self.shard(topic).put(topic, res, lambda: version != self.version)
+
+    def invalidate(self, topic_filter: str):
+        """
+        Evicts the topics matching `topic_filter`. Callers serialize
+        invalidations.
+        """
+        self.version += 1
+        for shard in self.shards:
+            shard.invalidate(topic_filter)
+
+    def topics(self) -> List[str]:
+        """
+        Returns the cached topics, least recently used first within a shard.
+        """
+        res = []
+        for shard in self.shards:
+            with shard.lock:
+                res.extend(shard.entries)
+        return res
+
+    def __len__(self):
+        return sum(len(shard.entries) for shard in self.shards)
+
+    def stats(self) -> dict:
+        hits = sum(shard.hits for shard in self.shards)
+        misses = sum(shard.misses for shard in self.shards)
+        lookups = hits + misses
+        return {
+            "size": len(self),
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / lookups if lookups > 0 else 0.0,
+            "evicted": sum(shard.evicted for shard in self.shards),
+            "invalidated": sum(shard.invalidated for shard in self.shards),
+        }
+
+
+class TopicTrie:
+    """
+    Subscription index: one node per filter level, subscribers hang off the
+    node of the last level.
+
+    Matching a topic walks the trie level by level and only follows the
+    exact, "+" and "#" children, so its cost depends on the depth of the
+    topic, not on the number of subscriptions. A reverse index from client id
+    to its filters lets a disconnecting client be removed without scanning
+    every subscription.
+
+    With a `cache_size`, the subscribers of the most recently published
+    topics are kept in a `MatchCache`, so the hot topics skip the walk.
+
+    Changes are serialized by `lock`; matching takes no lock. A walk only
+    looks up children by name, which is atomic, and copies the subscribers
+    of a node before going through them, so a concurrent change is either
+    seen whole or not at all. Other readers copy what they iterate as well.
+    """
+
+    def __init__(self, cache_size: int = 0):
+        self.cache = MatchCache(cache_size) if cache_size > 0 else None
+
+        self.root = _Node()
+
+        # maps client id to its filters and their qos
+        self.client_filters: Dict[str, Dict[str, QosLevel]] = {}
+
+        # Told when a filter gets its first subscriber (`filter_added`) and
+        # loses its last one (`filter_removed`), e.g. to keep other brokers'
+        # view of our subscriptions up to date
+        self.listener = None
+
+        self.lock = threading.Lock()
+
+    def subscribe(self, client_id: str, topic_filter: str, qos_level: QosLevel):
+        """
+        Adds or replaces the subscription of `client_id` to `topic_filter`.
+        """
+        with self.lock:
+            self._subscribe(client_id, topic_filter, qos_level)
+
+    def _subscribe(self, client_id: str, topic_filter: str, qos_level: QosLevel):
+        node = self.root
+        for level in topic_filter.split("/"):
+            child = node.children.get(level)
+            if child is None:
+                # Levels like "status" recur under thousands of nodes; keep
+                # one copy of each
+                child = node.children[sys.intern(level)] = _Node()
+            node = child
+
+        added = len(node.subscribers) == 0
+        node.subscribers[client_id] = qos_level
+        self.client_filters.setdefault(client_id, {})[topic_filter] = qos_level
+        if self.cache is not None:
+            self.cache.invalidate(topic_filter)
+
+        if added and self.listener is not None:
+            self.listener.filter_added(topic_filter)
+
+    def unsubscribe(self, client_id: str, topic_filter: str) -> bool:
+        """
+        Returns whether `client_id` was subscribed to `topic_filter`.
+        """
+        with self.lock:
+            return self._unsubscribe(client_id, topic_filter)
+
+    def _unsubscribe(self, client_id: str, topic_filter: str) -> bool:
+        filters = self.client_filters.get(client_id)
+        if filters is None or topic_filter not in filters:
+            return False
+
+        del filters[topic_filter]
+        if len(filters) == 0:
+            del self.client_filters[client_id]
+
+        # Remember the path so empty nodes can be pruned bottom-up
+        path = [self.root]
+        levels = topic_filter.split("/")
+        for level in levels:
+            path.append(path[-1].children[level])
+
+        del path[-1].subscribers[client_id]
+        removed = len(path[-1].subscribers) == 0
+        if self.cache is not None:
+            self.cache.invalidate(topic_filter)
+
+        for i in range(len(levels), 0, -1):
+            node = path[i]
+            if len(node.subscribers) > 0 or len(node.children) > 0:
+                break
+            del path[i - 1].children[levels[i - 1]]
+
+        if removed and self.listener is not None:
+            self.listener.filter_removed(topic_filter)
+        return True
+
+    def remove_client(self, client_id: str):
+        with self.lock:
+            for topic_filter in list(self.client_filters.get(client_id, ())):
+                self._unsubscribe(client_id, topic_filter)
+
+    def filters(self, client_id: str) -> Dict[str, QosLevel]:
+        return self.client_filters.get(client_id, {})
+
+    def active_filters(self) -> List[str]:
+        """
+        Returns every filter somebody is subscribed to.
+        """
+        res = []
+        # (node, its filter levels)
+        stack = [(self.root, [])]
+        while len(stack) > 0:
+            node, levels = stack.pop()
+            if len(node.subscribers) > 0:
+                res.append("/".join(levels))
+            for level, child in list(node.children.items()):
+                stack.append((child, levels + [level]))
+        return res
+
+    def matches(self, topic: str) -> bool:
+        """
+        Returns whether anybody is subscribed to `topic`.
+        """
+        return len(self.match(topic)) > 0
+
+    def match(self, topic: str) -> Dict[str, QosLevel]:
+        """
+        Returns the subscribers of `topic` with the qos they subscribed with.
+        A client with several matching filters gets the maximum of their qos.
+
+        The result may be shared with later calls: don't modify it.
+        """
+        if self.cache is None:
+            return self._match(topic)
+
+        res = self.cache.get(topic)
+        if res is None:
+            version = self.cache.version
+            res = self._match(topic)
+            self.cache.put(topic, res, version)
+        return res
+
+    def _match(self, topic: str) -> Dict[str, QosLevel]:
+        res: Dict[str, QosLevel] = {}
+        levels = topic.split("/")
+
+        # Wildcards at the first level don't match topics starting with "$"
+        wildcards = not topic.startswith("$")
+
+        nodes: List[_Node] = [self.root]
+        for level in levels:
+            next_nodes = []
+            for node in nodes:
+                if wildcards:
+                    multi = node.children.get("#")
+                    if multi is not None:
+                        self._collect(multi, res)
+
+                    single = node.children.get("+")
+                    if single is not None:
+                        next_nodes.append(single)
+
+                child = node.children.get(level)
+                if child is not None:
+                    next_nodes.append(child)
+
+            if len(next_nodes) == 0:
+                return res
+
+            nodes = next_nodes
+            wildcards = True
+
+        for node in nodes:
+            self._collect(node, res)
+
+            # "sport/#" also matches "sport"
+            multi = node.children.get("#")
+            if multi is not None:
+                self._collect(multi, res)
+
+        return res
+
+    @staticmethod
+    def _collect(node: _Node, res: Dict[str, QosLevel]):
+        for client_id, qos_level in node.subscribers.copy().items():
+            current: Optional[QosLevel] = res.get(client_id)
+            if current is None or current.value < qos_level.value:
+                res[client_id] = qos_level
+
+    def __len__(self):
+        return sum(len(filters) for filters in list(self.client_filters.values()))